@@ -36,7 +36,8 @@ you really need it, you should be able to figure it out.
 import struct
 import fcntl
 
-from .diskio import BTDiskSyncIO, BTDiskAIO, BTDiskBlockFDIO
+from .diskio import BTDiskSyncIO, BTDiskAIO, BTDiskBlockFDIO, DiskIOStats, \
+   backend_stats_get
 
 class LNFSError(Exception):
    pass
@@ -130,6 +131,7 @@ class LNFSDiskIOBase:
       self._volume = volume
       self._offset = offset
       self._length = length
+      self.io_stats = DiskIOStats(backend_stats_get(self.__class__.__name__))
 
    def _fileset_get(self, offset:int, length:int):
       if (offset < 0):
@@ -140,6 +142,11 @@ class LNFSDiskIOBase:
          raise ValueError('_fileset_get({0}, {1}) called on {0} with length {1}'.format(offset, length, self, self._length))
       return ((self._volume.f, self._offset+offset, length),)
 
+   def file_stats_get(self):
+      # Torrent data is stored inside the volume; there's no per-file
+      # metadata to compare.
+      return None
+
    def close(self):
       pass
 
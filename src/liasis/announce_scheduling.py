@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Client-wide scheduling of tracker announces"""
+
+import logging
+import random
+import time
+
+
+class AnnounceScheduler:
+   """Decide when the torrents of a client announce to their trackers
+
+   Torrents ask for an announce to be made after some delay, and are told
+   when to make it by a call to their client_announce_tracker() method. A
+   single timer is used for all of them, and the number of announces in
+   flight at any time is limited. When announces are sent to a tracker,
+   announces of other torrents to the same tracker that are due soon are
+   brought forward to go out with them, so they can share connections."""
+   logger = logging.getLogger('AnnounceScheduler')
+   log = logger.log
+   # Default limit on number of announces in flight at once
+   announces_active_max_default = 8
+   # Maximum fraction of announce delays randomly added to them
+   jitter = 0.1
+   # Seconds by which announces to a tracker that is being contacted anyway
+   # may be brought forward
+   coalesce_window = 120
+   # Seconds after which unfinished announces stop counting against
+   # announces_active_max
+   announce_timeout = 300
+   def __init__(self, event_dispatcher, announces_active_max=None):
+      if (announces_active_max is None):
+         announces_active_max = self.announces_active_max_default
+      self.ed = event_dispatcher
+      self.announces_active_max = announces_active_max
+      # bth -> (ts due, event)
+      self.schedule = {}
+      # bth -> ts announce started
+      self.announces_active = {}
+      self.timer = None
+      self.ts_timer = None
+      self.dispatching = False
+
+   def bth_scheduled(self, bth):
+      """Return whether bth has an announce scheduled"""
+      return (bth in self.schedule)
+
+   def announce_schedule(self, bth, delay, event=None):
+      """Have bth announce with specified event in about delay seconds;
+         replaces any announce scheduled for it previously, unless that one
+         carries an event and this one doesn't"""
+      if (delay > 0):
+         delay *= 1 + random.uniform(0, self.jitter)
+      if ((event is None) and (bth in self.schedule)):
+         event = self.schedule[bth][1]
+      self.schedule[bth] = (time.time() + delay, event)
+      self._timer_update()
+
+   def announce_finish(self, bth):
+      """Note that the announce of bth has finished"""
+      if (self.announces_active.pop(bth, None) is None):
+         return
+      self._announces_dispatch()
+
+   def bth_remove(self, bth):
+      """Forget about scheduled and pending announces of bth"""
+      self.schedule.pop(bth, None)
+      if not (self.announces_active.pop(bth, None) is None):
+         self._announces_dispatch()
+      else:
+         self._timer_update()
+
+   def _slots_free_get(self):
+      return (self.announces_active_max - len(self.announces_active))
+
+   def _announces_dispatch(self):
+      """Start due announces, as far as our limit allows"""
+      if (self.dispatching):
+         # Announce failed synchronously; our caller will pick up the slot.
+         return
+      now = time.time()
+      for (bth, ts_start) in tuple(self.announces_active.items()):
+         if (ts_start + self.announce_timeout <= now):
+            self.log(30, '{0} timeouted announce of {1}.'.format(self, bth))
+            del(self.announces_active[bth])
+      if ((self._slots_free_get() <= 0) or not (self.schedule)):
+         self._timer_update()
+         return
+      
+      self.dispatching = True
+      try:
+         self._announces_start(now)
+      finally:
+         self.dispatching = False
+      self._timer_update()
+   
+   def _announces_start(self, now):
+      """Start due announces, each together with announces of other torrents
+         to the same tracker that are due soon"""
+      # Everything we might start in this call, most urgent first.
+      candidates = sorted(((ts_due, id(bth), bth) for (bth, (ts_due, event))
+         in self.schedule.items() if (ts_due <= now + self.coalesce_window)),
+         key=lambda c: c[:2])
+      by_tracker = {}
+      for (ts_due, i, bth) in candidates:
+         an_url = bth.announce_url_get()
+         try:
+            by_tracker[an_url].append(bth)
+         except KeyError:
+            by_tracker[an_url] = [bth]
+
+      for (ts_due, i, bth) in candidates:
+         if (ts_due > now):
+            break
+         for bth_g in by_tracker.pop(bth.announce_url_get(), ()):
+            if (self._slots_free_get() <= 0):
+               return
+            if not (bth_g in self.schedule):
+               # Started by an earlier group, or dropped in the meantime.
+               continue
+            (ts_due_g, event) = self.schedule.pop(bth_g)
+            self.announces_active[bth_g] = now
+            bth_g.client_announce_tracker(event, event_force=True)
+
+   def _timer_update(self):
+      """Make sure our timer fires when the next announce is due"""
+      if not (self.schedule):
+         ts_next = None
+      elif (self._slots_free_get() > 0):
+         ts_next = min(ts_due for (ts_due, event) in self.schedule.values())
+      else:
+         # Nothing to do until an announce finishes or times out.
+         ts_next = min(self.announces_active.values()) + self.announce_timeout
+      if (ts_next == self.ts_timer):
+         return
+      if not (self.timer is None):
+         self.timer.cancel()
+         self.timer = None
+      self.ts_timer = ts_next
+      if (ts_next is None):
+         return
+      self.timer = self.ed.set_timer(max(ts_next - time.time(), 0),
+         self._timer_handle, parent=self)
+
+   def _timer_handle(self):
+      self.timer = None
+      self.ts_timer = None
+      self._announces_dispatch()
+
+   def close(self):
+      """Cancel our timer and forget about all announces"""
+      if not (self.timer is None):
+         self.timer.cancel()
+         self.timer = None
+      self.ts_timer = None
+      self.schedule = {}
+      self.announces_active = {}
+
+   def __repr__(self):
+      return '<{0} scheduled: {1} active: {2}/{3} id: {4}>'.format(
+         self.__class__.__name__, len(self.schedule),
+         len(self.announces_active), self.announces_active_max, id(self))
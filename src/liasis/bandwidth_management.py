@@ -17,6 +17,9 @@
 
 """Liasis gonium bandwidth limiting and counting structures."""
 
+import time
+from array import array
+
 from gonium.event_multiplexing import EventMultiplexer
 
 class BandwidthError(Exception):
@@ -31,11 +34,12 @@ class BandwidthRequest:
       self.priority = priority
       self.parent = parent
       self.request_ts = time.time()
+      self.cancelled = False
    
    def __eq__(self, other):
-      return self.__cmp__(other) == 0
+      return (self is other)
    def __ne__(self, other):
-      return self.__cmp__(other) != 0
+      return not (self is other)
    def __lt__(self, other):
       return self.__cmp__(other) == -1
    def __le__(self, other):
@@ -86,32 +90,196 @@ class BandwidthRequest:
       self.parent.requests_active.append(self)
       
    def unregister(self):
-      self.parent.requests_active.remove(self)
+      self.cancelled = True
+      if (self in self.parent.requests_active):
+         self.parent.requests_active.remove(self)
       
    cancel = unregister
 
+   def sort_key(self):
+      """Return key for sorting requests in the order they should be served"""
+      return (-self.priority, self.request_ts, id(self))
+
    def __repr__(self):
-      '{0}({1!a},{2!a},{3!a},{4!a})'.format(self.__class__.__name__, self.bytes, self.bytes_min, self.callback, self.priority)
+      return '{0}({1!a},{2!a},{3!a},{4!a})'.format(self.__class__.__name__, self.bytes, self.bytes_min, self.callback, self.priority)
+
+
+class RingBufferView:
+   """Read-only view of a range of slots of a RingBuffer; doesn't copy any
+      data, so it is only valid until the buffer is next written to"""
+   def __init__(self, ring_buffer, indices):
+      self.ring_buffer = ring_buffer
+      self.indices = indices
+   
+   def __len__(self):
+      return len(self.indices)
+   
+   def __getitem__(self, key):
+      if (isinstance(key, slice)):
+         return RingBufferView(self.ring_buffer, self.indices[key])
+      return self.ring_buffer[self.indices[key]]
+   
+   def __iter__(self):
+      rb = self.ring_buffer
+      history = rb.history
+      offset = rb.history_index + 1
+      length = rb.history_length
+      for i in self.indices:
+         yield history[(offset + i) % length]
+   
+   def tolist(self):
+      """Return contents as list"""
+      return list(self)
 
 
 class RingBuffer(object):
-   """Ring Buffer used for bandwidth logging"""
+   """Ring Buffer used for bandwidth logging
+   
+   Values are stored in an array of signed 64bit ints; slots which haven't
+   been written yet contain VALUE_NONE. Indexing is relative to the oldest
+   slot, so [-1] is the value added last. Slicing returns a RingBufferView
+   instead of copying."""
+   VALUE_NONE = -1
+   typecode = 'q'
    def __init__(self, history_length=1000, history_values_initial=None):
-      self.history = [history_values_initial]*history_length
-      self.history_index = 0
+      if (history_values_initial is None):
+         history_values_initial = self.VALUE_NONE
+      self.history = array(self.typecode, (history_values_initial,))*history_length
+      self.history_index = history_length - 1
       self.history_length = history_length
    
+   @classmethod
+   def build_from_seq(cls, history_length, seq):
+      """Build instance containing the last history_length values of seq"""
+      rv = cls(history_length)
+      for val in seq[-history_length:]:
+         rv.slice_add(val)
+      return rv
+   
    def slice_add(self, val):
       """Advance index and set resulting slot to specified value"""
+      if (val is None):
+         val = self.VALUE_NONE
       self.history_index = (self.history_index + 1) % self.history_length
       self.history[self.history_index] = val
    
+   def slice_add_repeat(self, val, count):
+      """Equivalent to calling slice_add(val) count times, but doesn't take
+         longer than filling the buffer once"""
+      if (count >= self.history_length):
+         self.history = array(self.typecode, (val,))*self.history_length
+         self.history_index = (self.history_index + count) % self.history_length
+         return
+      for i in range(count):
+         RingBuffer.slice_add(self, val)
+   
    def __len__(self):
       return self.history_length
    
+   def __iter__(self):
+      return iter(RingBufferView(self, range(self.history_length)))
+   
    def __getitem__(self, key):
-      history_linear = self.history[self.history_index + 1:] + self.history[:self.history_index + 1]
-      return history_linear.__getitem__(key)
+      if (isinstance(key, slice)):
+         return RingBufferView(self, range(self.history_length)[key])
+      if (key < 0):
+         key += self.history_length
+      if not (0 <= key < self.history_length):
+         raise IndexError('Index {0} out of range for {1!a}.'.format(key, self))
+      return self.history[(self.history_index + 1 + key) % self.history_length]
+   
+   def __repr__(self):
+      return '<{0} length: {1} id: {2}>'.format(self.__class__.__name__,
+         self.history_length, id(self))
+
+
+class RingBufferTier(RingBuffer):
+   """RingBuffer holding sums of fixed-size groups of slices of another one"""
+   def __init__(self, factor, *args, **kwargs):
+      RingBuffer.__init__(self, *args, **kwargs)
+      self.factor = factor
+      self.acc = 0
+      self.acc_count = 0
+   
+   def value_count(self, val):
+      """Count value added to lower-resolution buffer"""
+      if not ((val is None) or (val == self.VALUE_NONE)):
+         self.acc += val
+      self.acc_count += 1
+      if (self.acc_count >= self.factor):
+         self.slice_add(self.acc)
+         self.acc = 0
+         self.acc_count = 0
+   
+   def values_count(self, val, zeros):
+      """Count value val (unless None) followed by <zeros> zero values added to
+         lower-resolution buffer; returns the slices finished by this as
+         (value or None, count of zeros following it)"""
+      rv_val = None
+      rv_zeros = 0
+      if not (val is None):
+         self.value_count(val)
+         if (self.acc_count == 0):
+            rv_val = self[-1]
+      if not (zeros):
+         return (rv_val, rv_zeros)
+      if (self.acc_count):
+         need = self.factor - self.acc_count
+         if (zeros < need):
+            self.acc_count += zeros
+            return (rv_val, rv_zeros)
+         zeros -= need
+         self.slice_add(self.acc)
+         rv_val = self.acc
+         self.acc = 0
+         self.acc_count = 0
+      
+      (full, self.acc_count) = divmod(zeros, self.factor)
+      self.slice_add_repeat(0, full)
+      rv_zeros = full
+      return (rv_val, rv_zeros)
+
+
+class BandwidthClock:
+   """Client-wide cycle clock for bandwidth loggers
+   
+   Instead of each logger running its own timer, this runs one timer and rolls
+   over only those loggers which have seen any traffic (or otherwise asked to
+   be called) in the cycle just finished. Idle loggers catch up on the cycles
+   they missed lazily, once they're next used or read from.
+   
+   Event multiplexers:
+   em_cycle:
+      triggers: After all active loggers have been rolled over, once per cycle
+   """
+   def __init__(self, event_dispatcher, cycle_length):
+      self.event_dispatcher = event_dispatcher
+      self.cycle_length = cycle_length
+      self.cycle_count = 0
+      self.loggers_active = []
+      self.em_cycle = EventMultiplexer(self)
+      self.timer = event_dispatcher.set_timer(cycle_length, self._cycle_process,
+         parent=self, persist=True, align=True)
+   
+   def _cycle_process(self):
+      """Finish current cycle"""
+      self.cycle_count += 1
+      loggers = self.loggers_active
+      self.loggers_active = []
+      for bl in loggers:
+         bl._cycle_roll()
+      self.em_cycle()
+   
+   def close(self):
+      if (self.timer):
+         self.timer.cancel()
+         self.timer = None
+      self.loggers_active = []
+      self.em_cycle.close()
+   
+   def __repr__(self):
+      return '<{0} cycle_length: {1} cycle: {2} id: {3}>'.format(
+         self.__class__.__name__, self.cycle_length, self.cycle_count, id(self))
 
 
 class BandwidthLoggerBase(RingBuffer):
@@ -120,13 +288,36 @@ class BandwidthLoggerBase(RingBuffer):
       
    Event multiplexers:
    em_cycle:
-      triggers: At beginning of each new cycle (slice)
+      triggers: At beginning of each new cycle (slice); when using a
+      BandwidthClock, only for cycles in which the logger was active
    em_close:
       triggers: At instance clean_up
+   
+   Besides the per-cycle history, sums over longer periods are kept in
+   lower-resolution tiers, as specified by history_tiers.
+   
+   If a BandwidthClock is passed, the logger is driven by it; otherwise, it
+   runs its own timer. Subclasses driven by a clock have to call
+   _activate() whenever they need to be rolled over at the end of the
+   current cycle.
    """
    bandwidth_loggers = set()
-   def __init__(self_bl, event_dispatcher, cycle_length, *args, **kwargs):
+   # (resolution in seconds, history length) of additional history tiers;
+   # by default one day of minutes and 30 days of hours.
+   history_tiers = ((60, 1440), (3600, 720))
+   def __init__(self_bl, event_dispatcher, cycle_length, *args, clock=None,
+         **kwargs):
       RingBuffer.__init__(self_bl, *args, **kwargs)
+      if not (clock is None):
+         cycle_length = clock.cycle_length
+      self_bl.tiers = []
+      factor_prev = 1
+      for (resolution, length) in self_bl.history_tiers:
+         factor = int(round(resolution/cycle_length))
+         if ((factor <= factor_prev) or (factor % factor_prev)):
+            continue
+         self_bl.tiers.append(RingBufferTier(factor//factor_prev, length))
+         factor_prev = factor
       
       # FIXME: we really don't need to mess with runtime-generated classes
       # to get the functionality we need here ... clean this up someday.
@@ -144,13 +335,87 @@ class BandwidthLoggerBase(RingBuffer):
       self_bl.request_cls = PriorityBandwidthLimiter_BandwidthRequest
       self_bl.event_dispatcher = event_dispatcher
       self_bl.cycle_length = cycle_length
+      self_bl.clock = clock
+      # Are we going to be rolled over at the end of this cycle? Always true
+      # if we don't have a clock.
+      self_bl.clock_active = (clock is None)
+      # Last clock cycle we're caught up with
+      if (clock is None):
+         self_bl.cycle_last = None
+      else:
+         self_bl.cycle_last = clock.cycle_count
       self_bl.cycle_begin() # test whether this was overidden correctly
-      self_bl.cycle_timer = self_bl.event_dispatcher.set_timer(cycle_length,
-         self_bl.cycle_begin, parent=self_bl, persist=True, align=True)
+      if (clock is None):
+         self_bl.cycle_timer = self_bl.event_dispatcher.set_timer(cycle_length,
+            self_bl.cycle_begin, parent=self_bl, persist=True, align=True)
+      else:
+         self_bl.cycle_timer = None
       self_bl.bandwidth_loggers.add(self_bl) # why are we doing this, again?
+   
+   def _activate(self):
+      """Make sure our clock rolls us over at the end of the current cycle"""
+      if (self.clock_active):
+         return
+      self._cycles_catch_up()
+      self.clock_active = True
+      self.clock.loggers_active.append(self)
+   
+   def _cycles_catch_up(self):
+      """Add empty slices for clock cycles we have been idle in"""
+      if (self.clock is None):
+         return
+      missed = self.clock.cycle_count - self.cycle_last
+      if (missed <= 0):
+         return
+      self.cycle_last = self.clock.cycle_count
+      RingBuffer.slice_add_repeat(self, 0, missed)
+      val = None
+      zeros = missed
+      for tier in self.tiers:
+         (val, zeros) = tier.values_count(val, zeros)
+         if ((val is None) and (not zeros)):
+            break
+   
+   def _cycle_roll(self):
+      """Finish current cycle; called by our clock"""
+      # We've been caught up when activated during the cycle just finished.
+      self.clock_active = False
+      self.cycle_last = self.clock.cycle_count
+      self.cycle_begin()
+   
+   def __getitem__(self, key):
+      self._cycles_catch_up()
+      return RingBuffer.__getitem__(self, key)
+   
+   def __iter__(self):
+      self._cycles_catch_up()
+      return RingBuffer.__iter__(self)
 
+   def slice_add(self, val):
+      """Add value for finished cycle, and roll it up into our tiers"""
+      RingBuffer.slice_add(self, val)
+      for tier in self.tiers:
+         tier.value_count(val)
+         if (tier.acc_count):
+            break
+         # Tier finished a slice; pass it on to the next one.
+         val = tier[-1]
+   
+   def history_get(self, resolution=None):
+      """Return (slice length in seconds, RingBuffer) of the history tier with
+         the lowest resolution not finer than the specified one, in seconds"""
+      self._cycles_catch_up()
+      rv = (self.cycle_length, self)
+      if (resolution is None):
+         return rv
+      for tier in self.tiers:
+         slice_length = rv[0]*tier.factor
+         if (slice_length > resolution):
+            break
+         rv = (slice_length, tier)
+      return rv
+   
    def bandwidth_request(self, *args, **kwargs):
-      EventMultiplexer
       raise NotImplementedError("Request processing should be done by subclasses")
    
    def cycle_begin(self):
@@ -164,6 +429,11 @@ class BandwidthLoggerBase(RingBuffer):
       if (self.cycle_timer):
          self.cycle_timer.cancel()
          self.cycle_timer = None
+      if (self.clock_active and not (self.clock is None)):
+         if (self in self.clock.loggers_active):
+            self.clock.loggers_active.remove(self)
+      self.clock = None
+      self.clock_active = True
       if (self in self.bandwidth_loggers):
          self.bandwidth_loggers.remove(self)
       
@@ -182,16 +452,29 @@ class NullBandwidthLimiter(BandwidthLoggerBase):
       
    def bandwidth_request(self, bytes, bytes_min, callback, *args, **kwargs):
       """Always grants <bytes>, immediately."""
+      if not (self.clock_active):
+         self._activate()
       self.bytes_used += bytes
       return bytes
    
    def bandwidth_take(self, bytes, *args, **kwargs):
       """Notes that application has used <bytes> bytes of bandwidth without request"""
+      if not (self.clock_active):
+         self._activate()
       self.bytes_used += bytes
    
+   def bandwidth_refund(self, bytes, *args, **kwargs):
+      """Return <bytes> of previously granted bandwidth that weren't used"""
+      if not (self.clock_active):
+         self._activate()
+      self.bytes_used -= bytes
+   
+   def bandwidth_exhausted(self, *args, **kwargs):
+      """Return whether further traffic should wait for more bandwidth"""
+      return False
+   
    def cycle_begin(self):
-      self.history_index = (self.history_index + 1) % self.history_length
-      self.history[self.history_index] = self.bytes_used
+      self.slice_add(self.bytes_used)
       self.bytes_used = 0
       BandwidthLoggerBase.cycle_begin(self)
 
@@ -216,51 +499,65 @@ class PriorityBandwidthLimiter(BandwidthLoggerBase):
       super(PriorityBandwidthLimiter, self).__init__(event_dispatcher,
          cycle_length=cycle_length, *args, **kwargs)
    
-   def bandwidth_request(self, bytes, bytes_min, callback, parent=None, priority=0):
+   def bandwidth_request(self, bytes, bytes_min, callback, parent=None,
+         priority=0, bucket=None):
       """Request <bytes> of traffic in chunks >= <bytes_min>, except for the
          last one. If immediately granted, simply returns the amount.
          Otherwise, if bool(callback) is True, a self.request_cls will be
-         instantiated with the passed parameters, registered and returned."""
+         instantiated with the passed parameters, registered and returned.
+         <bucket> is ignored; it's only supported for interface
+         compatibility with TokenBucketBandwidthLimiter."""
       assert (bytes >= bytes_min > 0)
       if (bytes_min > self.byte_slice):
          raise BandwidthError("bytes_min {0} is greater than byte_slice {1}; request would never be granted".format(bytes_min, self.byte_slice))
          
+      if not (self.clock_active):
+         self._activate()
       if (bytes_min <= self.byte_reserve):
-         grant = min(self.byte_reserve, bytes_min)
-         self.byte_reserve -= bytes_min
+         grant = min(self.byte_reserve, bytes)
+         self.byte_reserve -= grant
          return grant
 
       if (callable(callback)):
-         rv = self.request_cls(bytes=bytes, bytes_min=bytes_min, parent=parent, priority=priority)
+         rv = self.request_cls(bytes=bytes, bytes_min=bytes_min,
+            callback=callback, parent=self, priority=priority)
          self.requests_active.append(rv)
          return rv
    
-   def bandwidth_take(self, bytes, parent=None):
+   def bandwidth_take(self, bytes, parent=None, bucket=None):
       """Notes that application has used <bytes> bytes of bandwidth without request"""
-      self.bytes_reserve -= bytes
+      if not (self.clock_active):
+         self._activate()
+      self.byte_reserve -= bytes
+   
+   def bandwidth_refund(self, bytes, *args, **kwargs):
+      """Return <bytes> of previously granted bandwidth that weren't used"""
+      if not (self.clock_active):
+         self._activate()
+      self.byte_reserve += bytes
+   
+   def bandwidth_exhausted(self, *args, **kwargs):
+      """Return whether further traffic should wait for the next cycle"""
+      return (self.byte_reserve <= 0)
    
    def cycle_begin(self):
       """Begin a new cycle; deals out remaining bandwidth and resets byte_reserve"""
-      self.requests_active.sort()
       # We can't iterate over the list directly, since it may be modified by
       # bandwidth_request() calls from the callbacks; however, we also have to
       # remember such modifications for the next cycle.
-      requests_active_tuple = tuple(self.requests_active)
+      requests_active_tuple = tuple(sorted(self.requests_active,
+         key=BandwidthRequest.sort_key))
       del(self.requests_active[:])
 
-      byte_reserve = self.byte_reserve
-
-      for request in tuple(self.requests_active):
-         if (byte_reserve <= 0):
+      for request in requests_active_tuple:
+         if ((self.byte_reserve <= 0) or (request.bytes_min > self.byte_reserve)):
             # We won't reduce it below zero directly, but calls to
             # bandwidth_take() from the callbacks might
-            break
-         
-         if (request.bytes_min > byte_reserve):
+            self.requests_active.append(request)
             continue
-         if (request.bytes > byte_reserve):
-            grant = byte_reserve
-            byte_reserve = 0
+         
+         if (request.bytes > self.byte_reserve):
+            grant = self.byte_reserve
             request_done = False
             request.bytes -= grant
             if (request.bytes < request.bytes_min):
@@ -268,14 +565,247 @@ class PriorityBandwidthLimiter(BandwidthLoggerBase):
             self.requests_active.append(request)
          else:
             grant = request.bytes
-            byte_reseve -= grant
             request_done = True
+         self.byte_reserve -= grant
          
          request.callback_call(bytes_granted=grant, request_done=request_done)
       
-      self.history_index = (self.history_index + 1) % self.history_length
-      self.history[self.history_index] = (self.byte_slice - byte_reserve)
+      self.slice_add(self.byte_slice - self.byte_reserve)
       
       self.byte_reserve = self.byte_slice
+      if (self.requests_active):
+         self._activate()
+      
+      BandwidthLoggerBase.cycle_begin(self)
+
+
+class TokenBucket:
+   """Token bucket for limiting a byte rate, optionally nested in a parent
+      bucket whose limits also apply
+   
+   Tokens are refilled lazily, based on time elapsed since the last access.
+   A rate of None means no limit at this level."""
+   # Buckets never hold less than this, so single blocks can always be granted:
+   # the largest block we upload (64KiB) plus its PIECE message header
+   burst_min = 65536 + 13
+   # Default burst size, in seconds of traffic at the configured rate
+   burst_time = 0.5
+   def __init__(self, rate=None, burst=None, parent=None):
+      self.parent = parent
+      self.rate = None
+      self.burst = None
+      self.tokens = 0
+      self.ts_refill = time.time()
+      self.rate_set(rate, burst)
+   
+   def rate_set(self, rate, burst=None):
+      """Change rate and burst size of this bucket"""
+      if (rate is None):
+         self.rate = None
+         self.burst = None
+         return
+      if (burst is None):
+         burst = int(rate*self.burst_time)
+      self.rate = rate
+      self.burst = max(burst, self.burst_min)
+      self.tokens = min(self.tokens, self.burst)
+   
+   def _refill(self, now):
+      if (self.rate is None):
+         return
+      self.tokens = min(self.burst,
+         self.tokens + (now - self.ts_refill)*self.rate)
+      self.ts_refill = now
+   
+   def available_get(self, now=None):
+      """Return number of bytes available in this bucket and its parents"""
+      if (now is None):
+         now = time.time()
+      rv = None
+      b = self
+      while not (b is None):
+         b._refill(now)
+         if not (b.rate is None):
+            if (rv is None):
+               rv = b.tokens
+            else:
+               rv = min(rv, b.tokens)
+         b = b.parent
+      return rv
+   
+   def delay_get(self, bytes, now=None):
+      """Return time in seconds until <bytes> will be available"""
+      if (now is None):
+         now = time.time()
+      rv = 0
+      b = self
+      while not (b is None):
+         b._refill(now)
+         if (not (b.rate is None)) and (b.tokens < bytes):
+            rv = max(rv, (bytes - b.tokens)/b.rate)
+         b = b.parent
+      return rv
+   
+   def consume(self, bytes):
+      """Take <bytes> from this bucket and its parents; tokens can become
+         negative through this"""
+      b = self
+      while not (b is None):
+         if not (b.rate is None):
+            b.tokens -= bytes
+         b = b.parent
+
+   def __repr__(self):
+      return '<{0} rate: {1} burst: {2} tokens: {3} id: {4}>'.format(
+         self.__class__.__name__, self.rate, self.burst, self.tokens, id(self))
+
+
+class TokenBucketBandwidthLimiter(BandwidthLoggerBase):
+   """Bandwidth limiter based on a (possibly nested) token bucket
+   
+   Requests that can't be granted immediately are queued, and served in order
+   of priority as soon as enough tokens have accumulated; unlike with
+   PriorityBandwidthLimiter, this doesn't have to wait for the end of a
+   cycle. Requests may specify a child TokenBucket of self.bucket, e.g. for
+   per-connection limits."""
+   # Minimum delay in seconds between attempts to serve queued requests
+   refill_interval_min = 0.02
+   def __init__(self, event_dispatcher, cycle_length, rate=None, burst=None,
+         parent=None, *args, **kwargs):
+      """Initialize bandwidth limiter; parent, if specified, is a TokenBucket
+         the limits of which apply to this limiter, too."""
+      self.bucket = TokenBucket(rate, burst, parent)
+      self.requests_active = []
+      self.bytes_used = 0
+      self.timer_requests = None
+      super(TokenBucketBandwidthLimiter, self).__init__(event_dispatcher,
+         cycle_length=cycle_length, *args, **kwargs)
+   
+   def rate_set(self, rate, burst=None):
+      """Change limits of this limiter"""
+      self.bucket.rate_set(rate, burst)
+      self._requests_process()
+   
+   def child_bucket_build(self, rate=None, burst=None):
+      """Build TokenBucket nested in ours"""
+      return TokenBucket(rate, burst, self.bucket)
+   
+   def bandwidth_request(self, bytes, bytes_min, callback, parent=None,
+         priority=0, bucket=None):
+      """Request <bytes> of traffic, at least <bytes_min> of which have to be
+         granted at once. If at least bytes_min bytes are available
+         immediately, return the (possibly partial) grant. Otherwise, if
+         callback is callable, register and return a request, which will be
+         granted in full or in part later."""
+      assert (bytes >= bytes_min > 0)
+      if (bucket is None):
+         bucket = self.bucket
+      avail = bucket.available_get()
+      if ((not self.requests_active) and ((avail is None) or (avail >= bytes_min))):
+         if (avail is None):
+            grant = bytes
+         else:
+            grant = min(bytes, int(avail))
+         bucket.consume(grant)
+         if not (self.clock_active):
+            self._activate()
+         self.bytes_used += grant
+         return grant
       
+      if (callable(callback)):
+         rv = self.request_cls(bytes=bytes, bytes_min=bytes_min,
+            callback=callback, parent=self, priority=priority)
+         rv.bucket = bucket
+         self.requests_active.append(rv)
+         self.requests_active.sort(key=BandwidthRequest.sort_key)
+         self._requests_timer_set()
+         return rv
+   
+   def bandwidth_take(self, bytes, parent=None, bucket=None):
+      """Notes that application has used <bytes> bytes of bandwidth without request"""
+      if (bucket is None):
+         bucket = self.bucket
+      bucket.consume(bytes)
+      if not (self.clock_active):
+         self._activate()
+      self.bytes_used += bytes
+   
+   def bandwidth_refund(self, bytes, parent=None, bucket=None):
+      """Return <bytes> of previously granted bandwidth that weren't used"""
+      if (bucket is None):
+         bucket = self.bucket
+      bucket.consume(-bytes)
+      if not (self.clock_active):
+         self._activate()
+      self.bytes_used -= bytes
+   
+   def bandwidth_exhausted(self, bucket=None):
+      """Return whether further traffic should wait for more tokens"""
+      if (bucket is None):
+         bucket = self.bucket
+      avail = bucket.available_get()
+      return ((not (avail is None)) and (avail <= 0))
+   
+   def _requests_timer_set(self):
+      """Make sure we get called when the first queued request can be
+         served"""
+      if (self.timer_requests or (not self.requests_active)):
+         return
+      now = time.time()
+      delay = max(min(req.bucket.delay_get(req.bytes_min, now)
+         for req in self.requests_active), self.refill_interval_min)
+      self.timer_requests = self.event_dispatcher.set_timer(delay,
+         self._requests_process_timer, parent=self)
+   
+   def _requests_process_timer(self):
+      self.timer_requests = None
+      self._requests_process()
+   
+   def _requests_process(self):
+      """Grant queued requests as far as available bandwidth allows"""
+      # Callbacks can queue new requests; those will be served after the ones
+      # we're looking at now.
+      requests = self.requests_active
+      self.requests_active = []
+      now = time.time()
+      for (i, req) in enumerate(requests):
+         if (req.cancelled):
+            continue
+         avail = req.bucket.available_get(now)
+         if ((avail is None) or (avail >= req.bytes_min)):
+            if (avail is None):
+               grant = req.bytes
+            else:
+               grant = min(req.bytes, int(avail))
+            req.bucket.consume(grant)
+            if not (self.clock_active):
+               self._activate()
+            self.bytes_used += grant
+            req.callback_call(bytes_granted=grant, request_done=True)
+         elif (req.bucket is self.bucket):
+            # Nothing with the same or lower priority is going to get through,
+            # either.
+            self.requests_active = [r for r in requests[i:]
+               if not (r.cancelled)] + self.requests_active
+            break
+         else:
+            # Might be limited by child bucket only
+            self.requests_active.append(req)
+      
+      self.requests_active.sort(key=BandwidthRequest.sort_key)
+      if (self.timer_requests):
+         self.timer_requests.cancel()
+         self.timer_requests = None
+      self._requests_timer_set()
+   
+   def cycle_begin(self):
+      self.slice_add(self.bytes_used)
+      self.bytes_used = 0
       BandwidthLoggerBase.cycle_begin(self)
+   
+   def close(self):
+      if (self.timer_requests):
+         self.timer_requests.cancel()
+         self.timer_requests = None
+      self.requests_active = []
+      BandwidthLoggerBase.close(self)
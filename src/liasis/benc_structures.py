@@ -28,6 +28,7 @@ import os
 import os.path
 import fcntl
 import binascii
+import socket
 from collections import Sequence,deque
 from hashlib import sha1
 from io import BytesIO
@@ -107,6 +108,74 @@ def py_from_benc_str(string):
    return py_from_benc_stream(BytesIO(string))
 
 
+def py_from_benc_str_untrusted(string, depth_max=32):
+   """Read and return one entity from a string containing bencoded data
+      received from an untrusted source
+   
+   Unlike py_from_benc_str(), this doesn't recurse, limits nesting of lists
+   and dicts to depth_max levels, and raises ValueError for any kind of
+   malformed data."""
+   data = bytes(string)
+   i = 0
+   # [container, pending dict key] for each list and dict we are inside of
+   stack = []
+   while (True):
+      c = data[i:i+1]
+      if (c == b''):
+         raise ValueError('Bencoded data {0!a} ends prematurely.'.format(data))
+      if (c in (b'l', b'd')):
+         if (len(stack) >= depth_max):
+            raise ValueError('Bencoded data nested deeper than {0} levels.'.format(depth_max))
+         stack.append([([] if (c == b'l') else {}), None])
+         i += 1
+         continue
+      
+      if (c == b'e'):
+         if not (stack):
+            raise ValueError('Unexpected end marker at offset {0}.'.format(i))
+         (value, key) = stack.pop()
+         if not (key is None):
+            raise ValueError('Dict key {0!a} is missing a value.'.format(key))
+         i += 1
+      elif (c == b'i'):
+         j = data.find(b'e', i)
+         if (j < 0):
+            raise ValueError('Unterminated integer at offset {0}.'.format(i))
+         digit_str = data[i+1:j]
+         digits = digit_str[1:] if digit_str.startswith(b'-') else digit_str
+         if not ((digit_str == b'') or (digits.isdigit() and not
+               (digits.startswith(b'0') and (digit_str != b'0')))):
+            raise ValueError('integer digitstring {0!a} is invalid'.format(digit_str))
+         # Empty digit strings are accepted as 0, as by py_from_benc_str().
+         value = int(digit_str or b'0')
+         i = j + 1
+      elif (c.isdigit()):
+         j = data.find(b':', i)
+         if ((j < 0) or not (data[i:j].isdigit())):
+            raise ValueError('Invalid string length at offset {0}.'.format(i))
+         str_len = int(data[i:j])
+         i = j + 1
+         if (i + str_len > len(data)):
+            raise ValueError('String of length {0} at offset {1} exceeds data.'.format(str_len, i))
+         value = data[i:i+str_len]
+         i += str_len
+      else:
+         raise ValueError('Unable to interpret initial chunk byte {0!a}.'.format(c))
+      
+      if not (stack):
+         return value
+      top = stack[-1]
+      if (isinstance(top[0], list)):
+         top[0].append(value)
+      elif (top[1] is None):
+         if not (isinstance(value, bytes)):
+            raise ValueError('Got dict key {0!a}; expected string.'.format(value))
+         top[1] = value
+      else:
+         top[0][top[1]] = value
+         top[1] = None
+
+
 def benc_str_from_py(obj):
    """Encode a python dict/list/str/int structure in a bencoded string"""
    if (isinstance(obj, (bytes, bytearray))):
@@ -133,6 +202,26 @@ class BTPeer:
       (iplong, port) = struct.unpack('>IH', string)
       return cls(iplong, port, None)
    
+   @classmethod
+   def build_from_packed(cls, string):
+      """Build instance from 6 (IPv4) or 18 (IPv6) byte compact form"""
+      if (len(string) == 6):
+         return cls.build_from_str(string)
+      if (len(string) != 18):
+         raise ValueError('Invalid compact peer {0!a}.'.format(string))
+      ip = socket.inet_ntop(socket.AF_INET6, bytes(string[:16]))
+      return cls(ip.encode('ascii'), struct.unpack('>H', string[16:])[0],
+         None)
+   
+   def packed_get(self):
+      """Return 6 (IPv4) or 18 (IPv6) byte compact form of address"""
+      ip_str = str(self.ip)
+      try:
+         ip_packed = socket.inet_pton(socket.AF_INET, ip_str)
+      except (socket.error, ValueError):
+         ip_packed = socket.inet_pton(socket.AF_INET6, ip_str)
+      return ip_packed + struct.pack('>H', self.port)
+   
    def state_get(self):
       """Summarize internal state using nested dicts, lists, ints and strings"""
       state = {
@@ -183,6 +272,12 @@ class BTPeer:
    def address_get(self):
       return (self.ip, self.port)
    
+   def family_get(self):
+      """Return address family to connect to peer with"""
+      if (len(self.packed_get()) == 18):
+         return socket.AF_INET6
+      return socket.AF_INET
+   
    def __repr__(self):
       return '{0}{1!a}'.format(self.__class__.__name__, (self.ip, self.port, self.peer_id))
    
@@ -190,6 +285,103 @@ class BTPeer:
       return '{0}{1!a}'.format(self.__class__.__name__, (str(self.ip), self.port, self.peer_id))
 
 
+class BTPeerTable:
+   """Deduplicated set of peer addresses kept in compact form
+   
+   Entries are the entry_length (6 for IPv4, 18 for IPv6) byte strings used
+   for compact peer lists in tracker responses. Each entry is stored once, in
+   a list of slots that the index dict refers to by position, so large peer
+   lists can be merged, tested and sampled without building a BTPeer for
+   every peer. Iterating over instances yields BTPeers."""
+   def __init__(self, entry_length=6, data=b''):
+      if not (entry_length in (6, 18)):
+         raise ValueError('Invalid entry length {0!a}.'.format(entry_length))
+      self.entry_length = entry_length
+      # slot -> entry
+      self.entries = []
+      # entry -> slot
+      self.index = {}
+      self.data_add(data)
+   
+   @staticmethod
+   def entry_valid(entry):
+      """Return whether entry has a non-zero address and port"""
+      return bool((entry[-2:] != b'\x00\x00') and entry[:-2].strip(b'\x00'))
+   
+   def data_add(self, data):
+      """Add all valid entries from compact peer list data not already in
+         table; returns number of entries added"""
+      el = self.entry_length
+      if ((len(data) % el) != 0):
+         raise ValueError('Compact peer data length {0} is not a multiple of {1}.'.format(len(data), el))
+      data = bytes(data)
+      rv = 0
+      for i in range(0, len(data), el):
+         if (self.entry_add(data[i:i+el])):
+            rv += 1
+      return rv
+   
+   def update(self, other):
+      """Add all entries from BTPeerTable other not already in table"""
+      if (other.entry_length != self.entry_length):
+         raise ValueError('Entry length mismatch: {0} != {1}.'.format(other.entry_length, self.entry_length))
+      for entry in other.index:
+         self.entry_add(entry)
+   
+   def entry_add(self, entry):
+      """Add entry if it is valid and not in table; returns whether it was
+         added"""
+      if ((entry in self.index) or not (self.entry_valid(entry))):
+         return False
+      entry = bytes(entry)
+      self.index[entry] = len(self.entries)
+      self.entries.append(entry)
+      return True
+   
+   def entry_remove(self, entry):
+      """Remove entry if it is in table; returns whether it was"""
+      try:
+         slot = self.index.pop(entry)
+      except KeyError:
+         return False
+      entry_last = self.entries.pop()
+      if (slot != len(self.entries)):
+         # Move last entry into the hole.
+         self.entries[slot] = entry_last
+         self.index[entry_last] = slot
+      return True
+   
+   def entries_sample(self, count):
+      """Return up to count randomly picked entries"""
+      return random.sample(self.entries, min(count, len(self.entries)))
+   
+   def entries_iter(self):
+      return iter(self.entries)
+   
+   def data_get(self):
+      """Return entries as compact peer list data"""
+      return b''.join(self.entries)
+   
+   def __contains__(self, entry):
+      return (entry in self.index)
+   
+   def __len__(self):
+      return len(self.index)
+   
+   def __iter__(self):
+      return (BTPeer.build_from_packed(e) for e in tuple(self.entries_iter()))
+   
+   def __getstate__(self):
+      return {'entry_length': self.entry_length, 'data': self.data_get()}
+   
+   def __setstate__(self, state):
+      self.__init__(state['entry_length'], state['data'])
+   
+   def __repr__(self):
+      return '<{0} entry_length: {1} peers: {2} id: {3}>'.format(
+         self.__class__.__name__, self.entry_length, len(self.index), id(self))
+
+
 class BTMetaInfo:
    """Bt Metainfo file structure"""
    fields = ('announce_urls', 'piece_length', 'piece_hashes', 'files',
@@ -198,7 +390,7 @@ class BTMetaInfo:
    hash_helper = sha1
    
    btmeta_known_fields_global = set((b'announce-list', b'announce', b'creation date', b'created by', b'comment', b'info'))
-   btmeta_known_fields_info = set((b'piece length', b'pieces', b'length', b'name', b'path', b'md5sum', b'files'))
+   btmeta_known_fields_info = set((b'piece length', b'pieces', b'length', b'name', b'path', b'md5sum', b'files', b'private'))
 
    hr_line_fmt_str = '{0:20} {1}'
    hr_line_fmt_repr = '{0:20} {1!a}'
@@ -224,6 +416,11 @@ class BTMetaInfo:
       """Summarize internal state using nested dicts, lists, ints and strings"""
       return self.dict_init
    
+   def private_get(self):
+      """Return whether torrent is marked private (BEP 27); peers for those
+         may only be obtained from its trackers"""
+      return (self.dict_init[b'info'].get(b'private') == 1)
+   
    @classmethod
    def build_from_dict(cls, dict, *args, **kwargs):
       """Create instance based on dict from benc data"""
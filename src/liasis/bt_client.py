@@ -17,7 +17,6 @@
 
 # Central BT client classes.
 
-import copy
 import datetime
 import logging
 import math
@@ -36,20 +35,31 @@ from .crypto import ARC4
 
 # gonium
 from gonium.fdm import AsyncDataStream, AsyncSockServer
-from gonium.hacks.asynchttpc import build_async_opener
-from gonium.event_multiplexing import DSEventAggregator, EventMultiplexer
+from gonium.event_multiplexing import EventMultiplexer
 
 # local imports
 from . import benc_structures
 from .bt_exceptions import BTClientError, BTCStateError, BTFileError, \
    HandlerNotReadyError
 from .bt_piecemasks import BitMask, BlockMask
-from .benc_structures import BTPeer
-from .tracker_proto_structures import tracker_request_build
-from .bandwidth_management import NullBandwidthLimiter, PriorityBandwidthLimiter
+from .benc_structures import BTPeer, BTPeerTable, py_from_benc_str_untrusted, \
+   benc_str_from_py
+from .peer_store import BTPeerStore
+from .tracker_proto_structures import tracker_request_build, UDPTrackerMux, \
+   tracker_scrape_request_build, scrape_request_info_hashes_max
+from .bandwidth_management import NullBandwidthLimiter, \
+   PriorityBandwidthLimiter, TokenBucketBandwidthLimiter, TokenBucket, \
+   BandwidthRequest, BandwidthClock
+from .stats_structures import EWMARate, LatencyHistogram
+from .resolver import AsyncResolver
+from .http_client import HTTPClientPool
+from .announce_scheduling import AnnounceScheduler
+from .connection_pacing import ConnectionPacer
 from .bt_client_mirror import BTClientConnectionMirror, BTorrentHandlerMirror, BTClientMirror
 from .bt_semipermanent_stats import BTStatsTracker
 from .diskio import btdiskio_build
+from .bt_resume import BTResumeData, resume_data_load
+from .worker_pool import WorkerPool, WorkerPoolRequest
 
 MAINTENANCE_INTERVAL = 100
 
@@ -103,6 +113,7 @@ def bmodpow(base, exp, mod):
 
 class ReservedMask:
    EXT_AZUREUS_EM = 2**63
+   EXT_LTEP = 2**20
    EXT_FAST = 2**3
    EXT_DHT = 2**1
    def __init__(self, mask=0):
@@ -293,6 +304,25 @@ class BTClientConnection(AsyncDataStream, MSEBase):
    MSG_ID_ALLOWED_FAST = 17
    MSG_ID_EXTENDED = 20
    
+   # Extension Protocol; see <http://www.bittorrent.org/beps/bep_0010.html>
+   LTEP_ID_HANDSHAKE = 0
+   # Extension messages we understand, with the ids we ask peers to use for
+   # them
+   LTEP_ID_UT_PEX = 1
+   ltep_extensions = {b'ut_pex': LTEP_ID_UT_PEX}
+   ltep_version = b'Liasis'
+   
+   # Peer exchange; see <http://www.bittorrent.org/beps/bep_0011.html>
+   # Minimum seconds between our PEX messages to a peer
+   pex_interval = 60
+   # PEX messages from a peer following the previous one more quickly than
+   # this are ignored
+   pex_interval_in_min = 30
+   # Maximum number of peers we add or drop per PEX message, and accept from
+   # one
+   pex_peers_max = 50
+   pex_in_peers_max = 200
+   
    # Limit the ability of hostile peers to DOS us with ridiculous buffer
    # sizes.
    # Raise this if you need it; the default is enough enough bitfields for
@@ -322,6 +352,11 @@ class BTClientConnection(AsyncDataStream, MSEBase):
    blocks_pending_out_limit = 128
    # Minimum number of blocks to wait to be queued before starting sending
    blocks_pending_out_expect = 1
+   # Output buffering limits, in bytes of queued PIECE messages: More blocks
+   # are read from disk once our queued output drops to or below the low
+   # watermark, and we don't read more than would fill it up to the high one.
+   outbuf_watermark_low = 32768
+   outbuf_watermark_high = 262144
    
    def __init__(self, *args, **kwargs):
       """ Initialize BTClientConnection instance.
@@ -334,7 +369,8 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       self.btpeer = None
       
       # generic connection state
-      self.reserved = ReservedMask(ReservedMask.EXT_FAST)
+      self.reserved = ReservedMask(ReservedMask.EXT_FAST |
+         ReservedMask.EXT_LTEP)
       self.s_interest = False
       self.s_choked = True
       self.s_snubbed = False
@@ -373,10 +409,56 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       self.ts_request_last_out = 0
       self.bandwidth_logger_in = None
       self.bandwidth_manager_out = None
+      # per-connection upload limit, if any; nested in the BTH's bucket
+      self.bucket_out = None
+      # download limiting: pending request for inbound bandwidth while we
+      # aren't reading from our socket
+      self.bandwidth_request_in = None
+      self.reading_paused = False
       self.bt_buffer_output = None
+      # bytes in our output buffer, and lengths of the buffers in it
+      self.outbuf_bytes = 0
+      self.outbuf_lengths = deque()
+      # bytes of PIECE messages currently being read from disk
+      self.outbuf_bytes_reading = 0
       self.peer_req_count = 0 # total count of blocks requested by peer
+      # rolling-window transfer rates, updated once per choke round
+      self.rate_in = 0
+      self.rate_out = 0
+      self.choke_bytes_in_last = 0
+      self.choke_bytes_out_last = 0
+      self.choke_traffic_history = deque()
+      # EWMA transfer rate estimates, updated with each block transferred
+      self.rate_ewma_in = EWMARate()
+      self.rate_ewma_out = EWMARate()
+      # REQUEST-to-PIECE latencies of blocks requested by us, and send times
+      # of our pending requests
+      self.latency_request = LatencyHistogram()
+      self.blocks_pending_ts = {}
+      # whether we opened this connection, when we finished processing the
+      # handshake of the peer, and whether we gave up on it because of an
+      # error
+      self.outgoing = False
+      self.ts_handshake = None
+      self.failed = False
+      # super-seeding: whether we hid our pieces in the bitfield sent to
+      # peer, and pieces revealed to peer that we haven't seen at any other
+      # peer yet
+      self.super_seed_masked = False
+      self.super_seed_pieces = set()
       # extensions that are active on this connection
       self.ext_Fast = False
+      self.ext_LTEP = False
+      # Extension Protocol: extension message ids we offered to and got
+      # from peer, by name, and the port peer says it listens on
+      self.ltep_ids_self = {}
+      self.ltep_ids_peer = {}
+      self.ltep_port = None
+      # Peer exchange: addresses we told peer about, and times of the last
+      # PEX message to and from it
+      self.pex_peers_sent = None
+      self.ts_pex_out = 0
+      self.ts_pex_in = None
    
       # parents
       self.bth = None # BTorrentHandler responsible for this connection
@@ -399,6 +481,7 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       """Connect to peer"""
       self = cls.build_sock_connect(ed, address, *args, **kwargs)
       self.btpeer = BTPeer(address[0], address[1], None)
+      self.outgoing = True
       return self
    
    def _process_new_pieces(self):
@@ -421,6 +504,7 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       self.piecemask = BitMask(bitlen=piece_count)
       self.bandwidth_logger_in = bth.bandwidth_logger_in
       self.bandwidth_manager_out = bth.bandwidth_manager_out
+      self.bucket_out_update()
       self.instance_init_done = True
       self._process_new_pieces()
 
@@ -447,6 +531,8 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          self.pieces_wanted_update()
       if (self.s_interest != bool(self.pieces_wanted)):
          self.interest_send(bool(self.pieces_wanted))
+      if (self.pex_active() and (now >= self.ts_pex_out + self.pex_interval)):
+         self.pex_send()
       if (not (self.s_choked or self.s_snubbed) and 
           (self.blocks_pending != set()) and
           (self.time_block_in_waiting + self.block_timeout < time.time())):
@@ -476,6 +562,7 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             self.bth.blockmask_req.block_have_set(piece_index, block_index, False)
          self.bth.connection_remove(self)
          self.blocks_pending = set()
+         self.blocks_pending_ts = {}
          self.pieces_wanted = deque()
          
          self.bth = None
@@ -485,6 +572,9 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       if (self.bandwidth_request):
          self.bandwidth_request.cancel()
          self.bandwidth_request = None
+      if (self.bandwidth_request_in):
+         self.bandwidth_request_in.cancel()
+         self.bandwidth_request_in = None
       if (self.flush_done_callback):
          self.flush_done_callback()
          self.flush_done_callback = None
@@ -514,9 +604,34 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             self.blocks_pending_out.clear()
       self.uploading = False
    
+   def choke_rates_update(self, interval, rounds):
+      """Update rolling-window transfer rates from traffic since last call;
+         called once per choke round"""
+      hist = self.choke_traffic_history
+      hist.append((self.content_bytes_in - self.choke_bytes_in_last,
+         self.content_bytes_out - self.choke_bytes_out_last))
+      self.choke_bytes_in_last = self.content_bytes_in
+      self.choke_bytes_out_last = self.content_bytes_out
+      while (len(hist) > rounds):
+         hist.popleft()
+      
+      span = interval*len(hist)
+      self.rate_in = int(sum(e[0] for e in hist)/span)
+      self.rate_out = int(sum(e[1] for e in hist)/span)
+   
+   def bucket_out_update(self):
+      """Set up per-connection upload limit according to our BTH's settings"""
+      rate = self.bth.peer_upload_rate_max
+      if (not isinstance(self.bandwidth_manager_out, TokenBucketBandwidthLimiter)):
+         self.bucket_out = None
+      elif (self.bucket_out is None):
+         if not (rate is None):
+            self.bucket_out = self.bandwidth_manager_out.child_bucket_build(rate)
+      else:
+         self.bucket_out.rate_set(rate)
+   
    def read_blocks(self, force=False):
       """Request blocks from mass storage"""
-      # XXX: Think about tuning this
       bpo = self.blocks_pending_out
       if (len(bpo) < self.blocks_pending_out_expect):
          if (not force):
@@ -524,48 +639,121 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          self.log2(30, '{0} force-reading blocks ({1} pending blocks).'.format(
             self, len(bpo)))
       
-      tbl = 0
-      for bufel in self._outbuf:
-         if (bufel is None):
-            continue
-         tbl += len(bufel)
+      queued = self.outbuf_bytes + self.outbuf_bytes_reading
+      if (queued > self.outbuf_watermark_low):
+         return
+      if (self.bandwidth_request):
+         # We'll be called back once we get some.
+         return
       
-      if (tbl >= 34406):
+      len_max = self.outbuf_watermark_high - queued
+      len_want = 0
+      for (pi, bs, bl) in bpo:
+         if (len_want and (len_want + bl + 13 > len_max)):
+            break
+         len_want += bl + 13
+      if (not len_want):
          return
       
-      total_len = sum(e[2]+13 for e in bpo)
+      grant = self.bandwidth_manager_out.bandwidth_request(len_want,
+         bpo[0][2] + 13, self._bandwidth_grant_process, bucket=self.bucket_out)
+      if (isinstance(grant, BandwidthRequest)):
+         self.bandwidth_request = grant
+         return
+      self._blocks_read(grant)
+   
+   def _bandwidth_grant_process(self, bandwidth_request, bytes_granted,
+         request_done):
+      """Process grant of upload bandwidth requested by read_blocks()"""
+      self.bandwidth_request = None
+      if not (self and self.uploading and self.blocks_pending_out):
+         self.bandwidth_manager_out.bandwidth_refund(bytes_granted,
+            bucket=self.bucket_out)
+         return
+      self._blocks_read(bytes_granted)
+   
+   def _blocks_read(self, len_max):
+      """Read as many pending blocks from mass storage as fit into len_max
+         bytes of granted upload bandwidth"""
+      bpo = self.blocks_pending_out
+      blocks = []
+      total_len = 0
+      while (bpo and ((not blocks) or (total_len + bpo[0][2] + 13 <= len_max))):
+         block = bpo.popleft()
+         blocks.append(block)
+         total_len += block[2] + 13
+      
+      # Pending blocks may have changed since the grant was requested.
+      if (total_len < len_max):
+         self.bandwidth_manager_out.bandwidth_refund(len_max - total_len,
+            bucket=self.bucket_out)
+      elif (total_len > len_max):
+         self.bandwidth_manager_out.bandwidth_take(total_len - len_max,
+            bucket=self.bucket_out)
       if (not total_len):
          return
       
       buf = bytearray(total_len)
       
       payload_len = 0
-      def bpo_iter(bpo):
+      def blocks_iter(blocks):
          nonlocal payload_len
          i = 0
          pl = self.bth.piece_length_get()
-         while (bpo):
-            (pi, bs, bl) = bpo.popleft()
+         for (pi, bs, bl) in blocks:
             buf[i:13+i] = struct.pack('>LBLL', (bl+9), self.MSG_ID_PIECE, pi, bs)
             msg_len = 13 + bl
             payload_len += bl
             yield (pl*pi + bs, memoryview(buf)[i+13:i+msg_len])
             i += msg_len
-         raise StopIteration()
       
-      req = self.bth.bt_disk_io.async_readinto(bpo_iter(bpo),
+      req = self.bth.bt_disk_io.async_readinto(blocks_iter(blocks),
          self._send_block)
-      bpo.clear()
+      self.outbuf_bytes_reading += total_len
       req.buf = buf
       req.payload_len = payload_len
 
+   @staticmethod
+   def _outbuf_len(bufel):
+      if (bufel is None):
+         return 0
+      return len(bufel)
+
+   def send_bytes(self, buffers, *args, **kwargs):
+      buffers = tuple(buffers)
+      for bufel in buffers:
+         l = self._outbuf_len(bufel)
+         self.outbuf_lengths.append(l)
+         self.outbuf_bytes += l
+      AsyncDataStream.send_bytes(self, buffers, *args, **kwargs)
+
+   def _outbuf_bytes_update(self):
+      """Subtract data written out since the last call from outbuf_bytes"""
+      outbuf = self._outbuf
+      lengths = self.outbuf_lengths
+      if (outbuf is None):
+         lengths.clear()
+         self.outbuf_bytes = 0
+         return
+      # Fully written buffers have been dropped from the front of outbuf;
+      # the first remaining one may have been written in part.
+      while (len(lengths) > len(outbuf)):
+         self.outbuf_bytes -= lengths.popleft()
+      if (lengths):
+         l = self._outbuf_len(outbuf[0])
+         self.outbuf_bytes -= lengths[0] - l
+         lengths[0] = l
+
    def _output_write(self, *args, **kwargs):
       AsyncDataStream._output_write(self, *args, **kwargs)
-      if ((not self._outbuf) and (not (self._outbuf is None)) and self.uploading):
+      self._outbuf_bytes_update()
+      if ((not (self._outbuf is None)) and self.uploading):
+         # Refill once we've drained to the low watermark.
          self.read_blocks()
 
    def _send_block(self, io_req):
       """Push blocks read from hd out to network"""
+      self.outbuf_bytes_reading -= len(io_req.buf)
       if not (self):
          return
       if (io_req.failed):
@@ -574,7 +762,13 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          self.close()
          return
       self.content_bytes_out += io_req.payload_len
-      self.send_data_bt(io_req.buf)
+      self.rate_ewma_out.value_add(io_req.payload_len)
+      # Bandwidth for this has been requested by read_blocks() already.
+      self.send_data_bt(io_req.buf, bw_count=False)
+      if (self and self.uploading):
+         # We might have been told about more requests while this one was
+         # being read.
+         self.read_blocks()
 
    # internal methods: sending data to peer
    def send_data_bt(self, data, bw_count=True, buffering_force=False, **kwargs):
@@ -593,7 +787,8 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             return
          self.ts_traffic_last_out = time.time()
          if (bw_count):
-            self.bandwidth_manager_out.bandwidth_take(len(data))
+            self.bandwidth_manager_out.bandwidth_take(len(data),
+               bucket=self.bucket_out)
    
    # MSE handshakes
    def mse_hss1_send(self):
@@ -651,6 +846,65 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       header = struct.pack('>LB', (len(payload) + 1), msg_id)
       self.send_data_bt(header + payload, bw_count=bw_count, buffering_force=buffering_force)
       
+   def ltep_msg_send(self, ext_id, payload):
+      """Send Extension Protocol message with specified id to peer"""
+      self.msg_send(self.MSG_ID_EXTENDED, bytes((ext_id,)) + payload)
+   
+   def ltep_handshake_send(self):
+      """Send Extension Protocol handshake to peer"""
+      if (self.bth and not (self.bth.metainfo.private_get())):
+         self.ltep_ids_self = dict(self.ltep_extensions)
+      else:
+         self.ltep_ids_self = {}
+      msg = {
+         b'm': self.ltep_ids_self,
+         b'v': self.ltep_version,
+         b'reqq': self.blocks_pending_out_limit
+      }
+      if (self.bth and self.bth.port):
+         msg[b'p'] = self.bth.port
+      self.ltep_msg_send(self.LTEP_ID_HANDSHAKE, benc_str_from_py(msg))
+   
+   def pex_active(self):
+      """Return whether both we and peer have offered peer exchange"""
+      return ((b'ut_pex' in self.ltep_ids_self) and
+         (b'ut_pex' in self.ltep_ids_peer))
+   
+   def pex_address_get(self):
+      """Return compact form of address peer accepts connections on, or None
+         if we don't know it"""
+      if (self.outgoing):
+         return self.btpeer.packed_get()
+      if (self.ltep_port is None):
+         return None
+      return self.btpeer.packed_get()[:-2] + struct.pack('>H', self.ltep_port)
+   
+   def pex_send(self):
+      """Send PEX message telling peer about changes to the set of peers
+         we're connected to since our last one"""
+      self.ts_pex_out = time.time()
+      peers = self.bth.pex_peers_get()
+      peers.discard(self.pex_address_get())
+      if (self.pex_peers_sent is None):
+         peers_sent = set()
+      else:
+         peers_sent = self.pex_peers_sent
+      added = [p for p in peers if not (p in peers_sent)][:self.pex_peers_max]
+      dropped = [p for p in peers_sent if not (p in peers)][:self.pex_peers_max]
+      if (not (added or dropped) and not (self.pex_peers_sent is None)):
+         return
+      self.pex_peers_sent = peers_sent.difference(dropped).union(added)
+      
+      msg = {}
+      for (key, el) in ((b'added', 6), (b'added6', 18)):
+         entries = [p for p in added if (len(p) == el)]
+         msg[key] = b''.join(entries)
+         msg[key + b'.f'] = bytes(len(entries))
+      for (key, el) in ((b'dropped', 6), (b'dropped6', 18)):
+         msg[key] = b''.join([p for p in dropped if (len(p) == el)])
+      self.log2(12, '{0} sending PEX message with {1} added and {2} dropped peers.'.format(self, len(added), len(dropped)))
+      self.ltep_msg_send(self.ltep_ids_peer[b'ut_pex'], benc_str_from_py(msg))
+   
    def choke_send(self, choking):
       """Send CHOKE/UNCHOKE message to peer and save status"""
       choking = bool(choking)
@@ -688,6 +942,11 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       
    def bitfield_send(self):
       """Send BITFIELD message to peer"""
+      if (self.bth.super_seeding_active()):
+         # Pretend not to have anything; pieces are revealed one by one later.
+         self.msg_send(self.MSG_ID_BITFIELD, BitMask(bitlen=self.bth.piece_count))
+         self.super_seed_masked = True
+         return
       self.msg_send(self.MSG_ID_BITFIELD, self.bth.piecemask)
       
    def block_request(self, piece_index, block):
@@ -705,11 +964,13 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          # BTC might have been terminated during send
          return
       
+      now = time.time()
       if not (self.blocks_pending):
-         self.time_block_in_waiting = time.time()
+         self.time_block_in_waiting = now
       self.blocks_pending.add((piece_index, block))
+      self.blocks_pending_ts[(piece_index, block)] = now
       self.bth.blockmask_req.block_have_set(piece_index, block, True)
-      self.ts_request_last_out = time.time()
+      self.ts_request_last_out = now
       
    def block_cancel(self, piece_index, block_index):
       """Send CANCEL message for specified pending block, and forget about it"""
@@ -743,10 +1004,44 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             pm_out = self.piecemask
          self.pieces_wanted = self.bth.pieces_wanted_get(pm_out, self.pieces_wanted_max)
          
+   def reading_pause(self):
+      """Stop reading from our socket until more inbound bandwidth is
+         available"""
+      if (self.reading_paused or (not self)):
+         return
+      req = self.bandwidth_logger_in.bandwidth_request(1, 1,
+         self._reading_resume)
+      if not (isinstance(req, BandwidthRequest)):
+         # Got some after all.
+         self.bandwidth_logger_in.bandwidth_refund(req)
+         return
+      self.log2(12, '{0} pausing reads.'.format(self))
+      self.bandwidth_request_in = req
+      self.reading_paused = True
+      self._fw.read_u()
+   
+   def _reading_resume(self, bandwidth_request, bytes_granted, request_done):
+      """Start reading from our socket again after reading_pause()"""
+      # We only wanted to know when there'd be some available again; actual
+      # traffic is accounted for when it arrives.
+      bandwidth_request.parent.bandwidth_refund(bytes_granted)
+      self.bandwidth_request_in = None
+      self.reading_paused = False
+      if not (self):
+         return
+      self.log2(12, '{0} resuming reads.'.format(self))
+      self._fw.read_r()
+      if (self.downloading and (len(self.blocks_pending) < self.pieces_queue_min)):
+         self.blocks_request()
+   
    def blocks_request(self):
       """Heuristically request pieces from peer"""
       if (not self.bth):
          return
+      if (self.reading_paused):
+         # Requesting more now would only make the peer's data pile up in
+         # kernel buffers; we'll get back to it once reading is resumed.
+         return
       if (self.s_snubbed):
          return
       if (self.s_choked):
@@ -795,6 +1090,7 @@ class BTClientConnection(AsyncDataStream, MSEBase):
    def block_pending_cancel(self, block):
       """Process a (piece becoming non-pending) - event"""
       self.blocks_pending.remove(block)
+      self.blocks_pending_ts.pop(block, None)
       if not (self.blocks_pending):
          self.time_block_in_waiting = None
          self.s_snubbed = False
@@ -805,6 +1101,7 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       
    def client_error_process(self):
       """Close connection and report to BTH that this client(?) is broken"""
+      self.failed = True
       if (self.bth):
          self.bth.peer_connection_error_process(self)
 
@@ -859,6 +1156,9 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       
       self.bandwidth_logger_in.bandwidth_take(len(in_data) - self.buffer_input_len)
       self.buffer_input_len = len(in_data)
+      if (self.bandwidth_logger_in.bandwidth_exhausted()):
+         # Finish processing what we have, but don't read any more for now.
+         self.reading_pause()
       
       if (self.mse_init):
          # MSE handshaking code
@@ -1060,8 +1360,15 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          if (self.reserved.feature_get(ReservedMask.EXT_FAST)):
             self.log2(15, 'Peer at {0} supports Fast Extension; activating it.'.format(self.btpeer))
             self.ext_Fast = True
+         if (self.reserved.feature_get(ReservedMask.EXT_LTEP)):
+            self.log2(15, 'Peer at {0} supports Extension Protocol; activating it.'.format(self.btpeer))
+            self.ext_LTEP = True
+            self.ltep_handshake_send()
          
          self.handshake_processed = True
+         self.ts_handshake = time.time()
+         if (self.outgoing and self.bth):
+            self.bth.peer_connection_established(self)
          if (not self):
             return
          cont = bool(in_data[header_size:])
@@ -1153,14 +1460,15 @@ class BTClientConnection(AsyncDataStream, MSEBase):
          raise BTProtocolError('Value {0} for payload_len invalid; expected 0.'.format(payload_len))
       self.log2(12, '{0} notes interest by peer'.format(self))
       self.p_interest = True
+      self.bth.downloader_slots_fill()
 
    def input_process_notinterested(self, data_sio, payload_len):
       """Process NOT INTERESTED message"""
       if (payload_len != 0):
          raise BTProtocolError('Value {0} for payload_len invalid; expected 0.'.format(payload_len))
       self.log2(12, '{0} notes disinterest by peer'.format(self))
-      self.bth.downloaders_update(discard_optimistic_unchokes=False)
       self.p_interest = False
+      self.bth.downloader_remove(self)
       
    def input_process_have(self, data_sio, payload_len):
       """Process HAVE message"""
@@ -1169,6 +1477,10 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       piece_index = struct.unpack('>L', data_sio.read(payload_len))[0]
       self.piecemask.bit_set(piece_index, True)
       self.bth.piece_availability_adjust(piece_index, + 1)
+      if (self.bth.super_seeding_active()):
+         self.bth.super_seed_have_process(self, piece_index)
+         if (not self):
+            return
       
       if not (self.s_interest):
          # This may have made the peer more interesting to us
@@ -1186,6 +1498,8 @@ class BTClientConnection(AsyncDataStream, MSEBase):
       self.log(15, 'Updating bitfield on {0!a} after BITFIELD message.'.format(self))
       self.piecemask = BitMask(data_sio.read(payload_len), bitlen=self.piecemask.bitlen)
       self.bth.pieces_availability_adjust_mask(self.piecemask, +1)
+      if (self.bth.super_seeding_active()):
+         self.bth.super_seed_offer(self)
       self._process_new_pieces()
    
    def input_process_request(self, data_sio, payload_len):
@@ -1242,12 +1556,16 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             self.log2(19, 'Connection {0} got block p{1}, s{2}, l{3}, which I do not remember requesting. Discarding data.'.format(self, piece_index, start, block_length))
             self.s_snubbed = False
       else:
+         ts_request = self.blocks_pending_ts.get(block_tuple)
          self.block_pending_cancel(block_tuple)
-         self.time_block_in_waiting = time.time()
+         now = self.time_block_in_waiting = time.time()
+         if not (ts_request is None):
+            self.latency_request.value_add(now - ts_request)
          snubbed_previous = self.s_snubbed
          self.s_snubbed = False
          self.bth.block_process(self, piece_index, start, block_length, data_sio, duplicate_ignore=snubbed_previous)
          self.content_bytes_in += block_length
+         self.rate_ewma_in.value_add(block_length, now)
 
       if (len(self.blocks_pending) < self.pieces_queue_min):
          self.blocks_request()
@@ -1326,10 +1644,69 @@ class BTClientConnection(AsyncDataStream, MSEBase):
    
    def input_process_extended(self, data_sio, payload_len):
       """Process (Extension Protocol) EXTENDED message"""
-      # XXX: Add support for this. This function only exists becasue some
-      # clients will send EXTENDED without checking whether the peer supports
-      # it.
-      pass
+      if not (self.ext_LTEP):
+         # Some clients will send EXTENDED without checking whether the peer
+         # supports it; ignore those.
+         return
+      if (payload_len < 1):
+         raise BTProtocolError('Got EXTENDED message without extended message id.')
+      data = data_sio.read(payload_len)
+      ext_id = data[0]
+      if (ext_id == self.LTEP_ID_HANDSHAKE):
+         self.ltep_handshake_process(data[1:])
+      elif ((ext_id == self.LTEP_ID_UT_PEX) and (b'ut_pex' in self.ltep_ids_self)):
+         self.pex_process(data[1:])
+      else:
+         self.log2(20, '{0} ignoring EXTENDED message with unknown extended message id {1}.'.format(self, ext_id))
+   
+   @staticmethod
+   def ltep_dict_parse(data):
+      """Decode bencoded dict from Extension Protocol message"""
+      try:
+         rv = py_from_benc_str_untrusted(data)
+      except ValueError as exc:
+         raise BTProtocolError('Got EXTENDED message with invalid payload: {0}'.format(exc))
+      if not (isinstance(rv, dict)):
+         raise BTProtocolError('Got EXTENDED message with non-dict payload {0!a}.'.format(rv))
+      return rv
+   
+   def ltep_handshake_process(self, data):
+      """Process Extension Protocol handshake"""
+      msg = self.ltep_dict_parse(data)
+      m = msg.get(b'm', {})
+      if not (isinstance(m, dict)):
+         raise BTProtocolError('Got Extension Protocol handshake with bogus m value {0!a}.'.format(m))
+      for (name, ext_id) in m.items():
+         if not (isinstance(ext_id, int) and (0 <= ext_id < 256)):
+            raise BTProtocolError('Got Extension Protocol handshake with bogus id {0!a} for {1!a}.'.format(ext_id, name))
+         if (ext_id == 0):
+            self.ltep_ids_peer.pop(name, None)
+         else:
+            self.ltep_ids_peer[name] = ext_id
+      port = msg.get(b'p')
+      if (isinstance(port, int) and (0 < port < 65536)):
+         self.ltep_port = port
+      self.log2(14, '{0} processed Extension Protocol handshake; peer extensions: {1!a}, port: {2}.'.format(self, self.ltep_ids_peer, self.ltep_port))
+      if (self.pex_active() and (self.pex_peers_sent is None)):
+         self.pex_send()
+   
+   def pex_process(self, data):
+      """Process PEX message"""
+      now = time.time()
+      if not ((self.ts_pex_in is None) or
+            (now >= self.ts_pex_in + self.pex_interval_in_min)):
+         self.log2(20, '{0} ignoring PEX message sent {1:.1f} seconds after the previous one.'.format(self, now - self.ts_pex_in))
+         return
+      self.ts_pex_in = now
+      msg = self.ltep_dict_parse(data)
+      tables = []
+      for (key, el) in ((b'added', 6), (b'added6', 18)):
+         added = msg.get(key, b'')
+         if not (isinstance(added, bytes) and ((len(added) % el) == 0)):
+            raise BTProtocolError('Got PEX message with bogus {0!a} value {1!a}.'.format(key, added))
+         tables.append(BTPeerTable(el, added[:self.pex_in_peers_max*el]))
+      if (self.bth):
+         self.bth.pex_peers_process(self, tables)
    
    # standard python operator overloading
    def __repr__(self):
@@ -1337,31 +1714,10 @@ class BTClientConnection(AsyncDataStream, MSEBase):
             self.__class__.__name__, self.btpeer, id(self),
             self.content_bytes_out, self.content_bytes_in)
    
-   def traffic_delta_cmp(self, other):
-      diff_self = self.content_bytes_in #- self.content_bytes_out
-      diff_other = other.content_bytes_in #- other.content_bytes_out
-      if (diff_self != diff_other):
-         if (diff_self < diff_other):
-            return 1
-         return -1
-      return 0
-   
    def __eq__(self, other):
       return (self is other)
    def __ne__(self, other):
       return not (self is other)
-   def __lt__(self, other):
-      td = self.traffic_delta_cmp(other)
-      return ((td == -1) or ((td == 0) and (id(self) < id(other))))
-   def __le__(self, other):
-      td = self.traffic_delta_cmp(other)
-      return ((td == -1) or ((td == 0) and (id(self) <= id(other))))
-   def __gt__(self, other):
-      td = self.traffic_delta_cmp(other)
-      return ((td == 1) or ((td == 0) and (id(self) > id(other))))
-   def __ge__(self, other):
-      td = self.traffic_delta_cmp(other)
-      return ((td == 1) or ((td == 0) and (id(self) >= id(other))))
 
    def __hash__(self):
       return hash(id(self))
@@ -1398,6 +1754,15 @@ class BTorrentHandler:
    block_time = 0.05
    
    optimistic_unchoke_rate = 0.2
+   # Interval in seconds between runs of the choking algorithm
+   choke_interval = 10
+   # Optimistic unchokes are rotated every this many choke rounds
+   optimistic_unchoke_rounds = 3
+   # Number of choke rounds to compute rolling-window transfer rates over
+   choke_rate_rounds = 2
+   # Maximum number of regular upload slots handed to different peers in a
+   # single choke round
+   choke_churn_max = 2
    
    # defaults for bandwidth limiter instantiation, if not provided by user
    bwm_cycle_length = 1
@@ -1413,16 +1778,35 @@ class BTorrentHandler:
    announce_default_interval = 1800
    # Minimum announce interval; overrides any suggestion by tracker
    announce_min_interval = 50
+   # Parallel announce mode: trackers that fail are skipped for
+   # announce_retry_interval seconds, doubled with each further failure up to
+   # this limit
+   announce_backoff_max = 3600
+   
+   # Size of single reads done for piecemask validation, and maximum number of
+   # those to have in flight at once
+   validation_chunk_length = 1048576
+   validation_depth = 4
+   # If true, validation is done in the background: We go online immediately,
+   # and pieces are advertised as they are found to be valid. In this mode,
+   # only one chunk is read at a time, with a pause of
+   # validation_background_delay seconds between chunks to keep disk load
+   # reasonable.
+   validation_background = False
+   validation_background_delay = 0.1
    
    init_names = ('metainfo', 'peer_id', 'interval_override',
       'peer_connection_count_target', 'peer_connections_start_delay',
       'basename_use', 'piecemask', 'piecemask_validate', 'bli_cls', 'bmo_cls', 
       'content_bytes_in', 'content_bytes_out', 'ts_downloading_start',
       'ts_downloading_finish', 'active', 'bytes_left', 'download_complete',
-      'announce_key')
+      'announce_key', 'resume_data', 'upload_slot_weight', 'super_seeding',
+      'upload_rate_max', 'peer_upload_rate_max', 'download_rate_max',
+      'announce_parallel', 'peers_known')
    
    timer_attributes = ('timer_announce', 'timer_maintenance', 
-      'timer_peer_connections_start', 'timer_init')
+      'timer_peer_connections_start', 'timer_init', 'timer_validation',
+      'timer_choke')
    
    def __init__(self, **kwargs):
       self.init_args = kwargs.copy()
@@ -1436,7 +1820,11 @@ class BTorrentHandler:
                 downloader_count=4, content_bytes_out=0, content_bytes_in=0,
                 ts_downloading_start=None, ts_downloading_finish=None,
                 active=False, bytes_left=None, download_complete=False,
-                announce_key=None, port=None):
+                announce_key=None, port=None, resume_data=None,
+                upload_slot_weight=1, super_seeding=False,
+                upload_rate_max=None, peer_upload_rate_max=None,
+                download_rate_max=None, announce_parallel=False,
+                peers_known=None):
       
       self.event_dispatcher = None
       if (announce_key is None):
@@ -1453,6 +1841,15 @@ class BTorrentHandler:
       self.basename_use = basename_use
       self.piecemask = piecemask
       self.piecemask_validate = piecemask_validate
+      # BTResumeData of last known-good piecemask and target file state, if any
+      self.resume_data = resume_data
+      # BitMask of pieces claimed by piecemask that haven't been validated yet,
+      # while validation is running
+      self.validation_mask = None
+      self.validation_bytes_total = None
+      self.validation_bytes_done = None
+      self.validation_rate = None
+      self.ts_validation_start = None
       self.pieces_have_count = 0
       
       self.endgame_mode = False
@@ -1460,14 +1857,43 @@ class BTorrentHandler:
       self.ts_downloading_start = (None or datetime.datetime.now())
       self.ts_downloading_finish = ts_downloading_finish
       self.bt_disk_io = None
+      self.disk_io_stats = None
+      # Incremented by each io_start(), to recognize results of disk and
+      # hash requests made before an io_stop()
+      self.io_generation = 0
+      self.hash_pool = None
+      self.resolver = None
+      self.udp_tracker_mux = None
+      self.http_client_pool = None
+      self.announce_scheduler = None
+      self.connection_pacer = None
       self.peer_connections = set()
-      self.peers_known = set()
+      # Peers we know about, along with their connection history
+      if (peers_known is None):
+         peers_known = BTPeerStore()
+      self.peers_known = peers_known
+      # Best peers to connect to next, in reverse order
+      self.peers_connect_queue = []
       self.bytes_left = bytes_left
       self.trackerid = None
       self.tr = None
       self.tier = 0
       self.tier_index = 0
       self.tracker_valid = False
+      # swarm statistics from last scrape or announce response; None if unknown
+      self.swarm_seeders = None
+      self.swarm_leechers = None
+      self.swarm_downloaded = None
+      self.ts_swarm_update = None
+      # If true, announce to all trackers of the current tier at once (or to
+      # all trackers, if none of them is known to work), instead of trying
+      # them one at a time.
+      self.announce_parallel = announce_parallel
+      # parallel announce mode: pending requests by announce URL, and
+      # (failure count, earliest retry ts) of trackers that failed
+      self.trs = {}
+      self.tracker_backoff = {}
+      self.announce_round_success = False
       
       for name in self.timer_attributes:
          setattr(self, name, None)
@@ -1476,11 +1902,26 @@ class BTorrentHandler:
       self.init_started = False
       self.init_done = False
       self.uploading = True
-      self.downloader_count = downloader_count
-      self.optimistic_unchoke_count = int(math.ceil(downloader_count*self.optimistic_unchoke_rate))
+      # relative share of upload slots when allocated by BTClient
+      self.upload_slot_weight = upload_slot_weight
+      # BEP 16 super-seeding: once complete, only reveal pieces to peers one
+      # at a time
+      self.super_seeding = super_seeding
+      self.super_seed_offers = [0]*self.piece_count
+      self.downloader_count = None
+      self.optimistic_unchoke_count = None
+      # unchoked interested connections; downloaders_regular ordered by
+      # nothing in particular, downloaders is their concatenation
       self.downloaders = []
+      self.downloaders_regular = []
+      self.downloaders_optimistic = []
       self.downloaders_index = 0
+      self.choke_round = 0
+      # regular upload slots reassigned in the current choke round
+      self.choke_swaps = 0
+      # unchoked connections that aren't interested
       self.senders = set()
+      self.downloader_count_set(downloader_count)
       # generic traffic statistics; note that these only refer to finished connections
       self.content_bytes_in = content_bytes_in
       self.content_bytes_out = content_bytes_out
@@ -1501,6 +1942,11 @@ class BTorrentHandler:
       self.pieces_preference = ()
       self.bli_cls = bli_cls
       self.bmo_cls = bmo_cls
+      # upload limits in bytes per second for the entire torrent and single
+      # connections; None for no limit
+      self.upload_rate_max = upload_rate_max
+      self.peer_upload_rate_max = peer_upload_rate_max
+      self.download_rate_max = download_rate_max
       self.bandwidth_logger_in = self.bandwidth_logger_out = \
          self.bandwidth_manager_out = None
       
@@ -1513,13 +1959,17 @@ class BTorrentHandler:
       
       self.active = True
       if ((not self.timer_announce) and self.init_done):
-         self.client_announce_tracker()
+         self.announce_queue()
    
    def data_transfers_stop(self):
       """Stop transferring data and close all active connections"""
       if (not self.active):
          raise BTCStateError('{0} is already inactive.'.format(self))
       self.active = False
+      if not (self.announce_scheduler is None):
+         self.announce_scheduler.bth_remove(self)
+      if not (self.connection_pacer is None):
+         self.connection_pacer.bth_remove(self)
       self.client_announce_tracker(event=b'stopped', event_force=True)
       for conn in self.peer_connections.copy():
          conn.close()
@@ -1529,34 +1979,71 @@ class BTorrentHandler:
       return BTorrentHandlerMirror.state_get_from_original(self)
       rv = {}
       
-   def io_start(self, sa, basepath, port, btdiskio_build):
+   def io_start(self, sa, basepath, port, btdiskio_build, hash_pool=None,
+         validation_chunk_length=None, validation_depth=None,
+         validation_background=None, validation_background_delay=None,
+         bucket_out_parent=None,
+         bucket_in_parent=None, bandwidth_clock=None, resolver=None,
+         udp_tracker_mux=None, http_client_pool=None,
+         announce_scheduler=None, connection_pacer=None):
       """Start IO init sequence: open files on disk, and start piecemask
-         validation (if any)"""
+         validation (if any); bucket_out_parent and bucket_in_parent are
+         TokenBuckets for limits shared with other torrents, bandwidth_clock
+         a BandwidthClock to drive our bandwidth loggers, resolver an
+         AsyncResolver to use for hostname lookups, udp_tracker_mux an
+         UDPTrackerMux to talk to UDP trackers through, http_client_pool a
+         HTTPClientPool to talk to HTTP trackers through, announce_scheduler
+         an AnnounceScheduler to decide when to announce and connection_pacer
+         a ConnectionPacer to open peer connections through"""
       assert not (self.init_started)
       assert not (self.init_done)
+      if not ((validation_depth is None) or (validation_depth >= 1)):
+         raise ValueError('validation_depth must be at least 1; got {0!a}.'.format(validation_depth))
       self.init_started = True
       self.sa = sa
       self.event_dispatcher = sa.ed
       self.port = port
-      
+      self.hash_pool = hash_pool
+      self.resolver = resolver
+      self.udp_tracker_mux = udp_tracker_mux
+      self.http_client_pool = http_client_pool
+      self.announce_scheduler = announce_scheduler
+      self.connection_pacer = connection_pacer
+      if not (validation_chunk_length is None):
+         self.validation_chunk_length = validation_chunk_length
+      if not (validation_depth is None):
+         self.validation_depth = validation_depth
+      if not (validation_background is None):
+         self.validation_background = validation_background
+      if not (validation_background_delay is None):
+         self.validation_background_delay = validation_background_delay
+      
+      self.io_generation += 1
       self.bt_disk_io = btdiskio_build(self.sa, self.metainfo, basepath,
          basename_use=self.basename_use)
+      self.disk_io_stats = self.bt_disk_io.io_stats
       if (self.piecemask):
          assert(self.piecemask.bitlen) == len(self.metainfo.piece_hashes)
       else:
          self.piecemask = BitMask(bitlen=self.piece_count)
 
-      self.bandwidth_logger_in = self.bli_cls(self.event_dispatcher,
-         cycle_length=self.bwm_cycle_length,
-         history_length=self.bwm_history_length)
+      self.bandwidth_logger_in = self._bl_build(self.bli_cls,
+         self.download_rate_max, bucket_in_parent, clock=bandwidth_clock)
       self.bandwidth_logger_out = self.bandwidth_manager_out = \
-         self.bmo_cls(self.event_dispatcher, cycle_length=self.bwm_cycle_length,
-         history_length=self.bwm_history_length)
+         self._bl_build(self.bmo_cls, self.upload_rate_max, bucket_out_parent,
+         self.peer_upload_rate_max, clock=bandwidth_clock)
       
       if (self.piecemask_validate):
+         self.validation_mask = self.piecemask_validation_mask_get()
+      
+      if not (self.validation_mask is None):
          self.piecemask_validation_perform()
+         if (self.validation_background):
+            self.bytes_left_update()
+            self.io_init_finish()
       else:
          self.pieces_have_count = self.piecemask.bits_set_count()
+         self.bytes_left_update()
          self.download_complete = (self.pieces_have_count == self.piece_count)
          self.io_init_finish()
    
@@ -1564,10 +2051,52 @@ class BTorrentHandler:
       """Finish IO initialization sequence.
          Should be called after piecemask validation (if any) is completed"""
       if (self.active):
-         self.client_announce_tracker()
+         self.announce_queue()
       self.persistence_timers_set()
       self.init_done = True
    
+   def _bl_build(self, cls, rate, bucket_parent, rate_child=None, clock=None):
+      """Instantiate bandwidth logger or limiter"""
+      kwargs = {}
+      rate_parent = None
+      if not (bucket_parent is None):
+         rate_parent = bucket_parent.rate
+      if ((cls is NullBandwidthLimiter) and not ((rate_parent is None)
+          and (rate is None) and (rate_child is None))):
+         # Limits have been configured, but this one can't enforce them.
+         cls = TokenBucketBandwidthLimiter
+      if (issubclass(cls, TokenBucketBandwidthLimiter)):
+         kwargs = dict(rate=rate, parent=bucket_parent)
+      return cls(self.event_dispatcher, cycle_length=self.bwm_cycle_length,
+         history_length=self.bwm_history_length, clock=clock, **kwargs)
+   
+   def download_rate_max_set(self, rate):
+      """Set download limit in bytes per second for this torrent; None for
+         no limit"""
+      self.download_rate_max = rate
+      bli = self.bandwidth_logger_in
+      if (bli is None):
+         return
+      if not (isinstance(bli, TokenBucketBandwidthLimiter)):
+         self.log(30, "{0} can't enforce download limits with bandwidth logger {1!a}; they will take effect after restart.".format(self, bli))
+         return
+      bli.rate_set(rate)
+   
+   def upload_rate_max_set(self, rate, peer_rate):
+      """Set upload limits in bytes per second for this torrent and each of
+         its connections; None for no limit"""
+      self.upload_rate_max = rate
+      self.peer_upload_rate_max = peer_rate
+      bmo = self.bandwidth_manager_out
+      if (bmo is None):
+         return
+      if not (isinstance(bmo, TokenBucketBandwidthLimiter)):
+         self.log(30, "{0} can't enforce upload limits with bandwidth manager {1!a}; they will take effect after restart.".format(self, bmo))
+         return
+      bmo.rate_set(rate)
+      for conn in self.peer_connections:
+         conn.bucket_out_update()
+   
    def bl_close(self):
       """Stop and forget bandwidth loggers and managers"""
       for bl in (self.bandwidth_logger_in, self.bandwidth_logger_out, self.bandwidth_manager_out):
@@ -1585,6 +2114,8 @@ class BTorrentHandler:
          if not (timer is None):
             timer.cancel()
          setattr(self, name, None)
+      if not (self.announce_scheduler is None):
+         self.announce_scheduler.bth_remove(self)
       
    def io_stop(self):
       """Abort running timers and close files on disk on an inactive bth"""
@@ -1592,8 +2123,13 @@ class BTorrentHandler:
          raise BTCStateError('{0} is currently active'.format(self))
       
       self.init_done = False
+      if not (self.validation_mask is None):
+         # Validation was interrupted; remember unchecked pieces as claimed.
+         self.piecemask = self.piecemask.mask_or(self.validation_mask)
+         self.validation_mask = None
       self.bt_disk_io.close()
       self.bt_disk_io = None
+      self.disk_io_stats = None
       self.timers_clear()
       
       self.bl_close()
@@ -1603,67 +2139,232 @@ class BTorrentHandler:
       for name in self.init_names:
          if (hasattr(self, name)):
             rv[name] = getattr(self, name)
+      if not (self.validation_mask is None):
+         # Don't forget about pieces we haven't gotten around to checking yet.
+         rv['piecemask'] = self.piecemask.mask_or(self.validation_mask)
       return rv
    
    def __setstate__(self, state):
       kwargs = state
       self.__init__(**kwargs)
    
+   def _hash_compute(self, data, callback):
+      """Compute SHA1 digest of data, and pass a request with the result to
+         callback once it's available.
+         
+         Hashing is done on our hash pool, if any; otherwise it's done
+         immediately, with the callback deferred to a timer."""
+      if not (self.hash_pool is None):
+         req = self.hash_pool.sha1_digest(data, callback)
+      else:
+         req = WorkerPoolRequest(callback)
+         req.rv = sha1(data).digest()
+         self.event_dispatcher.set_timer(0, callback, args=(req,))
+      req.io_generation = self.io_generation
+      return req
+   
+   def _io_req_current(self, req):
+      """Return whether req was made since our last io_start(), and IO is
+         still running"""
+      return ((not (self.bt_disk_io is None)) and
+         (req.io_generation == self.io_generation))
+   
+   def resume_data_use(self, resume_data):
+      """Start using externally generated resume data, including its piecemask.
+         Must be called before io_start()."""
+      assert not (self.init_started)
+      if (resume_data.piecemask.bitlen != self.piece_count):
+         raise ValueError('Resume data {0!a} has piecemask of bitlen {1}; expected {2}.'.format(resume_data, resume_data.piecemask.bitlen, self.piece_count))
+      self.resume_data = resume_data
+      self.piecemask = BitMask(bytes(resume_data.piecemask), bitlen=self.piece_count)
+   
+   def resume_data_update(self):
+      """Record current piecemask and target file state, for skipping
+         validation of unchanged files on next startup"""
+      if not (self.validation_mask is None):
+         # Background validation isn't done yet; our piecemask is incomplete.
+         return
+      self.resume_data = BTResumeData.build_from_disk_io(self.piecemask,
+         self.bt_disk_io)
+   
+   def piecemask_validation_mask_get(self):
+      """Return BitMask of claimed pieces that need validation, or None if
+         there aren't any"""
+      rd = self.resume_data
+      claimed = self.piecemask
+      if not (rd is None):
+         try:
+            changed = rd.pieces_changed_get(self.metainfo,
+               self.bt_disk_io.file_stats_get())
+            # Only pieces the resume data vouches for, in unchanged files,
+            # can be trusted without checking.
+            trusted = rd.piecemask.mask_andnot(changed)
+            unchecked = claimed.mask_andnot(trusted)
+         except ValueError as exc:
+            self.log(30, "{0} can't use resume data {1!a}: {2}".format(self,
+               rd, exc))
+         else:
+            self.log(20, '{0} skipping validation of {1} pieces in unchanged '
+               'files.'.format(self, claimed.bits_set_count() -
+               unchecked.bits_set_count()))
+            claimed = unchecked
+      
+      if (claimed.bits_set_count() == 0):
+         return None
+      return claimed
+   
    def piecemask_validation_perform(self, req=None):
       """Check whether allegedly present data hashes to the correct value"""
       piece_len = self.piece_length_get(False)
       if (req is None):
-         self.bytes_left = self.metainfo.length_total
-         self.log(22, '{0} is starting validation of previously downloaded data.'.format(self))
-         blen = 1048576
+         # Pieces are only added back to our piecemask once we've found them
+         # to be valid.
+         self.piecemask = self.piecemask.mask_andnot(self.validation_mask)
+         self.pieces_have_count = self.piecemask.bits_set_count()
+         self.download_complete = False
+         
+         bytes_total = self.validation_mask.bits_set_count()*piece_len
+         if (self.validation_mask.bit_get(self.piece_count - 1)):
+            bytes_total -= (piece_len - self.piece_length_get(True))
+         self.validation_bytes_total = bytes_total
+         self.validation_bytes_done = 0
+         self.validation_rate = 0
+         self.ts_validation_start = time.time()
+         
+         self.log(22, '{0} is starting validation of {1} pieces ({2} bytes) of '
+            'previously downloaded data.'.format(self,
+            self.validation_mask.bits_set_count(), bytes_total))
+         blen = self.validation_chunk_length
          blen -= (blen % piece_len)
          if (not blen):
             blen = piece_len
-         
-         buf = bytearray(min(blen, self.metainfo.length_total))
-         req = self.bt_disk_io.async_readinto(((0,buf),), self.piecemask_validation_perform)
-         req.buf = buf
-         req.blen = blen
-         req.index = 0
+         self.validation_blen = blen
+         self.validation_index = 0
+         self.validation_chunks_pending = 0
+         self._validation_chunks_read()
+         return
+      
+      if not (self._io_req_current(req)):
          return
       
       buf = memoryview(req.buf)
       i = req.index
       o = 0
+      req.hashes_pending = 0
       while (len(buf) > o):
          m = buf[o:o+piece_len]
-         if (self.piecemask.bit_get(i)):
-            h = sha1(m).digest()
-            if (self.metainfo.piece_hashes[i] != h):
-               # We don't explicitly check for failed reads; the somewhat nicer
-               # log messages aren't worth the additional complexity.
-               self.log(25, 'Piece {0} of {1} was supposed to be present, but hd'
-                   'content (if present) hashed to {2!a}, while expected hash was'
-                   ' {3!a}.'.format(i, self, h, self.metainfo.piece_hashes[i]))
-               self.piecemask.bit_set(i, False)
-            else:
-               self.pieces_have_count += 1
-               self.bytes_left -= len(m)
+         if (self.validation_mask.bit_get(i)):
+            hreq = self._hash_compute(m, self._validation_hash_process)
+            hreq.vreq = req
+            hreq.index = i
+            hreq.length = len(m)
+            req.hashes_pending += 1
          o += len(m)
          i += 1
       
-      if (i >= self.piece_count):
-         self.log(22, '{0} has finished validation of previously downloaded data.'.format(self))
-         if ((self.piecemask.bitlen > 0) and self.piecemask.bit_get(i - 1)):
-            # Last piece was valid. Correct self.bytes_left back up
-            self.bytes_left += (self.metainfo.piece_length - self.piece_length_get(True))
-         assert (self.bytes_left >= 0)
+      if (req.hashes_pending == 0):
+         self._validation_chunk_finish()
+   
+   def _validation_chunks_read(self):
+      """Start reading chunks of data to validate, until we have
+         validation_depth of them in flight or run out of pieces to check"""
+      self.timer_validation = None
+      if (self.validation_background):
+         depth = 1
+      else:
+         depth = self.validation_depth
+      
+      piece_len = self.piece_length_get(False)
+      i = self.validation_index
+      while (self.validation_chunks_pending < depth):
+         while ((i < self.piece_count) and (not self.validation_mask.bit_get(i))):
+            i += 1
          
-         self.io_init_finish()
-         self.download_complete = (self.pieces_have_count == self.piece_count)
+         if (i >= self.piece_count):
+            break
+         
+         buf = bytearray(min(self.validation_blen, self.metainfo.length_total - piece_len*i))
+         req = self.bt_disk_io.async_readinto(((piece_len*i,buf),), self.piecemask_validation_perform)
+         req.io_generation = self.io_generation
+         req.buf = buf
+         req.index = i
+         self.validation_chunks_pending += 1
+         i += self.validation_blen//piece_len
+      
+      self.validation_index = i
+      if (self.validation_chunks_pending == 0):
+         self._validation_finish()
+   
+   def _validation_chunk_finish(self):
+      """Process end of validation of one chunk"""
+      self.validation_chunks_pending -= 1
+      tdiff = time.time() - self.ts_validation_start
+      if (tdiff > 0):
+         self.validation_rate = int(self.validation_bytes_done/tdiff)
+      
+      if (self.validation_background and (self.validation_index < self.piece_count)):
+         self.timer_validation = self.event_dispatcher.set_timer(
+            self.validation_background_delay, self._validation_chunks_read,
+            parent=self)
+         return
+      self._validation_chunks_read()
+   
+   def _validation_hash_process(self, hreq):
+      """Process hash of piece computed during piecemask validation"""
+      if not (self._io_req_current(hreq)):
          return
       
-      buf = bytearray(min(req.blen, self.metainfo.length_total - piece_len*i))
-      
-      req_new = self.bt_disk_io.async_readinto(((piece_len*i,buf),), self.piecemask_validation_perform)
-      req_new.buf = buf
-      req_new.blen = req.blen
-      req_new.index = i
+      i = hreq.index
+      h = hreq.rv
+      self.validation_mask.bit_set(i, False)
+      self.validation_bytes_done += hreq.length
+      if (self.metainfo.piece_hashes[i] != h):
+         # We don't explicitly check for failed reads; the somewhat nicer
+         # log messages aren't worth the additional complexity.
+         self.log(25, 'Piece {0} of {1} was supposed to be present, but hd'
+             'content (if present) hashed to {2!a}, while expected hash was'
+             ' {3!a}.'.format(i, self, h, self.metainfo.piece_hashes[i]))
+      else:
+         self.piecemask.bit_set(i, True)
+         self.pieces_have_count += 1
+         if (self.init_done):
+            # Background validation; tell everyone about it.
+            self.bytes_left -= hreq.length
+            for conn in self.peer_connections.copy():
+               conn.piece_have_new(i)
+      
+      req = hreq.vreq
+      req.hashes_pending -= 1
+      if (req.hashes_pending == 0):
+         self._validation_chunk_finish()
+   
+   def _validation_finish(self):
+      """Finish piecemask validation and IO init sequence"""
+      self.log(22, '{0} has finished validation of previously downloaded data;'
+         ' checked {1} bytes at {2} bytes/s.'.format(self,
+         self.validation_bytes_done, self.validation_rate))
+      self.validation_mask = None
+      self.bytes_left_update()
+      self.download_complete = (self.pieces_have_count == self.piece_count)
+      if not (self.init_done):
+         self.io_init_finish()
+      elif (self.download_complete):
+         # Background validation completed the torrent.
+         self.log(28, 'Completed torrent {0} by validation; {1} bytes in {2} pieces.'.format(self, self.metainfo.length_total, self.piecemask.bitlen))
+         if (self.ts_downloading_finish is None):
+            self.ts_downloading_finish = datetime.datetime.now()
+         self.em_download_finish()
+         for conn in self.peer_connections.copy():
+            conn.downloading = False
+            conn._process_new_pieces()
+   
+   def bytes_left_update(self):
+      """Recompute bytes_left from piecemask"""
+      bytes_have = self.pieces_have_count*self.piece_length_get(False)
+      if ((self.piece_count > 0) and self.piecemask.bit_get(self.piece_count - 1)):
+         bytes_have -= (self.piece_length_get(False) - self.piece_length_get(True))
+      self.bytes_left = self.metainfo.length_total - bytes_have
+      assert (self.bytes_left >= 0)
       
    def piece_length_get(self, piece_last=False):
       """Return piece_length (in bytes) for this torrent"""
@@ -1675,6 +2376,9 @@ class BTorrentHandler:
       """Return whether piece <index> has any blocks that are neither already downloaded nor currently pending"""
       if (self.piecemask.bit_get(index)):
          return False
+      if ((not (self.validation_mask is None)) and self.validation_mask.bit_get(index)):
+         # Still waiting for background validation of this one.
+         return False
       
       if (index == (self.piece_count - 1)):
          subrange = range(self.blockmask.blocks_per_piece_last)
@@ -1692,19 +2396,102 @@ class BTorrentHandler:
    def pieces_availability_adjust_mask(self, piecemask, adjustment):
       """Add <adjustment> to the availability metric of every piece in <piecemask>"""
       assert (piecemask.bitlen == self.piecemask.bitlen)
-      if (self.download_complete):
+      if (self.download_complete and (not self.super_seeding)):
          # Who cares?
          return
       for i in range(len(piecemask)):
          byteval = piecemask[i]
-         for j in range(7,-1,-1):
-            k = i*8 + j
-            if (byteval & (1 << k)):
-               self.pieces_availability[k] += adjustment
+         for j in range(8):
+            if (byteval & (1 << (7-j))):
+               self.pieces_availability[i*8 + j] += adjustment
 
    def piece_availability_adjust(self, index, adjustment=1):
       """Add <adjustment> to the availability of piece with index <index>"""
       self.pieces_availability[index] += adjustment
+   
+   def pieces_availability_recount(self):
+      """Recompute piece availability from piecemasks of our connections"""
+      self.pieces_availability = [0]*self.piece_count
+      for conn in self.peer_connections:
+         self.pieces_availability_adjust_mask(conn.piecemask, +1)
+   
+   def super_seeding_active(self):
+      """Return whether we are currently hiding pieces from new peers"""
+      return (self.super_seeding and self.download_complete)
+   
+   def super_seeding_set(self, super_seeding):
+      """Turn super-seeding mode on or off"""
+      super_seeding = bool(super_seeding)
+      if (super_seeding == self.super_seeding):
+         return
+      self.super_seeding = super_seeding
+      if (super_seeding):
+         self.super_seed_offers = [0]*self.piece_count
+         self.pieces_availability_recount()
+         return
+      
+      # Connections made while super-seeding only know about the pieces we
+      # revealed to them; tell them about everything else.
+      for conn in self.peer_connections.copy():
+         revealed = conn.super_seed_pieces
+         conn.super_seed_pieces = set()
+         if not (conn.super_seed_masked):
+            # Got our full bitfield.
+            continue
+         conn.super_seed_masked = False
+         for i in range(self.piece_count):
+            if (self.piecemask.bit_get(i) and (not conn.piecemask.bit_get(i))
+                and (not i in revealed)):
+               conn.have_send(i)
+   
+   def super_seed_offer(self, conn):
+      """Reveal one more piece to peer, picking the rarest one we haven't
+         offered often yet"""
+      pm = conn.piecemask
+      avail = self.pieces_availability
+      offers = self.super_seed_offers
+      best = None
+      best_key = None
+      for i in range(self.piece_count):
+         if (pm.bit_get(i) or (i in conn.super_seed_pieces) or
+             (not self.piecemask.bit_get(i))):
+            continue
+         key = (avail[i], offers[i])
+         if ((best is None) or (key < best_key)):
+            best = i
+            best_key = key
+      
+      if (best is None):
+         return
+      self.log(14, '{0} revealing piece {1} to {2}.'.format(self, best, conn))
+      offers[best] += 1
+      conn.super_seed_pieces.add(best)
+      conn.have_send(best)
+   
+   def super_seed_have_process(self, conn, piece_index):
+      """Process HAVE message from peer while super-seeding"""
+      # A piece we revealed to some other peer has shown up here, so that peer
+      # has passed it on; it's earned another one.
+      for conn_other in self.peer_connections.copy():
+         if ((conn_other is conn) or (not conn_other) or
+             (not piece_index in conn_other.super_seed_pieces)):
+            continue
+         conn_other.super_seed_pieces.remove(piece_index)
+         if not (conn_other.super_seed_pieces):
+            self.super_seed_offer(conn_other)
+      
+      if (piece_index in conn.super_seed_pieces):
+         # Waiting for the piece to show up elsewhere only makes sense if
+         # there's someone who could still get it from this peer.
+         for conn_other in self.peer_connections:
+            if ((not (conn_other is conn)) and
+                (not conn_other.piecemask.bit_get(piece_index))):
+               break
+         else:
+            conn.super_seed_pieces.remove(piece_index)
+      
+      if (not conn.super_seed_pieces):
+         self.super_seed_offer(conn)
       
    def pieces_preference_update(self):
       """Update cached piece preference when downloading new pieces"""
@@ -1798,15 +2585,25 @@ class BTorrentHandler:
          buf = bytearray(self.piece_length_get(piece_index == (self.piece_count - 1)))
          req_new = self.bt_disk_io.async_readinto(((piece_index*self.piece_length_get(),
             buf),), self._piece_verify)
+         req_new.io_generation = self.io_generation
          req_new.buf = buf
          req_new.bth_index = piece_index
    
    def _piece_verify(self, req):
+      """Start hash verification of potentially completed piece"""
+      if not (self._io_req_current(req)):
+         return
+      hreq = self._hash_compute(req.buf, self._piece_hash_process)
+      hreq.bth_index = req.bth_index
+   
+   def _piece_hash_process(self, req):
       """Verify hash of potentially completed piece"""
+      if not (self._io_req_current(req)):
+         return
       piece_index = req.bth_index
       
       mi_piece_hash = self.metainfo.piece_hashes[piece_index]
-      di_piece_hash = sha1(req.buf).digest()
+      di_piece_hash = req.rv
       
       if (di_piece_hash != mi_piece_hash):
          # Unfortunately we don't know which block(s) were bad, so we can't
@@ -1859,84 +2656,219 @@ class BTorrentHandler:
          self.log(30, '{0} is requesting blocks without having declared interest. Ignoring.'.format(conn))
          return
       if (not conn.uploading):
-         self.downloaders_update(discard_optimistic_unchokes=False)
-
+         self.sender_promote(conn)
 
-   def downloaders_update(self, discard_optimistic_unchokes=True):
+   def _choke_key_get(self):
+      """Return key function for ranking connections by contribution"""
+      if (self.download_complete):
+         return lambda conn: conn.rate_out
+      return lambda conn: conn.rate_in
+   
+   def choke_round_perform(self):
+      """Update connection transfer rates and rerun choking algorithm; called
+         by timer every choke_interval seconds"""
+      for conn in self.peer_connections:
+         conn.choke_rates_update(self.choke_interval, self.choke_rate_rounds)
+      self.choke_round += 1
+      self.choke_swaps = 0
+      self.downloaders_update(optimistic_rotate=
+         ((self.choke_round % self.optimistic_unchoke_rounds) == 0))
+   
+   def downloaders_update(self, optimistic_rotate=False):
       """Update list of connections we are sending content blocks out over"""
-      if not ((self.uploading) or (self.downloader_count < 1)):
+      if not (self.uploading):
          return
-      peer_connections_all = [conn for conn in self.peer_connections]
-      peer_connections_all.sort()
-      peer_connections = [conn for conn in peer_connections_all if conn.p_interest]
-      senders = []
-      
-      rate_downloader_count = self.downloader_count - self.optimistic_unchoke_count
-      
-      if (peer_connections == []):
-         senders = peer_connections_all
+      key = self._choke_key_get()
+      conns_interested = [conn for conn in self.peer_connections if conn.p_interest]
+      ranked = sorted(conns_interested, key=key, reverse=True)
+      regular_count = max(self.downloader_count - self.optimistic_unchoke_count, 0)
+      
+      # Regular slots go to the peers contributing most, but we don't reassign
+      # more than choke_churn_max of those that are still in use per round.
+      regular = [conn for conn in self.downloaders_regular
+         if ((conn in self.peer_connections) and conn.p_interest)]
+      regular.sort(key=key, reverse=True)
+      del(regular[regular_count:])
+      regular_set = set(regular)
+      for conn in ranked[:regular_count]:
+         if (conn in regular_set):
+            continue
+         if (len(regular) < regular_count):
+            regular.append(conn)
+            regular_set.add(conn)
+            continue
+         if (self.choke_swaps >= self.choke_churn_max):
+            break
+         worst = min(regular, key=key)
+         if (key(worst) >= key(conn)):
+            break
+         regular.remove(worst)
+         regular_set.remove(worst)
+         regular.append(conn)
+         regular_set.add(conn)
+         self.choke_swaps += 1
+      
+      if (optimistic_rotate):
+         optimistic = []
       else:
-         if (len(peer_connections) > rate_downloader_count):
-            ref_peer = peer_connections[rate_downloader_count-1]
-         else:
-            ref_peer = peer_connections[-1]
-         
-         for conn in peer_connections_all:
-            if (conn.traffic_delta_cmp(ref_peer) >= 0):
-               break
-            senders.append(conn)
-      
-      if (len(peer_connections) <= self.downloader_count):
-         downloaders = peer_connections
+         optimistic = [conn for conn in self.downloaders_optimistic
+            if ((conn in self.peer_connections) and conn.p_interest and
+                (not (conn in regular_set)))]
+      
+      del(optimistic[max(self.downloader_count - len(regular), 0):])
+      candidates = [conn for conn in conns_interested
+         if not ((conn in regular_set) or (conn in optimistic))]
+      while (candidates and (len(regular) + len(optimistic) < self.downloader_count)):
+         optimistic.append(candidates.pop(random.randint(0, len(candidates) - 1)))
+      
+      # Tell non-interested high-upload peers that we'd be willing to send
+      # them stuff
+      if (self.downloader_count < 1):
+         senders = []
+      elif (regular and (len(regular) >= regular_count)):
+         ref_val = key(min(regular, key=key))
+         senders = [conn for conn in self.peer_connections
+            if ((not conn.p_interest) and (key(conn) > ref_val))]
       else:
-         downloaders = peer_connections[:rate_downloader_count]
-         peer_connections = peer_connections[rate_downloader_count:]
-         
-         if not (discard_optimistic_unchokes):
-            # Append currently optimistically unchoked connections to new
-            # downloader list
-            for conn in self.downloaders[-self.optimistic_unchoke_count:]:
-               if ((conn in self.peer_connections) and (conn.p_interest)):
-                  peer_connections.append(conn)
-         
-         while ((peer_connections != []) and (len(downloaders) < self.downloader_count)):
-            index = random.randint(0, len(peer_connections) - 1)
-            downloaders.append(peer_connections.pop(index))
+         senders = [conn for conn in self.peer_connections if (not conn.p_interest)]
+      
+      self._downloaders_set(regular, optimistic, senders)
+   
+   def _downloaders_set(self, regular, optimistic, senders):
+      """Choke and unchoke connections as necessary to make the specified
+         sets of connections our downloaders and senders"""
+      downloaders = regular + optimistic
+      downloaders_set = set(downloaders)
+      senders = set(senders)
       
       for conn in self.downloaders:
-         if not (conn in downloaders):
+         if not (conn in downloaders_set):
             self.log(10, 'Calling uploading_stop() on {0}.'.format(conn))
             conn.uploading_stop(not (conn in senders))
       
       for conn in downloaders:
          if not (conn in self.downloaders):
             conn.uploading_start()
-
-      # Tell non-interested high-upload peers that we'd be willing to send them stuff
+      
       for conn in senders:
          if (conn.p_choked):
             conn.choke_send(False)
       
-      for conn in copy.copy(self.senders):
-         if ((not conn in senders) and (not conn in downloaders)):
+      for conn in self.senders:
+         if ((not conn in senders) and (not conn in downloaders_set)):
             conn.uploading = True
             conn.uploading_stop(True)
-
+      
       # Discard connections that where open when we entered this loop, but have
       # been closed since then because of one of our calls to them.
       self.senders = set(c for c in senders if (c in self.peer_connections))
-      self.downloaders = [c for c in downloaders if (c in self.peer_connections)]
-      
-      downloader_count = len(downloaders)
-      
+      self.downloaders_regular = [c for c in regular if (c in self.peer_connections)]
+      self.downloaders_optimistic = [c for c in optimistic if (c in self.peer_connections)]
+      self.downloaders = self.downloaders_regular + self.downloaders_optimistic
+      self._downloaders_index_fix()
+   
+   def _downloaders_index_fix(self):
+      """Make sure downloaders_index is valid"""
+      downloader_count = len(self.downloaders)
       # Count of downloaders may have fallen
       if (downloader_count > 0):
          self.downloaders_index %= downloader_count
       else:
          self.downloaders_index = 0
    
+   def downloader_remove(self, conn):
+      """Take upload slot away from connection that is no longer interested
+         or closed, and pass it on to the best waiting peer"""
+      if not (conn in self.downloaders):
+         return
+      if (conn in self.downloaders_regular):
+         self.downloaders_regular.remove(conn)
+      else:
+         self.downloaders_optimistic.remove(conn)
+      self.downloaders = self.downloaders_regular + self.downloaders_optimistic
+      self._downloaders_index_fix()
+      
+      if (conn in self.peer_connections):
+         # Keep it unchoked, so it can start requesting right away if it
+         # changes its mind.
+         conn.uploading_stop(False)
+         self.senders.add(conn)
+      self.downloader_slots_fill()
+   
+   def downloader_slots_fill(self):
+      """Hand out any unused upload slots to waiting interested peers"""
+      if ((not self.uploading) or (len(self.downloaders) >= self.downloader_count)):
+         return
+      key = self._choke_key_get()
+      candidates = [conn for conn in self.peer_connections
+         if (conn.p_interest and (not (conn in self.downloaders)))]
+      regular_count = max(self.downloader_count - self.optimistic_unchoke_count, 0)
+      while (candidates and (len(self.downloaders) < self.downloader_count)):
+         conn = max(candidates, key=key)
+         candidates.remove(conn)
+         if (len(self.downloaders_regular) < regular_count):
+            self.downloaders_regular.append(conn)
+         else:
+            self.downloaders_optimistic.append(conn)
+         self.downloaders = self.downloaders_regular + self.downloaders_optimistic
+         self.senders.discard(conn)
+         conn.uploading_start()
+   
+   def downloader_count_set(self, count):
+      """Set number of peers we upload to at any one time"""
+      if (count == self.downloader_count):
+         return
+      self.downloader_count = count
+      self.optimistic_unchoke_count = min(
+         int(math.ceil(count*self.optimistic_unchoke_rate)), max(count - 1, 0))
+      if (len(self.downloaders) > count):
+         self.downloaders_update()
+      else:
+         self.downloader_slots_fill()
+   
+   def upload_slots_demand_get(self):
+      """Return number of upload slots we could currently make use of"""
+      if not (self.active and self.init_done and self.uploading):
+         return 0
+      return len([conn for conn in self.peer_connections if conn.p_interest])
+   
+   def sender_promote(self, conn):
+      """Start uploading to unchoked connection that has started requesting
+         blocks, choking our worst regular downloader if necessary and
+         choke_churn_max allows it"""
+      self.senders.discard(conn)
+      if (self.downloader_count < 1):
+         # All of our upload slots have been taken away since we unchoked it.
+         if not (conn.p_choked):
+            conn.choke_send(True)
+         return
+      if (len(self.downloaders) >= self.downloader_count):
+         if (self.choke_swaps >= self.choke_churn_max):
+            # Out of slot reassignments for this round; it can compete for
+            # a slot in the next one.
+            conn.uploading = True
+            conn.uploading_stop(True)
+            return
+         self.choke_swaps += 1
+         key = self._choke_key_get()
+         if (self.downloaders_regular):
+            worst = min(self.downloaders_regular, key=key)
+            self.downloaders_regular.remove(worst)
+         else:
+            worst = self.downloaders_optimistic.pop(0)
+         self.downloaders = self.downloaders_regular + self.downloaders_optimistic
+         worst.uploading_stop(True)
+      
+      self.downloaders_regular.append(conn)
+      self.downloaders = self.downloaders_regular + self.downloaders_optimistic
+      self._downloaders_index_fix()
+      conn.uploading_start()
+   
    def timer_announce_set(self, interval):
       """Set timer for a new announce request in <interval>"""
+      if not (self.announce_scheduler is None):
+         self.announce_scheduler.announce_schedule(self, interval)
+         return
       if (self.timer_announce):
          try:
             self.timer_announce.cancel()
@@ -1952,6 +2884,9 @@ class BTorrentHandler:
       if (self.timer_maintenance):
          self.timer_maintenance.cancel()
       self.timer_maintenance = self.event_dispatcher.set_timer(self.maintenance_interval, self.maintenance_perform, parent=self, persist=True, align=True)
+      if (self.timer_choke):
+         self.timer_choke.cancel()
+      self.timer_choke = self.event_dispatcher.set_timer(self.choke_interval, self.choke_round_perform, parent=self, persist=True)
       
    def maintenance_perform(self):
       """Perform various maintenance tasks"""
@@ -1969,55 +2904,103 @@ class BTorrentHandler:
          if (not conn):
             continue
          conn.maintenance_perform()
-      
-      self.downloaders_update()
-      #for conn in self.downloaders:
-      #   conn.read_blocks(force=True)
+         if (conn and conn.handshake_processed and
+             (not conn.super_seed_pieces) and self.super_seeding_active()):
+            # Peer may not have sent a bitfield.
+            self.super_seed_offer(conn)
       
    def peer_connections_start(self):
       """Connect to more peers if we don't have sufficient connections yet."""
       if (not self.active):
          return
-      
-      self.log(15, 'BTH {0} is starting connect sequence.'.format(self))
-      peers_connected_count = len(self.peer_connections)
-      peers_available_count = len(self.peers_known)
-      
-      peers_wanted_count = self.peer_connection_count_target - peers_connected_count
-      if (peers_wanted_count <= 0):
+      if (len(self.peer_connections) >= self.peer_connection_count_target):
          return
       
-      peers_connected = set([conn.btpeer for conn in self.peer_connections])
-      peers_targeted = list(self.peers_known - peers_connected)
-      random.shuffle(peers_targeted)
-      
-      peers_wanted_count = min(peers_wanted_count, len(peers_targeted))
+      if not (self.connection_pacer is None):
+         # Connections will be opened as the pacer sees fit.
+         self.connection_pacer.bth_want(self)
+         return
       
-      for i in range(peers_wanted_count):
-         if (len(self.peer_connections) >= self.peer_connection_count_target):
-            break
-         peer = peers_targeted[i]
+      self.log(15, 'BTH {0} is starting connect sequence.'.format(self))
+      self.peers_connect_queue = []
+      while (self.peer_connection_open()):
+         pass
+   
+   def peer_connection_open(self):
+      """Open connection to the best known peer we aren't connected to yet;
+         returns the new connection, or None if we have enough connections or
+         no peers left to try"""
+      while (self.active and
+            (len(self.peer_connections) < self.peer_connection_count_target)):
+         peers_connected = set([conn.btpeer for conn in self.peer_connections])
+         if not (self.peers_connect_queue):
+            self.peers_connect_queue = self.peers_known.peers_connectable_get(
+               self.peer_connection_count_target - len(self.peer_connections),
+               peers_connected)
+            if not (self.peers_connect_queue):
+               return None
+            self.peers_connect_queue.reverse()
+         
+         peer = self.peers_connect_queue.pop()
+         if (peer in peers_connected):
+            continue
          self.log(15, 'BTH {0} is opening connection to peer {1!a}.'.format(self, peer))
+         self.peers_known.connect_start(peer)
          try:
-            conn = BTClientConnection.peer_connect(self.event_dispatcher,peer.address_get())
+            conn = BTClientConnection.peer_connect(self.event_dispatcher,
+               peer.address_get(), family=peer.family_get())
          except socket.error as exc:
             self.log(30, 'BTH {0} failed to connect to {1!a} with error "{2}"'.format(self, peer, exc))
+            self.peers_known.failure_record(peer)
             continue
          conn.info_hash = self.metainfo.info_hash
          conn.bandwidth_logger_in = self.bandwidth_logger_in
          self.connection_add(conn)
          conn.handshake_send()
+         return conn
+      return None
+   
+   def pex_peers_get(self):
+      """Return set of compact addresses of connected peers that accept
+         connections, as far as we know them"""
+      rv = set()
+      for conn in self.peer_connections:
+         if not (conn.handshake_processed):
+            continue
+         address = conn.pex_address_get()
+         if not (address is None):
+            rv.add(address)
+      return rv
+   
+   def pex_peers_process(self, conn, tables):
+      """Add peers learned from conn by peer exchange to our known peers"""
+      count = len(self.peers_known)
+      for table in tables:
+         self.peers_known.peers_add(table)
+      count_new = len(self.peers_known) - count
+      self.log(12, 'BTH {0} learned {1} new peers from {2} by PEX.'.format(self, count_new, conn))
+      if ((count_new > 0) and self.active and
+            (len(self.peer_connections) < self.peer_connection_count_target)):
+         # Consider new peers on our next connect.
+         self.peers_connect_queue = []
+         self.peer_connections_start()
+   
+   def peer_connection_established(self, conn):
+      """Process handshake of peer on an outgoing connection"""
+      if not (self.connection_pacer is None):
+         self.connection_pacer.connection_established(conn)
       
    def peer_connection_error_process(self, connection):
       """Process a serious error from a peer we connected (or tried to) to."""
       if (connection.btpeer in self.peers_known):
-         self.log(12, 'Removing peer {0!a} from known list of bth {1} as a result of error condition.'.format(connection.btpeer, self))
-         self.peers_known.remove(connection.btpeer)
+         self.log(12, 'Backing off from peer {0!a} of bth {1} as a result of error condition.'.format(connection.btpeer, self))
+         self.peers_known.failure_record(connection.btpeer)
       
    def tracker_conn_response_process(self, tr, data):
       """Process data from successful announce"""
       self.tr = None
       self.timer_announce = None
+      self.announce_finish()
       an_urls_tier = self.metainfo.announce_urls[self.tier]
       an_url = an_urls_tier[self.tier_index]
       # announce target reordering
@@ -2028,6 +3011,14 @@ class BTorrentHandler:
          self.tier_index = 0
       self.tracker_valid = True
       
+      interval = self.tracker_response_data_process(tr, an_url, data)
+      if (self.active):
+         self.timer_announce_set(interval)
+         self.peer_connections_start()
+   
+   def tracker_response_data_process(self, tr, an_url, data):
+      """Take peers and tracker id from announce response; returns interval
+         to wait for until the next announce"""
       self.log(10, 'Processing response {0!a}.'.format(data))
       if (b'min interval' in data):
          delay_min = int(data[b'min interval'])
@@ -2037,8 +3028,15 @@ class BTorrentHandler:
       if (b'tracker id' in data):
          self.trackerid = data[b'tracker id']
       
-      for peer in data[b'peers']:
-         self.peers_known.add(peer)
+      self.swarm_stats_update(data)
+      
+      self.peers_known.peers_add(data[b'peers'])
+      if (b'peers6' in data):
+         self.peers_known.peers_add(data[b'peers6'])
+      # Consider new peers on our next connect.
+      self.peers_connect_queue = []
+      for (host, port, peer_id) in data.get(b'peers_hostname', ()):
+         self.peer_hostname_resolve(host, port, peer_id)
       
       if (self.interval_override):
          interval = max(self.interval_override, delay_min)
@@ -2049,17 +3047,95 @@ class BTorrentHandler:
             interval = self.announce_min_interval
       else:
          interval = self.announce_default_interval
+      return interval
+   
+   def tracker_parallel_response_process(self, tr, an_url, data):
+      """Process data from successful announce in parallel mode"""
+      del(self.trs[an_url])
+      if not (self.trs):
+         self.announce_finish()
+      self.tracker_backoff.pop(an_url, None)
+      self.log(20, 'TrackerRequest from {0} to {1!a} got response.'.format(self, an_url))
+      # announce target reordering
+      for (tier, an_urls_tier) in enumerate(self.metainfo.announce_urls):
+         if (an_url in an_urls_tier):
+            an_urls_tier.remove(an_url)
+            an_urls_tier.insert(0, an_url)
+            self.tier = tier
+            self.tier_index = 0
+            break
+      self.tracker_valid = True
       
-      if (self.active):
+      interval = self.tracker_response_data_process(tr, an_url, data)
+      if not (self.active):
+         return
+      if not (self.announce_round_success):
+         # First response in this round; the others only contribute peers.
+         self.announce_round_success = True
          self.timer_announce_set(interval)
-         
-         if (not self.peer_connections):
-            self.peer_connections_start()
+      self.peer_connections_start()
+   
+   def tracker_parallel_error_process(self, tr, an_url):
+      """Process an error occuring during announce in parallel mode"""
+      del(self.trs[an_url])
+      if not (self.trs):
+         self.announce_finish()
+      (failures, ts_retry) = self.tracker_backoff.get(an_url, (0, None))
+      failures += 1
+      delay = min(self.announce_retry_interval*2**(failures - 1),
+         self.announce_backoff_max)
+      self.tracker_backoff[an_url] = (failures, time.time() + delay)
+      self.log(25, 'TrackerRequest from {0} to {1!a} failed; failure count is {2}.'.format(self, an_url, failures))
+      if (self.trs or self.announce_round_success):
+         return
+      
+      # Nobody answered in this round.
+      self.tracker_valid = False
+      if (self.active):
+         self.timer_announce_set(self.announce_retry_interval)
+   
+   def _tracker_parallel_callbacks_build(self, tr, an_url):
+      def result_cb(tr_, data):
+         if (self.trs.get(an_url) is tr):
+            self.tracker_parallel_response_process(tr, an_url, data)
+      def error_cb(*args):
+         if (self.trs.get(an_url) is tr):
+            self.tracker_parallel_error_process(tr, an_url)
+      return (result_cb, error_cb)
+   
+
+   def swarm_stats_update(self, stats):
+      """Take swarm statistics from scrape or announce response data"""
+      if not ((b'complete' in stats) or (b'incomplete' in stats)):
+         return
+      for (key, name) in ((b'complete', 'swarm_seeders'),
+            (b'incomplete', 'swarm_leechers'),
+            (b'downloaded', 'swarm_downloaded')):
+         if (key in stats):
+            setattr(self, name, int(stats[key]))
+      self.ts_swarm_update = int(time.time())
+   
+   def peer_hostname_resolve(self, host, port, peer_id):
+      """Look up peer specified by hostname, and add it to our known peers"""
+      if (self.resolver is None):
+         self.log(20, "{0} can't look up hostname {1!a} of peer without resolver; discarding peer.".format(self, host))
+         return
+      
+      def cb(req):
+         if not (req.addrinfo and self.active):
+            return
+         peer = BTPeer(req.addrinfo[0][4][0].encode('ascii'), port, peer_id)
+         self.log(12, '{0} resolved hostname {1!a} to peer {2}.'.format(self, host, peer))
+         self.peers_known.add(peer)
       
+      self.resolver.resolve(host, port, cb, family=socket.AF_INET,
+         type=socket.SOCK_STREAM)
+   
    def tracker_conn_error_process(self, tr):
       """Process an error occuring during announce procedure"""
       self.tr = None
       self.timer_announce = None
+      self.announce_finish()
       self.log(25, 'TrackerRequest from {0} to {1!a} failed.'.format(self, self.announce_url_get()))
       
       if (self.tracker_valid):
@@ -2088,7 +3164,54 @@ class BTorrentHandler:
    def announce_url_get(self):
       """Get announce url of currently preferred tracker"""
       return self.metainfo.announce_urls[self.tier][self.tier_index]
-      
+   
+   def announce_urls_parallel_get(self):
+      """Get announce urls to contact in parallel announce mode"""
+      an_urls = self.metainfo.announce_urls
+      if (self.tracker_valid):
+         return list(an_urls[self.tier])
+      return [an_url for an_urls_tier in an_urls for an_url in an_urls_tier]
+   
+   def announce_parallel_set(self, announce_parallel):
+      """Turn parallel announce mode on or off"""
+      announce_parallel = bool(announce_parallel)
+      if (announce_parallel == self.announce_parallel):
+         return
+      self.announce_parallel = announce_parallel
+      if not (announce_parallel):
+         round_pending = bool(self.trs)
+         self.trackers_parallel_close()
+         self.tracker_backoff = {}
+         if (round_pending):
+            # None of the dropped requests will call us back, so finish the
+            # round here and try again in regular mode.
+            self.announce_finish()
+            if (self.active):
+               self.timer_announce_set(self.announce_retry_interval)
+   
+   def trackers_parallel_close(self):
+      """Abort pending parallel announce requests"""
+      for tr in self.trs.values():
+         tr.close()
+      self.trs = {}
+      
+   def announce_queue(self):
+      """Announce ourselves to our tracker as soon as our announce scheduler
+         allows, or immediately if we don't have one"""
+      if (self.announce_scheduler is None):
+         self.client_announce_tracker()
+         return
+      if (self.announce_scheduler.bth_scheduled(self)):
+         event = None
+      else:
+         event = b'started'
+      self.announce_scheduler.announce_schedule(self, 0, event)
+   
+   def announce_finish(self):
+      """Tell our announce scheduler that our current announce is done"""
+      if not (self.announce_scheduler is None):
+         self.announce_scheduler.announce_finish(self)
+   
    def client_announce_tracker(self, event=None, event_force=False):
       """Announce ourselves to currently preferred tracker"""
       if (self.tr):
@@ -2103,12 +3226,54 @@ class BTorrentHandler:
       elif (not event_force):
          event = b'started'
       
+      if (self.announce_parallel):
+         self.client_announce_trackers(event)
+         return
+      
       self.tr = tracker_request_build(self.announce_url_get(), self.metainfo.info_hash,
             self.peer_id, self.port, self.content_bytes_out,
             self.content_bytes_in, self.bytes_left, trackerid=self.trackerid,
             compact=True, key=self.announce_key, event=event)
       self.tr.request_send(self.event_dispatcher,
-         self.tracker_conn_response_process, self.tracker_conn_error_process)
+         self.tracker_conn_response_process, self.tracker_conn_error_process,
+         resolver=self.resolver, udp_mux=self.udp_tracker_mux,
+         http_pool=self.http_client_pool)
+
+   def client_announce_trackers(self, event=None):
+      """Announce ourselves to several trackers at once"""
+      self.trackers_parallel_close()
+      self.announce_round_success = False
+      now = time.time()
+      ts_retry_min = None
+      for an_url in self.announce_urls_parallel_get():
+         if ((an_url in self.tracker_backoff) and (event != b'stopped')):
+            ts_retry = self.tracker_backoff[an_url][1]
+            if (ts_retry > now):
+               if ((ts_retry_min is None) or (ts_retry < ts_retry_min)):
+                  ts_retry_min = ts_retry
+               continue
+         
+         self.trs[an_url] = tracker_request_build(an_url,
+            self.metainfo.info_hash, self.peer_id, self.port,
+            self.content_bytes_out, self.content_bytes_in, self.bytes_left,
+            trackerid=self.trackerid, compact=True, key=self.announce_key,
+            event=event)
+      
+      if not (self.trs):
+         self.log(25, '{0} has no trackers to announce to outside of their backoff period.'.format(self))
+         self.announce_finish()
+         if (self.active and not (ts_retry_min is None)):
+            self.timer_announce_set(max(ts_retry_min - now,
+               self.announce_min_interval))
+         return
+      
+      # Errors can be reported synchronously, so don't iterate over self.trs
+      # directly.
+      for (an_url, tr) in tuple(self.trs.items()):
+         (result_cb, error_cb) = self._tracker_parallel_callbacks_build(tr, an_url)
+         tr.request_send(self.event_dispatcher, result_cb, error_cb,
+            resolver=self.resolver, udp_mux=self.udp_tracker_mux,
+            http_pool=self.http_client_pool)
 
    def connection_add(self, conn):
       """Add an open client connection to this handler."""
@@ -2129,17 +3294,23 @@ class BTorrentHandler:
       """Forget about a tracked connection"""
       self.log(15, 'Removing conn {0}.'.format(conn))
       self.peer_connections.remove(conn)
+      if not (self.connection_pacer is None):
+         self.connection_pacer.connection_close(conn)
+         if (self.active):
+            # Replace it soon.
+            self.connection_pacer.bth_want(self,
+               self.connection_pacer.backfill_delay)
+      if (conn.outgoing and not (conn.failed)):
+         if (conn.ts_handshake is None):
+            handshake_latency = None
+         else:
+            handshake_latency = conn.ts_handshake - conn.ts_start
+         self.peers_known.connection_record(conn.btpeer, handshake_latency,
+            conn.content_bytes_in, time.time() - conn.ts_start)
       self.content_bytes_in += conn.content_bytes_in
       self.content_bytes_out += conn.content_bytes_out
-      if (conn in self.senders):
-         self.senders.remove(conn)
-      if (conn in self.downloaders):
-         self.downloaders.remove(conn)
-         if (self.downloaders):
-            self.downloaders_index %= len(self.downloaders)
-         else:
-            self.downloaders_index = 0
-         self.downloaders_update(discard_optimistic_unchokes=False)
+      self.senders.discard(conn)
+      self.downloader_remove(conn)
       
    def close(self):
       if (self.active):
@@ -2166,6 +3337,8 @@ class BTClient:
    logger = logging.getLogger('BTClient')
    log = logger.log
    maintenance_interval = MAINTENANCE_INTERVAL
+   # Interval in seconds between reallocations of global upload slots
+   upload_slots_interval = 10
    def __init__(self, bth_archiver=None, *args):
       self.sa = None
       self.event_dispatcher = None
@@ -2177,7 +3350,17 @@ class BTClient:
       self.el_pickle_shutdown = None
       self.timer_pickle = None
       self.timer_maintenance = None
+      self.timer_upload_slots = None
+      self.timer_scrape = None
+      self.scrape_requests = set()
+      self.bandwidth_clock = None
       self.bandwidth_logger_in = None
+      self.hash_pool = None
+      self.resolver = None
+      self.udp_tracker_mux = None
+      self.http_client_pool = None
+      self.announce_scheduler = None
+      self.connection_pacer = None
       self.em_bth_add = EventMultiplexer(self)
       self.em_bth_remove = EventMultiplexer(self)
       self.em_bth_download_finish = EventMultiplexer(self)
@@ -2191,6 +3374,22 @@ class BTClient:
       self.backlog = None
       self.bwm_cycle_length = None
       self.bwm_history_length = None
+      self.hash_workers = None
+      self.hash_workers_processes = None
+      self.validation_chunk_length = None
+      self.validation_depth = None
+      self.validation_background = None
+      self.validation_background_delay = None
+      self.resume_basepath = None
+      self.upload_slots = None
+      self.upload_slots_torrent_min = None
+      self.upload_rate_max = None
+      self.download_rate_max = None
+      self.scrape_interval = None
+      self.announces_active_max = None
+      self.connections_half_open_max = None
+      self.bucket_out = None
+      self.bucket_in = None
       self.bth_archiver = bth_archiver
    
    def torrent_infohashes_update(self):
@@ -2206,6 +3405,31 @@ class BTClient:
          self.em_bth_download_finish(bth)
       return bth.em_download_finish.new_listener(cb)
    
+   def _bth_io_start(self, bth):
+      """Call io_start() on specified BTH with our settings"""
+      if ((bth.resume_data is None) and (not (self.resume_basepath is None))):
+         rd = resume_data_load(self.resume_basepath, bth.metainfo.info_hash)
+         if not (rd is None):
+            try:
+               bth.resume_data_use(rd)
+            except ValueError as exc:
+               self.log(30, "{0} can't use resume data for {1}: {2}".format(self, bth, exc))
+            else:
+               self.log(20, '{0} loaded resume data {1!a} for {2}.'.format(self, rd, bth))
+      bth.io_start(self.sa, self.data_basepath,
+         self.server.sock.getsockname()[1], self._btdiskio_build,
+         hash_pool=self.hash_pool,
+         validation_chunk_length=self.validation_chunk_length,
+         validation_depth=self.validation_depth,
+         validation_background=self.validation_background,
+         validation_background_delay=self.validation_background_delay,
+         bucket_out_parent=self.bucket_out, bucket_in_parent=self.bucket_in,
+         bandwidth_clock=self.bandwidth_clock, resolver=self.resolver,
+         udp_tracker_mux=self.udp_tracker_mux,
+         http_client_pool=self.http_client_pool,
+         announce_scheduler=self.announce_scheduler,
+         connection_pacer=self.connection_pacer)
+   
    def connections_start(self, sa, btc_config):
       """Open server socket and call io_start() on all inactive BTHs"""
       assert (self.server is None)
@@ -2214,9 +3438,30 @@ class BTClient:
       self.data_basepath = btc_config.data_basepath
       self.sa = sa
       self.event_dispatcher = sa.ed
+      # Shared by all of our bandwidth loggers, to avoid running two timers
+      # per torrent.
+      self.bandwidth_clock = BandwidthClock(self.event_dispatcher,
+         self.bwm_cycle_length)
       self.bandwidth_logger_in = NullBandwidthLimiter(self.event_dispatcher,
          cycle_length=self.bwm_cycle_length, 
-         history_length=self.bwm_history_length)
+         history_length=self.bwm_history_length, clock=self.bandwidth_clock)
+      # Client-wide limits; only set up if configured, so torrents can keep
+      # their configured bandwidth loggers otherwise.
+      if not (self.upload_rate_max is None):
+         self.bucket_out = TokenBucket(self.upload_rate_max)
+      if not (self.download_rate_max is None):
+         self.bucket_in = TokenBucket(self.download_rate_max)
+      self.resolver = AsyncResolver(self.event_dispatcher)
+      self.udp_tracker_mux = UDPTrackerMux(self.event_dispatcher)
+      self.http_client_pool = HTTPClientPool(self.event_dispatcher,
+         self.resolver)
+      self.announce_scheduler = AnnounceScheduler(self.event_dispatcher,
+         self.announces_active_max)
+      self.connection_pacer = ConnectionPacer(self.event_dispatcher,
+         self.connections_half_open_max)
+      if (self.hash_workers):
+         self.hash_pool = WorkerPool(self.event_dispatcher, self.hash_workers,
+            processes=self.hash_workers_processes)
       
       self.server = AsyncSockServer(self.event_dispatcher,
          (self.host, self.port), backlog=self.backlog)
@@ -2225,18 +3470,25 @@ class BTClient:
       self.timer_maintenace = self.event_dispatcher.set_timer(
          self.maintenance_interval, self.maintenance_perform, parent=self,
          persist=True)
+      if (self.upload_slots):
+         self.timer_upload_slots = self.event_dispatcher.set_timer(
+            self.upload_slots_interval, self.upload_slots_allocate,
+            parent=self, persist=True)
+      if (self.scrape_interval):
+         self.timer_scrape = self.event_dispatcher.set_timer(
+            self.scrape_interval, self.scrape_perform, parent=self,
+            persist=True)
       
       for bth in self.torrents.values():
          if not (bth.init_started):
             self._bth_link_em_df(bth)
-            bth.io_start(sa, self.data_basepath, self.server.sock.getsockname()[1],
-               self._btdiskio_build)
+            self._bth_io_start(bth)
    
    def bths_reannounce_tracker(self):
       """Tell each active BTH managed by this instance to send an announce to their tracker"""
       for bth in self.torrents.values():
          if (bth.active and bth.init_done):
-            bth.client_announce_tracker()
+            bth.announce_queue()
    
    def pickling_shedule(self, pickler):
       """Start pickling to stream at regular intervals and program shutdown"""
@@ -2252,6 +3504,146 @@ class BTClient:
       for conn in self.connections_uk.copy():
          conn.maintenance_perform()
    
+   def scrape_perform(self):
+      """Scrape trackers of all of our torrents, batching the info hashes of
+         torrents which share a tracker"""
+      self.scrape_requests_close()
+      an_urls = {}
+      for bth in self.torrents.values():
+         an_urls.setdefault(bth.announce_url_get(), []).append(
+            bth.metainfo.info_hash)
+      
+      for (an_url, info_hashes) in an_urls.items():
+         try:
+            count_max = scrape_request_info_hashes_max(an_url)
+         except (KeyError, ValueError):
+            continue
+         for i in range(0, len(info_hashes), count_max):
+            try:
+               tr = tracker_scrape_request_build(an_url,
+                  info_hashes[i:i+count_max])
+            except ValueError as exc:
+               self.log(15, "{0} can't scrape tracker {1!a}: {2}".format(self, an_url, exc))
+               break
+            self.scrape_requests.add(tr)
+            (result_cb, error_cb) = self._scrape_callbacks_build(tr)
+            tr.request_send(self.event_dispatcher, result_cb, error_cb,
+               resolver=self.resolver, udp_mux=self.udp_tracker_mux,
+            http_pool=self.http_client_pool)
+   
+   def _scrape_callbacks_build(self, tr):
+      def result_cb(tr_, data):
+         self.scrape_requests.discard(tr)
+         self.scrape_result_process(tr, data)
+      def error_cb(*args):
+         self.scrape_requests.discard(tr)
+         self.log(20, '{0} failed to scrape {1!a}.'.format(self, tr.announce_url))
+      return (result_cb, error_cb)
+   
+   def scrape_result_process(self, tr, data):
+      """Pass scrape results on to our BTHs"""
+      for (info_hash, stats) in data.items():
+         try:
+            bth = self.torrents[info_hash]
+         except KeyError:
+            continue
+         bth.swarm_stats_update(stats)
+   
+   def scrape_requests_close(self):
+      """Abort pending scrape requests"""
+      for tr in self.scrape_requests:
+         tr.close()
+      self.scrape_requests = set()
+   
+   def upload_slots_allocate(self):
+      """Distribute our global upload slots over our torrents, according to
+         their current demand and upload slot weights"""
+      demand = {}
+      for bth in self.torrents.values():
+         d = bth.upload_slots_demand_get()
+         if (d > 0):
+            demand[bth] = d
+      alloc = dict((bth, 0) for bth in self.torrents.values())
+      slots = self.upload_slots
+      
+      # Make sure each torrent with interested peers gets a minimum number of
+      # slots; if there aren't enough for that, favor those with higher
+      # weights, and pick randomly among equal ones.
+      bths = list(demand.keys())
+      random.shuffle(bths)
+      bths.sort(key=lambda bth: bth.upload_slot_weight, reverse=True)
+      for bth in bths:
+         if (slots < 1):
+            break
+         a = min(self.upload_slots_torrent_min, demand[bth], slots)
+         alloc[bth] = a
+         slots -= a
+      
+      # Hand out the rest proportionally to weights, without exceeding demand.
+      bths = [bth for bth in bths if (alloc[bth] < demand[bth])]
+      while ((slots > 0) and bths):
+         weight_sum = sum(bth.upload_slot_weight for bth in bths)
+         if (weight_sum <= 0):
+            break
+         slots_prev = slots
+         for bth in bths:
+            a = min(int(slots_prev*bth.upload_slot_weight/weight_sum),
+               demand[bth] - alloc[bth], slots)
+            alloc[bth] += a
+            slots -= a
+         if (slots == slots_prev):
+            # Rounding ate all of the shares; hand out single slots in order
+            # of weight instead.
+            for bth in bths:
+               if (slots < 1):
+                  break
+               alloc[bth] += 1
+               slots -= 1
+         bths = [bth for bth in bths if (alloc[bth] < demand[bth])]
+      
+      for (bth, count) in alloc.items():
+         bth.downloader_count_set(count)
+   
+   def bth_upload_rate_max_set(self, info_hash, rate, peer_rate):
+      """Set upload limits of specified BTH"""
+      self.torrents[info_hash].upload_rate_max_set(rate, peer_rate)
+   
+   def upload_rate_max_set(self, rate):
+      """Set global upload limit; None for no limit"""
+      self.upload_rate_max = rate
+      if not (self.bucket_out is None):
+         self.bucket_out.rate_set(rate)
+      elif not ((rate is None) or (self.sa is None)):
+         self.bucket_out = TokenBucket(rate)
+         self.log(30, '{0} set up global upload limit; it will apply to running torrents after their restart.'.format(self))
+   
+   def bth_download_rate_max_set(self, info_hash, rate):
+      """Set download limit of specified BTH"""
+      self.torrents[info_hash].download_rate_max_set(rate)
+   
+   def download_rate_max_set(self, rate):
+      """Set global download limit; None for no limit"""
+      self.download_rate_max = rate
+      if not (self.bucket_in is None):
+         self.bucket_in.rate_set(rate)
+      elif not ((rate is None) or (self.sa is None)):
+         self.bucket_in = TokenBucket(rate)
+         self.log(30, '{0} set up global download limit; it will apply to running torrents after their restart.'.format(self))
+   
+   def bth_super_seeding_set(self, info_hash, super_seeding):
+      """Turn super-seeding mode of specified BTH on or off"""
+      self.torrents[info_hash].super_seeding_set(super_seeding)
+   
+   def bth_announce_parallel_set(self, info_hash, announce_parallel):
+      """Turn parallel announce mode of specified BTH on or off"""
+      self.torrents[info_hash].announce_parallel_set(announce_parallel)
+   
+   def bth_upload_slot_weight_set(self, info_hash, weight):
+      """Set upload slot weight of specified BTH"""
+      if (weight < 0):
+         raise ValueError('Invalid upload slot weight {0!a}.'.format(weight))
+      self.torrents[info_hash].upload_slot_weight = weight
+   
    def connection_remove(self, conn):
       """Process closing of a uk connection."""
       self.connections_uk.remove(conn)
@@ -2282,8 +3674,7 @@ class BTClient:
          raise DupeError("I'm already tracking torrent {0} with same info_hash {1!a} as in specified metainfo.".format(self, metainfo.info_hash))
       bth = BTorrentHandler(metainfo=metainfo, active=active, *bth_args, **bth_kwargs)
       if not (self.event_dispatcher is None):
-         bth.io_start(self.sa, self.data_basepath, self.server.sock.getsockname()[1],
-            self._btdiskio_build)
+         self._bth_io_start(bth)
       
       self.torrents[metainfo.info_hash] = bth
       self.torrent_infohashes_update()
@@ -2337,8 +3728,8 @@ class BTClient:
       """Seek picklestream to position 0, and dump a serialization of this
          instance to it"""
       for bth in self.torrents.values():
-         if (bth.piecemask_validate and bth.init_done):
-            bth.piecemask_validate = False #FIXME: should be done cleanly by the time liasis enters production
+         if (bth.init_done):
+            bth.resume_data_update()
       
       self.pickler(self)
 
@@ -2368,13 +3759,44 @@ class BTClient:
       self.torrents = {}
       self.torrent_infohashes_update()
       
-      for timer in (self.timer_pickle, self.timer_maintenance):
-         timer.cancel()
+      if not (self.hash_pool is None):
+         self.hash_pool.close()
+         self.hash_pool = None
+      if not (self.resolver is None):
+         self.resolver.close()
+         self.resolver = None
+      self.scrape_requests_close()
+      if not (self.udp_tracker_mux is None):
+         self.udp_tracker_mux.close()
+         self.udp_tracker_mux = None
+      if not (self.http_client_pool is None):
+         self.http_client_pool.close()
+         self.http_client_pool = None
+      if not (self.announce_scheduler is None):
+         self.announce_scheduler.close()
+         self.announce_scheduler = None
+      if not (self.connection_pacer is None):
+         self.connection_pacer.close()
+         self.connection_pacer = None
+      
+      for timer in (self.timer_pickle, self.timer_maintenance,
+            self.timer_upload_slots, self.timer_scrape):
+         if not (timer is None):
+            timer.cancel()
       
       self.el_pickle_shutdown.close()
       self.el_pickle_shutdown = None
       self.timer_pickle = None
       self.timer_maintenance = None
+      self.timer_upload_slots = None
+      self.timer_scrape = None
+      
+      if not (self.bandwidth_logger_in is None):
+         self.bandwidth_logger_in.close()
+         self.bandwidth_logger_in = None
+      if not (self.bandwidth_clock is None):
+         self.bandwidth_clock.close()
+         self.bandwidth_clock = None
       
       self.em_bth_add.close()
       self.em_bth_remove.close()
@@ -2384,21 +3806,21 @@ class EABTClient(BTClient):
    """BT Client which aggregates events from managed BTHs
    
    The throughput-data for each BTH managed by this client will be sent as
-   events through self.em_throughput at the end of each cycle.
+   events through self.em_throughput at the end of each cycle of our
+   bandwidth clock; torrents that haven't been initialized yet are reported as
+   -1.
    call arguments: (listener,) btc, downstream_data, upstream_data
    """
    def __init__(self, *args, **kwargs):
       BTClient.__init__(self, *args, **kwargs)
-      self.__em_throughput = DSEventAggregator(0, parent=self)
-      self.__em_throughput_listener = self.__em_throughput.new_listener(
-         self.em_throughput_cycle_handle)
+      self.__em_throughput_listener = None
       self.em_throughput = EventMultiplexer(self)
    
    def __setstate__(self, *args, **kwargs):
       BTClient.__setstate__(self, *args, **kwargs)
 
    def em_throughput_cycle_handle(self):
-      """Handle throughput event from self.__em_throughput"""
+      """Handle cycle event from our bandwidth clock"""
       if (self.em_throughput.listeners == []):
          # Nobody cares, let's save some cycles
          return
@@ -2408,6 +3830,10 @@ class EABTClient(BTClient):
       
       for infohash in self.torrent_infohashes:
          bth = self.torrents[infohash]
+         if (bth.bandwidth_logger_in is None):
+            downstream_data.append(-1)
+            upstream_data.append(-1)
+            continue
          downstream_data.append(bth.bandwidth_logger_in[-1])
          upstream_data.append(bth.bandwidth_logger_out[-1])
       
@@ -2416,37 +3842,14 @@ class EABTClient(BTClient):
    def connections_start(self, *args, **kwargs):
       """Open server socket and call io_start() on all inactive BTHs"""
       BTClient.connections_start(self, *args, **kwargs)
-      self.__em_throughput.n = 0
-      reg = self.__em_throughput.multiplexer_register
-      for bth in self.torrents.values():
-         reg(bth.bandwidth_logger_in.em_cycle)
-         reg(bth.bandwidth_logger_out.em_cycle)
-         self.__em_throughput.n += 2
-
-   def torrent_add(self, *args, **kwargs):
-      """Instantiate BTorrentHandler and register and return created BTH"""
-      bth = BTClient.torrent_add(self, *args, **kwargs)
-      
-      self.__em_throughput.multiplexer_register(bth.bandwidth_logger_in.em_cycle)
-      self.__em_throughput.multiplexer_register(bth.bandwidth_logger_out.em_cycle)
-      self.__em_throughput.n += 2
-      return bth
-   
-   def torrent_drop(self, info_hash, *args, **kwargs):
-      """Remove BTH with specified info_hash"""
-      bth = self.torrents[info_hash]
-      #bli_ec = bth.bandwidth_logger_in.em_cycle
-      #blo_ec = bth.bandwidth_logger_out.em_cycle
-      
-      BTClient.torrent_drop(self, info_hash, *args, **kwargs)
-      
-      self.__em_throughput.n -= 2
-      #self.__em_throughput.multiplexer_unregister(bli_ec) # unneeded, done automatically on torrent close through close of multiplexers
-      #self.__em_throughput.multiplexer_unregister(blo_ec) # ditto
-      
+      self.__em_throughput_listener = \
+         self.bandwidth_clock.em_cycle.new_listener(
+         self.em_throughput_cycle_handle)
    
    def close(self):
       self.em_throughput.close()
-      self.__em_throughput.close()
+      if not (self.__em_throughput_listener is None):
+         self.__em_throughput_listener.close()
+         self.__em_throughput_listener = None
       BTClient.close(self)
 
@@ -29,6 +29,9 @@ liasis instance's state."""
 
 from .benc_structures import BTPeer, BTMetaInfo
 from .bt_piecemasks import *
+from .diskio import DiskIOStats
+from .peer_store import BTPeerStore
+from .stats_structures import EWMARate, LatencyHistogram
 
 def s2b(s):
    return s.encode('ascii')
@@ -161,13 +164,14 @@ class BTClientConnectionMirror(BaseMirror):
       (__state_var_s_bool, __state_var_ds_bool,
       ('s_interest', 's_choked', 's_snubbed', 'p_interest',
       'p_choked', 'handshake_processed', 'handshake_sent', 'sync_done',
-      'instance_init_done', 'downloading', 'uploading', 'ext_Fast',
+      'instance_init_done', 'downloading', 'uploading', 'ext_Fast', 'ext_LTEP',
       'mse_init', 'mse_init_done')),
       #int values
       (int, BaseMirror.state_ds_static_build(int), 
       ('buffer_input_len', 'content_bytes_in', 'content_bytes_out', 'ts_start',
       'ts_traffic_last_out', 'ts_traffic_last_in', 'ts_request_last_out', 'mse_cm',
-       'peer_req_count')),
+       'peer_req_count', 'outbuf_bytes', 'outbuf_bytes_reading', 'rate_in',
+       'rate_out')),
       #lists with directly valid subelements
       (list, BaseMirror.state_var_ds_identity, ('pieces_wanted', 'blocks_pending',
          'blocks_pending_out', 'pieces_suggested', 'pieces_allowed_fast')),
@@ -177,7 +181,13 @@ class BTClientConnectionMirror(BaseMirror):
       (BaseMirror.state_var_s_getstate,
       BaseMirror.state_var_ds_setstate_build(BitMask), ('piecemask',)),
       (BaseMirror.state_var_s_state_get,
-      BaseMirror.state_var_ds_bfs_build(BTPeer), ('btpeer',))
+      BaseMirror.state_var_ds_bfs_build(BTPeer), ('btpeer',)),
+      (BaseMirror.state_var_s_state_get,
+      BaseMirror.state_var_ds_bfs_build(EWMARate),
+      ('rate_ewma_in', 'rate_ewma_out')),
+      (BaseMirror.state_var_s_state_get,
+      BaseMirror.state_var_ds_bfs_build(LatencyHistogram),
+      ('latency_request',))
    )
    def __repr__(self):
       return '<{0} to {1} at {2} sent: {3} received: {4}>'.format(
@@ -200,12 +210,14 @@ class BTorrentHandlerMirror(BaseMirror):
       (int, __state_var_ds_bool,
       ('active', 'endgame_mode', 'download_complete', 'init_started',
       'init_done', 'uploading', 'peer_connection_count_target',
-      'peer_connections_start_delay')),
+      'peer_connections_start_delay', 'super_seeding', 'announce_parallel')),
       #int values
       (int, BaseMirror.state_ds_static_build(int),
       ('piece_count', 'pieces_have_count', 'bytes_left', 'downloader_count',
       'optimistic_unchoke_count', 'content_bytes_in', 'content_bytes_out', 
-      'tier', 'tier_index')),
+      'tier', 'tier_index', 'validation_bytes_total', 'validation_bytes_done',
+      'validation_rate', 'upload_slot_weight', 'swarm_seeders',
+      'swarm_leechers', 'swarm_downloaded', 'ts_swarm_update')),
       # str values
       (bytes, BaseMirror.state_var_ds_identity, ('peer_id', 'trackerid')),
       # special cases
@@ -219,8 +231,11 @@ class BTorrentHandlerMirror(BaseMirror):
       (BaseMirror.seq_state_var_s_state_get, 
       BaseMirror.seq_state_var_ds_bfs_build(BTClientConnectionMirror), 
       ('peer_connections',)),
-      (BaseMirror.seq_state_var_s_state_get,
-      BaseMirror.seq_state_var_ds_bfs_build(BTPeer), ('peers_known',))
+      # Peers are kept in compact form; don't build BTPeers for all of them.
+      (BaseMirror.state_var_s_state_get,
+      BaseMirror.state_var_ds_bfs_build(BTPeerStore), ('peers_known',)),
+      (BaseMirror.state_var_s_state_get,
+      BaseMirror.state_var_ds_bfs_build(DiskIOStats), ('disk_io_stats',))
    )
    
    def target_basename_get(self):
@@ -25,6 +25,7 @@ from .bt_client import EABTClient
 from . import benc_structures
 from .benc_structures import BTMetaInfo
 from .bt_piecemasks import BitMask
+from . import diskio
 from .cc_base import BTControlConnectionBase, BTControlConnectionError
 
 
@@ -167,16 +168,32 @@ class BTControlConnection(BTControlConnectionBase, AsyncDataStream):
       client_idx = self.client_nnint_get(args,0)
       torrent_infohash = args[1]
       max_len = self.client_nnint_get(args,2)
+      if (len(args) > 3):
+         resolution = self.client_nnint_get(args,3)
+      else:
+         resolution = None
       
       bth = self.btm.bt_clients[client_idx].torrents[torrent_infohash]
+      (sl_in, bli) = bth.bandwidth_logger_in.history_get(resolution)
+      (sl_out, blo) = bth.bandwidth_logger_out.history_get(resolution)
       
       self.msg_send(b'BTHTHROUGHPUT', [client_idx, torrent_infohash,
-            bth.bandwidth_logger_in.cycle_length*1000,
-            self.seq_None_filter(bth.bandwidth_logger_in[-max_len:], -1),
-            bth.bandwidth_logger_out.cycle_length*1000,
-            self.seq_None_filter(bth.bandwidth_logger_out[-max_len:], -1)
+            sl_in*1000, self.seq_None_filter(bli[-max_len:], -1),
+            sl_out*1000, self.seq_None_filter(blo[-max_len:], -1)
       ])
    
+   def input_process_GETDISKIOSTATS(self, cmd, args):
+      """Process GETDISKIOSTATS message"""
+      client_idx = self.client_nnint_get(args,0)
+      client = self.btm.bt_clients[client_idx]
+      
+      backend_stats = dict((name.encode('ascii'), stats.state_get())
+         for (name, stats) in diskio.backend_stats.items())
+      torrent_stats = dict((info_hash, bth.disk_io_stats.state_get())
+         for (info_hash, bth) in client.torrents.items()
+         if not (bth.disk_io_stats is None))
+      self.msg_send(b'DISKIOSTATS', [client_idx, backend_stats, torrent_stats])
+   
    def input_process_FORCEBTCREANNOUNCE(self, cmd, args):
       """Process FORCEBTCREANNOUNCE message"""
       client_idx = self.client_nnint_get(args, 0)
@@ -206,6 +223,77 @@ class BTControlConnection(BTControlConnectionBase, AsyncDataStream):
          client.torrent_stop(torrent_infohash)
          self.msg_send(b'COMMANDOK', [cmd] + args)
    
+   def input_process_SETBTHUPLOADSLOTWEIGHT(self, cmd, args):
+      """Process SETBTHUPLOADSLOTWEIGHT message"""
+      client_idx = self.client_nnint_get(args,0)
+      torrent_infohash = args[1]
+      weight = self.client_nnint_get(args,2)
+      self.btm.bt_clients[client_idx].bth_upload_slot_weight_set(
+         torrent_infohash, weight)
+      self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   @staticmethod
+   def rate_get(args, arg_idx):
+      """Retrieve rate limit from arg list; 0 means no limit"""
+      rv = BTControlConnection.client_nnint_get(args, arg_idx)
+      if (rv == 0):
+         return None
+      return rv
+   
+   def input_process_SETCLIENTUPLOADRATE(self, cmd, args):
+      """Process SETCLIENTUPLOADRATE message"""
+      client_idx = self.client_nnint_get(args,0)
+      self.btm.bt_clients[client_idx].upload_rate_max_set(self.rate_get(args,1))
+      self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   def input_process_SETBTHUPLOADRATE(self, cmd, args):
+      """Process SETBTHUPLOADRATE message"""
+      client_idx = self.client_nnint_get(args,0)
+      torrent_infohash = args[1]
+      self.btm.bt_clients[client_idx].bth_upload_rate_max_set(torrent_infohash,
+         self.rate_get(args,2), self.rate_get(args,3))
+      self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   def input_process_SETCLIENTDOWNLOADRATE(self, cmd, args):
+      """Process SETCLIENTDOWNLOADRATE message"""
+      client_idx = self.client_nnint_get(args,0)
+      self.btm.bt_clients[client_idx].download_rate_max_set(self.rate_get(args,1))
+      self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   def input_process_SETBTHDOWNLOADRATE(self, cmd, args):
+      """Process SETBTHDOWNLOADRATE message"""
+      client_idx = self.client_nnint_get(args,0)
+      torrent_infohash = args[1]
+      self.btm.bt_clients[client_idx].bth_download_rate_max_set(torrent_infohash,
+         self.rate_get(args,2))
+      self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   def input_process_SETBTHSUPERSEEDING(self, cmd, args):
+      """Process SETBTHSUPERSEEDING message"""
+      client_idx = self.client_nnint_get(args,0)
+      torrent_infohash = args[1]
+      super_seeding = bool(self.client_nnint_get(args,2))
+      client = self.btm.bt_clients[client_idx]
+      bth = client.torrents[torrent_infohash]
+      if (bth.super_seeding == super_seeding):
+         self.msg_send(b'COMMANDNOOP', [cmd] + args)
+      else:
+         client.bth_super_seeding_set(torrent_infohash, super_seeding)
+         self.msg_send(b'COMMANDOK', [cmd] + args)
+   
+   def input_process_SETBTHANNOUNCEPARALLEL(self, cmd, args):
+      """Process SETBTHANNOUNCEPARALLEL message"""
+      client_idx = self.client_nnint_get(args,0)
+      torrent_infohash = args[1]
+      announce_parallel = bool(self.client_nnint_get(args,2))
+      client = self.btm.bt_clients[client_idx]
+      bth = client.torrents[torrent_infohash]
+      if (bth.announce_parallel == announce_parallel):
+         self.msg_send(b'COMMANDNOOP', [cmd] + args)
+      else:
+         client.bth_announce_parallel_set(torrent_infohash, announce_parallel)
+         self.msg_send(b'COMMANDOK', [cmd] + args)
+   
    def input_process_SUBSCRIBEBTHTHROUGHPUT(self, cmd, args):
       """Process SUBSCRIBEBTHTHROUGHPUT message"""
       client_idx = self.client_nnint_get(args,0)
@@ -291,9 +379,17 @@ class BTControlConnection(BTControlConnectionBase, AsyncDataStream):
       b'GETCLIENTTORRENTS': ('input_process_GETCLIENTTORRENTS', RC_BTCC, None),
       b'GETBTHDATA': ('input_process_GETBTHDATA', RC_BTCC, None),
       b'GETBTHTHROUGHPUT': ('input_process_GETBTHTHROUGHPUT', RC_BTCC, None),
+      b'GETDISKIOSTATS': ('input_process_GETDISKIOSTATS', RC_BTCC, None),
       b'FORCEBTCREANNOUNCE': ('input_process_FORCEBTCREANNOUNCE', RC_BTCC, None),
       b'STARTBTH': ('input_process_STARTBTH', RC_BTCC, None),
       b'STOPBTH': ('input_process_STOPBTH', RC_BTCC, None),
+      b'SETBTHDOWNLOADRATE': ('input_process_SETBTHDOWNLOADRATE', RC_BTCC, None),
+      b'SETBTHSUPERSEEDING': ('input_process_SETBTHSUPERSEEDING', RC_BTCC, None),
+      b'SETBTHANNOUNCEPARALLEL': ('input_process_SETBTHANNOUNCEPARALLEL', RC_BTCC, None),
+      b'SETBTHUPLOADRATE': ('input_process_SETBTHUPLOADRATE', RC_BTCC, None),
+      b'SETCLIENTDOWNLOADRATE': ('input_process_SETCLIENTDOWNLOADRATE', RC_BTCC, None),
+      b'SETCLIENTUPLOADRATE': ('input_process_SETCLIENTUPLOADRATE', RC_BTCC, None),
+      b'SETBTHUPLOADSLOTWEIGHT': ('input_process_SETBTHUPLOADSLOTWEIGHT', RC_BTCC, None),
       b'SUBSCRIBEBTHTHROUGHPUT':('input_process_SUBSCRIBEBTHTHROUGHPUT', RC_BTCC, None),
       b'UNSUBSCRIBEBTHTHROUGHPUT':('input_process_UNSUBSCRIBEBTHTHROUGHPUT', RC_BTCC, None)
    }
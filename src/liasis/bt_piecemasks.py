@@ -92,6 +92,28 @@ class BitMask(bytearray):
       bit_index = index % 8
       return bool((self[byte_index] >> (7-bit_index)) & 1)
 
+   def _mask_op(self, other, op):
+      """Return new BitMask built by combining self with other bytewise"""
+      if (self.bitlen != other.bitlen):
+         raise ValueError('Bitlen mismatch: {0} != {1}.'.format(self.bitlen, other.bitlen))
+      l = len(self)
+      val = op(int.from_bytes(self, 'big'), int.from_bytes(other, 'big'))
+      val &= ((1 << (8*l)) - 1)
+      return BitMask(val.to_bytes(l, 'big'), bitlen=self.bitlen)
+   
+   def mask_and(self, other):
+      """Return new BitMask with bits set that are set in self and other"""
+      return self._mask_op(other, lambda a,b: a & b)
+   
+   def mask_or(self, other):
+      """Return new BitMask with bits set that are set in self or other"""
+      return self._mask_op(other, lambda a,b: a | b)
+   
+   def mask_andnot(self, other):
+      """Return new BitMask with bits set that are set in self but not in
+         other"""
+      return self._mask_op(other, lambda a,b: a & ~b)
+
    def bits_set_count(self):
       """Return count of bits marked"""
       rv = 0
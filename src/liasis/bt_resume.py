@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fast-resume records for skipping validation of unchanged torrent data"""
+
+import binascii
+import logging
+import os
+import os.path
+
+from .benc_structures import benc_str_from_py, py_from_benc_str
+from .bt_piecemasks import BitMask
+
+_logger = logging.getLogger('BTResume')
+_log = _logger.log
+
+
+class BTResumeData:
+   """Snapshot of piecemask and target file metadata of a torrent
+
+   file_stats is a sequence of (size, mtime, inode) tuples, one for each
+   target file of the torrent, or None if the storage backend doesn't provide
+   per-file metadata."""
+   def __init__(self, piecemask, file_stats):
+      self.piecemask = piecemask
+      if not (file_stats is None):
+         file_stats = [tuple(fs) for fs in file_stats]
+      self.file_stats = file_stats
+
+   @classmethod
+   def build_from_disk_io(cls, piecemask, bt_disk_io):
+      """Build instance from piecemask and current state of bt_disk_io"""
+      return cls(BitMask(bytes(piecemask), bitlen=piecemask.bitlen),
+         bt_disk_io.file_stats_get())
+
+   def files_changed_get(self, file_stats):
+      """Return indices of files whose stats differ from recorded ones"""
+      if ((self.file_stats is None) or (file_stats is None) or
+          (len(self.file_stats) != len(file_stats))):
+         raise ValueError('File stats {0!a} not comparable to recorded file '
+            'stats {1!a}.'.format(file_stats, self.file_stats))
+
+      return [i for i in range(len(file_stats))
+         if (tuple(file_stats[i]) != self.file_stats[i])]
+
+   def pieces_changed_get(self, metainfo, file_stats):
+      """Return BitMask of pieces overlapping files whose stats differ from
+         recorded ones; without stats to compare, all pieces count as
+         changed"""
+      piece_count = len(metainfo.piece_hashes)
+      rv = BitMask(bitlen=piece_count)
+      if ((self.file_stats is None) or (file_stats is None)):
+         for j in range(piece_count):
+            rv.bit_set(j, True)
+         return rv
+      files_changed = set(self.files_changed_get(file_stats))
+      piece_length = metainfo.piece_length
+
+      offset = 0
+      for (i, btfile) in enumerate(metainfo.files):
+         if ((i in files_changed) and (btfile.length > 0)):
+            for j in range(offset//piece_length,
+                  (offset + btfile.length - 1)//piece_length + 1):
+               rv.bit_set(j, True)
+         offset += btfile.length
+      return rv
+
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      rv = {
+         b'piecemask': bytes(self.piecemask),
+         b'bitlen': self.piecemask.bitlen
+      }
+      if not (self.file_stats is None):
+         rv[b'file_stats'] = [list(fs) for fs in self.file_stats]
+      return rv
+
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      bitlen = int(state[b'bitlen'])
+      piecemask = bytes(state[b'piecemask'])
+      if (len(piecemask) != (bitlen//8 + int((bitlen % 8) != 0))):
+         raise ValueError('Piecemask length {0} is invalid for bitlen {1}.'.format(len(piecemask), bitlen))
+
+      if (b'file_stats' in state):
+         file_stats = [tuple(int(v) for v in fs) for fs in state[b'file_stats']]
+         for fs in file_stats:
+            if (len(fs) != 3):
+               raise ValueError('Invalid file stats {0!a}.'.format(fs))
+      else:
+         file_stats = None
+
+      return cls(BitMask(piecemask, bitlen=bitlen), file_stats)
+
+   def __repr__(self):
+      return '<{0} pieces: {1}/{2} files: {3}>'.format(self.__class__.__name__,
+         self.piecemask.bits_set_count(), self.piecemask.bitlen,
+         (None if (self.file_stats is None) else len(self.file_stats)))
+
+
+def resume_data_path_get(basepath, info_hash):
+   """Return path of resume data file for specified info_hash"""
+   return os.path.join(basepath, binascii.b2a_hex(info_hash) + b'.resume')
+
+def resume_data_load(basepath, info_hash):
+   """Read resume data for specified info_hash from resume data directory;
+      returns None if there isn't any valid data"""
+   path = resume_data_path_get(basepath, info_hash)
+   try:
+      f = open(path, 'rb')
+   except EnvironmentError:
+      return None
+   
+   try:
+      return BTResumeData.build_from_state(py_from_benc_str(f.read()))
+   except (ValueError, KeyError, TypeError):
+      _log(30, 'Failed to parse resume data file {0!a}:'.format(path), exc_info=True)
+      return None
+   finally:
+      f.close()
+
+def resume_data_write(basepath, info_hash, resume_data):
+   """Write resume data for specified info_hash to resume data directory"""
+   path = resume_data_path_get(basepath, info_hash)
+   path_tmp = path + b'.tmp'
+   f = open(path_tmp, 'wb')
+   try:
+      f.write(benc_str_from_py(resume_data.state_get()))
+      f.flush()
+      os.fsync(f.fileno())
+   finally:
+      f.close()
+   os.rename(path_tmp, path)
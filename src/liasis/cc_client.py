@@ -21,12 +21,13 @@ import time
 from gonium.fdm import AsyncDataStream
 from gonium.event_multiplexing import EventMultiplexer
 
-from .liasis.bandwidth_management import RingBuffer
+from .bandwidth_management import RingBuffer
 
 from .benc_structures import BTMetaInfo
 from .cc_base import BTControlConnectionBase, BTControlConnectionError, \
 BTCCStateError
 from .bt_client_mirror import SIHLBTClientMirror, BTorrentHandlerMirror
+from .diskio import DiskIOStats
 
 
 class Universe:
@@ -53,6 +54,7 @@ class BTControlConnectionClient(BTControlConnectionBase):
       self.em_utd_change_false = EventMultiplexer(self)
       self.em_throughput_block = EventMultiplexer(self)
       self.em_throughput_slice = EventMultiplexer(self)
+      self.em_diskio_stats = EventMultiplexer(self)
 
 
 #------------------------------------------------------------------------------ implemented general-purpose methods
@@ -88,6 +90,39 @@ class BTControlConnectionClient(BTControlConnectionBase):
       """Stop specified BTH"""
       self.msg_send(b'STOPBTH', [int(client_idx), bytes(info_hash)])
    
+   def client_upload_rate_set(self, client_idx, rate):
+      """Set global upload limit of specified BTC; 0 for no limit"""
+      self.msg_send(b'SETCLIENTUPLOADRATE', [int(client_idx), int(rate)])
+   
+   def bth_upload_rate_set(self, client_idx, info_hash, rate, peer_rate):
+      """Set upload limits of specified BTH; 0 for no limit"""
+      self.msg_send(b'SETBTHUPLOADRATE', [int(client_idx), bytes(info_hash),
+         int(rate), int(peer_rate)])
+   
+   def client_download_rate_set(self, client_idx, rate):
+      """Set global download limit of specified BTC; 0 for no limit"""
+      self.msg_send(b'SETCLIENTDOWNLOADRATE', [int(client_idx), int(rate)])
+   
+   def bth_download_rate_set(self, client_idx, info_hash, rate):
+      """Set download limit of specified BTH; 0 for no limit"""
+      self.msg_send(b'SETBTHDOWNLOADRATE', [int(client_idx), bytes(info_hash),
+         int(rate)])
+   
+   def bth_super_seeding_set(self, client_idx, info_hash, super_seeding):
+      """Turn super-seeding mode of specified BTH on or off"""
+      self.msg_send(b'SETBTHSUPERSEEDING', [int(client_idx), bytes(info_hash),
+         int(bool(super_seeding))])
+   
+   def bth_announce_parallel_set(self, client_idx, info_hash, announce_parallel):
+      """Turn parallel announce mode of specified BTH on or off"""
+      self.msg_send(b'SETBTHANNOUNCEPARALLEL', [int(client_idx),
+         bytes(info_hash), int(bool(announce_parallel))])
+   
+   def bth_upload_slot_weight_set(self, client_idx, info_hash, weight):
+      """Set upload slot weight of specified BTH"""
+      self.msg_send(b'SETBTHUPLOADSLOTWEIGHT', [int(client_idx), bytes(info_hash),
+         int(weight)])
+   
    def bth_drop(self, client_idx, info_hash):
       """Drop specified BTH from list of BTHs managed by specified BTC"""
       self.msg_send(b'DROPBTH', [int(client_idx), bytes(info_hash)])
@@ -96,6 +131,10 @@ class BTControlConnectionClient(BTControlConnectionBase):
       """Force active BTHs of specified BTC to reannounce to their trackers"""
       self.msg_send(b'FORCEBTCREANNOUNCE', [int(client_idx)])
    
+   def diskio_stats_request(self, client_idx):
+      """Request disk IO statistics for specified BTC"""
+      self.msg_send(b'GETDISKIOSTATS', [int(client_idx)])
+   
    def bth_add_from_metainfo(self, client_idx, mi_str, active):
       """Add new BTH built from provided MI string to specified BTC"""
       # sanity check
@@ -155,6 +194,15 @@ class BTControlConnectionClient(BTControlConnectionBase):
       up_data = args[2]
       self.em_throughput_slice(client_idx, down_data, up_data)
 
+   def input_process_DISKIOSTATS(self, cmd, args):
+      """Process DISKIOSTATS message"""
+      client_idx = int(args[0])
+      backend_stats = dict((name.decode('ascii'), DiskIOStats.build_from_state(state))
+         for (name, state) in args[1].items())
+      torrent_stats = dict((info_hash, DiskIOStats.build_from_state(state))
+         for (info_hash, state) in args[2].items())
+      self.em_diskio_stats(client_idx, backend_stats, torrent_stats)
+
    def input_process_CLIENTCOUNT(self, cmd, args):
       """Process CLIENTCOUNT message and request full data for each client"""
       self.cc = int(args[0])
@@ -235,8 +283,11 @@ class BTControlConnectionClient(BTControlConnectionBase):
    # input command data
    all_set = Universe()
    commandnoop_set = set((b'BUILDBTHFROMMETAINFO', b'STARTBTH', b'STOPBTH',
-      b'SUBSCRIBEBTHTHROUGHPUT', b'UNSUBSCRIBEBTHTHROUGHPUT'))
-   commandok_set = commandnoop_set.union(set((b'BUILDBTHFROMMETAINFO',b'DROPBTH')))
+      b'SUBSCRIBEBTHTHROUGHPUT', b'UNSUBSCRIBEBTHTHROUGHPUT',
+      b'SETBTHSUPERSEEDING', b'SETBTHANNOUNCEPARALLEL'))
+   commandok_set = commandnoop_set.union(set((b'BUILDBTHFROMMETAINFO',b'DROPBTH',
+      b'SETBTHUPLOADSLOTWEIGHT', b'SETBTHUPLOADRATE', b'SETCLIENTUPLOADRATE',
+      b'SETBTHDOWNLOADRATE', b'SETCLIENTDOWNLOADRATE')))
 
    # tuple contents:
    #  1. name of processing method
@@ -251,6 +302,7 @@ class BTControlConnectionClient(BTControlConnectionBase):
        b'CLIENTCOUNT': ('input_process_CLIENTCOUNT', True, (b'GETCLIENTCOUNT',)),
        b'CLIENTDATA': ('input_process_CLIENTDATA', True, (b'GETCLIENTDATA',)),
        b'CLIENTTORRENTS': ('input_process_CLIENTTORRENTS', True, (b'GETCLIENTTORRENTS',)),
+       b'DISKIOSTATS': ('input_process_DISKIOSTATS', True, (b'GETDISKIOSTATS',)),
        b'COMMANDOK': ('input_process_COMMANDOK', True, commandok_set),
        b'COMMANDNOOP': ('input_process_COMMANDNOOP', True, commandnoop_set),
        b'INVALIDCLIENTCOUNT': ('input_process_INVALIDCLIENTCOUNT', True, None),
@@ -308,16 +360,10 @@ class ThroughputCounter:
       if (l != len(td_up)):
          raise ValueError('td_down: {0!a} td_up: {1!a}'.format(td_down, td_up))
       
-      padding = [None]*(self.history_length - l)
       # Since we're up to date, the client and info-hash had better exist.
       bth = self.bt_clients[client_idx].torrents[info_hash]
-      bli = bth.bandwidth_logger_in = RingBuffer(self.history_length)
-      blo = bth.bandwidth_logger_out = RingBuffer(self.history_length)
-      
-      bli.history = td_down + padding
-      blo.history = td_up + padding
-      
-      bli.history_index = blo.history_index = (l - 1)
+      bth.bandwidth_logger_in = RingBuffer.build_from_seq(self.history_length, td_down)
+      bth.bandwidth_logger_out = RingBuffer.build_from_seq(self.history_length, td_up)
    
    def throughput_slice_log(self, client_idx, td_down, td_up):
       """Process received slice of throughput data."""
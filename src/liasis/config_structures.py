@@ -34,7 +34,7 @@ class ConfigBase:
    def config_use(self, target):
       for attr in self._bytes_attributes:
          val = getattr(self, attr)
-         if (isinstance(val, (bytes, bytearray))):
+         if ((val is None) or isinstance(val, (bytes, bytearray))):
             continue
          setattr(self, attr, val.encode())
       
@@ -57,9 +57,16 @@ class BTMConfig(ConfigBase):
 class BTCConfig(ConfigBase):
    """BTC config value storage class"""
    attributes = ('host', 'port', 'pickle_interval', 'backlog', 
-      'bwm_cycle_length', 'bwm_history_length', '_btdiskio_build')
+      'bwm_cycle_length', 'bwm_history_length', 'hash_workers',
+      'hash_workers_processes', 'validation_chunk_length', 'validation_depth',
+      'validation_background', 'validation_background_delay',
+      'resume_basepath', 'upload_slots',
+      'upload_slots_torrent_min', 'upload_rate_max', 'download_rate_max',
+      'scrape_interval', 'announces_active_max', 'connections_half_open_max',
+      '_btdiskio_build')
    
-   _bytes_attributes = ('bth_archive_basepath', 'host', 'data_basepath')
+   _bytes_attributes = ('bth_archive_basepath', 'host', 'data_basepath',
+      'resume_basepath')
    
    # default config values
    bth_archive_basepath = b'torrent_archive'
@@ -71,11 +78,51 @@ class BTCConfig(ConfigBase):
    backlog = 10
    bwm_cycle_length = 1
    bwm_history_length = 1000
+   # Number of worker threads (or processes) used for verifying piece hashes;
+   # if 0, hashing is done inline in the event loop thread.
+   hash_workers = 2
+   hash_workers_processes = False
+   # Size of reads done for startup validation, and number of them to keep in
+   # flight at once
+   validation_chunk_length = 1048576
+   validation_depth = 4
+   # If true, torrents are started before startup validation has finished,
+   # and validation is done in the background at reduced speed.
+   validation_background = False
+   # Seconds to pause between chunks read by background validation; this
+   # limits it to about validation_chunk_length bytes per this many seconds
+   # for each torrent.
+   validation_background_delay = 0.1
+   # Directory to read externally generated (e.g. by liasis_btdata_verify)
+   # resume data from, for torrents that don't have any yet; None to disable.
+   resume_basepath = None
+   # Total number of peers to upload to at once, distributed over all
+   # torrents according to demand and their upload slot weights; None to let
+   # each torrent use a fixed number of slots instead.
+   upload_slots = None
+   # Minimum number of slots given to each torrent with interested peers, as
+   # long as there are enough to go around
+   upload_slots_torrent_min = 1
+   # Global upload and download limits in bytes per second; None for no
+   # limit. Limits for single torrents can be set at runtime.
+   upload_rate_max = None
+   download_rate_max = None
+   # Interval in seconds between scrapes of the trackers of all torrents;
+   # None to disable scraping.
+   scrape_interval = 1800
+   # Limit on number of tracker announces in flight at once, over all
+   # torrents
+   announces_active_max = 8
+   # Limit on number of outgoing peer connections that haven't been answered
+   # with a handshake yet, over all torrents
+   connections_half_open_max = 8
    
    # No user-servicable parts beyond this point.
    _btdiskio_build = staticmethod(diskio.btdiskio_build)
 
    def config_use(self, target):
+      if (self.validation_depth < 1):
+         raise ValueError('validation_depth must be at least 1; got {0!a}.'.format(self.validation_depth))
       ConfigBase.config_use(self, target)
       target.bth_archiver = self.bth_archiver_cls(self.bth_archive_basepath)
 
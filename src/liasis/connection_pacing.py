@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Client-wide pacing of outgoing peer connections"""
+
+import logging
+import time
+from collections import deque
+
+
+class ConnectionPacer:
+   """Open outgoing peer connections for the torrents of a client at a
+      bounded rate
+
+   At most half_open_max connections are in progress (opened by us, but
+   without a handshake from the peer yet) at any time. Torrents that want
+   more peers register with us, and are asked to open one connection at a
+   time, round-robin, whenever a slot is free. Connects that take much longer
+   than handshakes usually do are given up on, so unreachable peers don't
+   hold slots for long."""
+   logger = logging.getLogger('ConnectionPacer')
+   log = logger.log
+   half_open_max_default = 8
+   # Bounds on seconds to wait for a handshake before giving up on a connect;
+   # the actual timeout is connect_timeout_factor times the typical handshake
+   # latency seen recently.
+   connect_timeout_min = 5
+   connect_timeout_max = 30
+   connect_timeout_factor = 4
+   # Seconds to wait before replacing lost connections, to batch work
+   backfill_delay = 1
+   def __init__(self, event_dispatcher, half_open_max=None):
+      if (half_open_max is None):
+         half_open_max = self.half_open_max_default
+      self.ed = event_dispatcher
+      self.half_open_max = half_open_max
+      # connection -> ts connect started
+      self.half_open = {}
+      self.bths_wanting = deque()
+      self.bths_wanting_set = set()
+      # Smoothed handshake latency of recent connects, in seconds
+      self.latency = None
+      self.timer = None
+      self.ts_timer = None
+      self.filling = False
+
+   def connect_timeout_get(self):
+      """Return current number of seconds to allow for connects"""
+      if (self.latency is None):
+         return self.connect_timeout_max
+      return min(max(self.latency*self.connect_timeout_factor,
+         self.connect_timeout_min), self.connect_timeout_max)
+
+   def bth_want(self, bth, delay=0):
+      """Note that bth wants more connections, and start opening them after
+         delay seconds"""
+      if not (bth in self.bths_wanting_set):
+         self.bths_wanting.append(bth)
+         self.bths_wanting_set.add(bth)
+      self._timer_set(time.time() + delay)
+
+   def bth_remove(self, bth):
+      """Stop opening connections for bth"""
+      if (bth in self.bths_wanting_set):
+         self.bths_wanting.remove(bth)
+         self.bths_wanting_set.remove(bth)
+
+   def connection_established(self, conn):
+      """Note that outgoing connection conn has received a handshake"""
+      ts_start = self.half_open.pop(conn, None)
+      if (ts_start is None):
+         return
+      latency = time.time() - ts_start
+      if (self.latency is None):
+         self.latency = latency
+      else:
+         self.latency = (3*self.latency + latency)/4
+      self._timer_set(time.time())
+
+   def connection_close(self, conn):
+      """Note that conn has been closed"""
+      if not (self.half_open.pop(conn, None) is None):
+         self._timer_set(time.time() + self.backfill_delay)
+
+   def _timer_set(self, ts):
+      """Make sure our timer fires no later than ts"""
+      if not ((self.ts_timer is None) or (ts < self.ts_timer)):
+         return
+      if not (self.timer is None):
+         self.timer.cancel()
+      self.ts_timer = ts
+      self.timer = self.ed.set_timer(max(ts - time.time(), 0),
+         self._timer_handle, parent=self)
+
+   def _timer_handle(self):
+      self.timer = None
+      self.ts_timer = None
+      self.connections_fill()
+
+   def connections_fill(self):
+      """Give up on overdue connects, and use free slots to open new ones"""
+      if (self.filling):
+         return
+      self.filling = True
+      try:
+         self._connections_fill()
+      finally:
+         self.filling = False
+
+   def _connections_fill(self):
+      now = time.time()
+      timeout = self.connect_timeout_get()
+      for (conn, ts_start) in tuple(self.half_open.items()):
+         if (ts_start + timeout <= now):
+            self.log(15, '{0} giving up on connect {1} after {2:.1f} seconds.'.format(self, conn, now - ts_start))
+            del(self.half_open[conn])
+            conn.close()
+
+      while (self.bths_wanting and (len(self.half_open) < self.half_open_max)):
+         bth = self.bths_wanting.popleft()
+         conn = bth.peer_connection_open()
+         if (conn is None):
+            # Satisfied or out of peers to try.
+            self.bths_wanting_set.remove(bth)
+            continue
+         self.bths_wanting.append(bth)
+         if (conn.handshake_processed or not (conn)):
+            continue
+         self.half_open[conn] = now
+
+      if (self.half_open):
+         self._timer_set(min(self.half_open.values()) + timeout)
+
+   def close(self):
+      """Cancel our timer and forget about all torrents and connects"""
+      if not (self.timer is None):
+         self.timer.cancel()
+         self.timer = None
+      self.ts_timer = None
+      self.half_open = {}
+      self.bths_wanting = deque()
+      self.bths_wanting_set = set()
+
+   def __repr__(self):
+      return '<{0} half-open: {1}/{2} wanting: {3} id: {4}>'.format(
+         self.__class__.__name__, len(self.half_open), self.half_open_max,
+         len(self.bths_wanting), id(self))
@@ -18,27 +18,145 @@
 import errno
 import logging
 import os
+import time
 from collections import deque, Callable
 
 from hashlib import sha1
 
 from .bt_exceptions import BTClientError, BTCStateError, BTFileError
+from .stats_structures import LatencyHistogram
 
 _logger = logging.getLogger('BTDiskIO')
 _log = _logger.log
 
 
+class DiskIOStats:
+   """Latency, queue depth and throughput statistics for disk IO requests
+   
+   Instances can be chained; any request counted by an instance with a parent
+   is also counted by that parent."""
+   # Time (in seconds) over which bytes per second values are averaged
+   rate_window = 5
+   
+   def __init__(self, parent=None):
+      self.parent = parent
+      self.reqs_pending = 0
+      self.reqs_pending_max = 0
+      self.reqs_done = 0
+      self.reqs_failed = 0
+      self.bytes_read = 0
+      self.bytes_written = 0
+      self.latency_read = LatencyHistogram()
+      self.latency_write = LatencyHistogram()
+      self.bytes_per_second = 0
+      self._rate_ts = time.time()
+      self._rate_bytes = 0
+   
+   def request_start(self, req):
+      """Count submission of new request"""
+      self.reqs_pending += 1
+      if (self.reqs_pending > self.reqs_pending_max):
+         self.reqs_pending_max = self.reqs_pending
+      if not (self.parent is None):
+         self.parent.request_start(req)
+   
+   def request_finish(self, req):
+      """Count completion of a request previously passed to request_start()"""
+      self.reqs_pending -= 1
+      self.reqs_done += 1
+      if (req.failed):
+         self.reqs_failed += 1
+      
+      latency = req.ts_done - req.ts_submit
+      if (req.mode == req.MODE_WRITE):
+         self.bytes_written += req.io_length
+         self.latency_write.value_add(latency)
+      else:
+         self.bytes_read += req.io_length
+         self.latency_read.value_add(latency)
+      
+      self._rate_bytes += req.io_length
+      self._rate_update(req.ts_done)
+      if not (self.parent is None):
+         self.parent.request_finish(req)
+   
+   def _rate_update(self, now):
+      """Recompute bytes_per_second if the current window is over"""
+      tdiff = now - self._rate_ts
+      if (tdiff < self.rate_window):
+         return
+      self.bytes_per_second = int(self._rate_bytes/tdiff)
+      self._rate_ts = now
+      self._rate_bytes = 0
+   
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      self._rate_update(time.time())
+      return {
+         b'reqs_pending': self.reqs_pending,
+         b'reqs_pending_max': self.reqs_pending_max,
+         b'reqs_done': self.reqs_done,
+         b'reqs_failed': self.reqs_failed,
+         b'bytes_read': self.bytes_read,
+         b'bytes_written': self.bytes_written,
+         b'bytes_per_second': self.bytes_per_second,
+         b'latency_read': self.latency_read.state_get(),
+         b'latency_write': self.latency_write.state_get()
+      }
+   
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      rv = cls()
+      for name in ('reqs_pending', 'reqs_pending_max', 'reqs_done',
+            'reqs_failed', 'bytes_read', 'bytes_written', 'bytes_per_second'):
+         setattr(rv, name, int(state[name.encode('ascii')]))
+      rv.latency_read = LatencyHistogram.build_from_state(state[b'latency_read'])
+      rv.latency_write = LatencyHistogram.build_from_state(state[b'latency_write'])
+      return rv
+   
+   def __repr__(self):
+      return '<{0} at {1} pending: {2} done: {3} read: {4} written: {5}>'.format(
+         self.__class__.__name__, id(self), self.reqs_pending, self.reqs_done,
+         self.bytes_read, self.bytes_written)
+
+
+# Per-backend (i.e. per BTDisk* class) stats, shared by all instances of the
+# respective class.
+backend_stats = {}
+
+def backend_stats_get(name):
+   """Return DiskIOStats instance for backend with specified name"""
+   try:
+      rv = backend_stats[name]
+   except KeyError:
+      rv = backend_stats[name] = DiskIOStats()
+   return rv
+
+
 class BTDiskIORequest:
-   def __init__(self, results_pending, callback):
+   MODE_READ = 0
+   MODE_WRITE = 1
+   def __init__(self, results_pending, callback, mode=MODE_READ, stats=None):
       self.res_count = results_pending
       self.callback = callback
       self.failed = False
+      self.mode = mode
+      self.stats = stats
+      self.io_length = 0
+      self.ts_submit = time.time()
+      self.ts_done = None
+      if not (stats is None):
+         stats.request_start(self)
    
    def _process_result(self, req):
       """Process IO read/write response"""
       self.res_count -= 1
       assert(self.res_count >= 0)
       if (self.res_count == 0):
+         self.ts_done = time.time()
+         if not (self.stats is None):
+            self.stats.request_finish(self)
          self.callback(self)
 
 
@@ -84,6 +202,7 @@ class BTDiskBase:
       
       self.file_index = 0
       self.file_index_max = (len(self.files) - 1)
+      self.io_stats = DiskIOStats(backend_stats_get(self.__class__.__name__))
    
    def _fileset_get(self, offset:int, length:int):
       """Return sequence of (file, offset, length) accesses needed to implement
@@ -113,12 +232,19 @@ class BTDiskBase:
          raise BTFileError('Access violates file domain.')
       return rv
 
+   def file_stats_get(self):
+      """Return list of (size, mtime, inode) tuples for our backing files"""
+      rv = []
+      for btfile in self.files:
+         st = os.fstat(btfile.file.fileno())
+         rv.append((st.st_size, st.st_mtime_ns, st.st_ino))
+      return rv
+
    def close(self):
       """Close backing files"""
       for file in self.files:
          file.file_close()
       self.metainfo = None
-      self.metainfo.files = None
       self.files = None
 
 
@@ -127,10 +253,12 @@ class BTDiskSyncIO(BTDiskBase):
       using blocking read()/write() calls."""
    def async_write(self, req_s:(int,memoryview), callback:Callable) -> BTDiskIORequest:
       """Write data at offset."""
-      req = BTDiskIORequest(1, callback)
+      req = BTDiskIORequest(1, callback, BTDiskIORequest.MODE_WRITE,
+         self.io_stats)
       for (offset, buf) in req_s:
          i = 0
          buf = memoryview(buf)
+         req.io_length += len(buf)
          for (f, f_off, length) in self._fileset_get(offset, len(buf)):
             f.seek(f_off)
             try:
@@ -152,10 +280,12 @@ class BTDiskSyncIO(BTDiskBase):
    
    def async_readinto(self, req_s:(int,memoryview), callback:Callable) -> BTDiskIORequest:
       """Read data from offset."""
-      req = BTDiskIORequest(1, callback)
+      req = BTDiskIORequest(1, callback, BTDiskIORequest.MODE_READ,
+         self.io_stats)
       for (offset, buf) in req_s:
          i = 0
          buf = memoryview(buf)
+         req.io_length += len(buf)
          for (f, f_off, length) in self._fileset_get(offset, len(buf)):
             f.seek(f_off)
             try:
@@ -199,11 +329,16 @@ class BTDiskAIO(BTDiskBase):
 
    def _async_io(self, mode, req_s, callback):
       aio = self._sa.aio
-      req = BTDiskAIORequest(None, callback)
+      if (mode == aio.MODE_WRITE):
+         req_mode = BTDiskIORequest.MODE_WRITE
+      else:
+         req_mode = BTDiskIORequest.MODE_READ
+      req = BTDiskAIORequest(None, callback, req_mode, self.io_stats)
       aio_reqs = deque()
       for (offset, buf) in req_s:
          i = 0
          buf = memoryview(buf)
+         req.io_length += len(buf)
          for (f, f_off, length) in self._fileset_get(offset, len(buf)):
             aio_req = aio.REQ_CLS(mode, buf[i:i+length], f, f_off,
                callback=req._process_result)
@@ -256,11 +391,13 @@ class BTDiskBlockFDIO(BTDiskBase):
       return self._async_io(self.MODE_READ, req_s, callback)
 
    def _async_io(self, mode, req_s, callback):
-      req = BTDiskBlockFDIORequest(None, callback)
+      # Our MODE_* values match those of BTDiskIORequest.
+      req = BTDiskBlockFDIORequest(None, callback, mode, self.io_stats)
       dtrs = deque()
       for (offset, buf) in req_s:
          i = 0
          buf = memoryview(buf)
+         req.io_length += len(buf)
          for (f, f_off, length) in self._fileset_get(offset, len(buf)):
             if (mode == self.MODE_READ):
                dtr = self._sa.dtd.new_req_fd2mem(f, buf[i:i+length],
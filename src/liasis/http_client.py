@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal asynchronous HTTP/1.1 client with persistent connections"""
+
+import logging
+import socket
+import zlib
+from collections import deque
+
+from gonium.fdm import AsyncDataStream
+
+from .resolver import getaddrinfo_catch
+
+_logger = logging.getLogger('HTTPClient')
+_log = _logger.log
+
+
+class HTTPClientError(Exception):
+   pass
+
+
+class HTTPResponse:
+   """Parsed HTTP response; header names are lowercased"""
+   def __init__(self):
+      self.version = None
+      self.status = None
+      self.reason = None
+      self.headers = {}
+      self.body = None
+      self.keep_alive = False
+
+   def __repr__(self):
+      return '<{0} version: {1!a} status: {2!a} reason: {3!a} id: {4}>'.format(
+         self.__class__.__name__, self.version, self.status, self.reason,
+         id(self))
+
+
+class HTTPResponseParser:
+   """Incremental parser for a single HTTP response
+
+   Data is passed in as it arrives, and the body is decoded (including
+   gzip/deflate content coding) while it is received."""
+   # Limits on sizes of header section and decoded body
+   header_length_max = 65536
+   body_length_max = 4194304
+
+   ST_STATUS = 0
+   ST_HEADERS = 1
+   ST_BODY_LENGTH = 2
+   ST_CHUNK_SIZE = 3
+   ST_CHUNK_DATA = 4
+   ST_CHUNK_END = 5
+   ST_TRAILER = 6
+   ST_BODY_EOF = 7
+   ST_DONE = 8
+
+   def __init__(self, head=False):
+      self.head = head
+      self.state = self.ST_STATUS
+      self.buf = bytearray()
+      self.header_length = 0
+      self.length_left = None
+      self.decompressor = None
+      self.body_parts = []
+      self.body_length = 0
+      self.response = HTTPResponse()
+
+   def done(self):
+      return (self.state == self.ST_DONE)
+
+   def _line_get(self):
+      """Remove and return next line from buffer, or None if we don't have a
+         complete one yet"""
+      i = self.buf.find(b'\n')
+      if (i < 0):
+         if (self.header_length + len(self.buf) > self.header_length_max):
+            raise HTTPClientError('Header line exceeds length limit.')
+         return None
+      line = bytes(self.buf[:i]).rstrip(b'\r')
+      del(self.buf[:i+1])
+      self.header_length += i + 1
+      if (self.header_length > self.header_length_max):
+         raise HTTPClientError('Header section exceeds length limit.')
+      return line
+
+   def _status_process(self, line):
+      try:
+         (version, status, *reason) = line.split(None, 2)
+         status = int(status)
+      except ValueError:
+         raise HTTPClientError('Invalid status line {0!a}.'.format(line))
+      if not (version.startswith(b'HTTP/1.')):
+         raise HTTPClientError('Unsupported HTTP version in status line {0!a}.'.format(line))
+      resp = self.response
+      resp.version = version
+      resp.status = status
+      resp.reason = (reason[0] if reason else b'')
+
+   def _header_process(self, line):
+      try:
+         (name, value) = line.split(b':', 1)
+      except ValueError:
+         raise HTTPClientError('Invalid header line {0!a}.'.format(line))
+      name = name.strip().lower()
+      value = value.strip()
+      headers = self.response.headers
+      if (name in headers):
+         headers[name] = b', '.join((headers[name], value))
+      else:
+         headers[name] = value
+
+   def _headers_finish(self):
+      """Determine body framing after the end of the header section"""
+      resp = self.response
+      if (100 <= resp.status < 200):
+         # Interim response; the real one follows.
+         self.response = HTTPResponse()
+         self.state = self.ST_STATUS
+         return
+
+      headers = resp.headers
+      connection = [t.strip() for t in headers.get(b'connection', b'').lower().split(b',')]
+      if (resp.version == b'HTTP/1.0'):
+         resp.keep_alive = (b'keep-alive' in connection)
+      else:
+         resp.keep_alive = not (b'close' in connection)
+
+      coding = headers.get(b'content-encoding', b'identity').strip().lower()
+      if (coding in (b'gzip', b'x-gzip', b'deflate')):
+         # Automatic header detection handles both gzip and zlib streams.
+         self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+      elif (coding != b'identity'):
+         raise HTTPClientError('Unsupported content encoding {0!a}.'.format(coding))
+
+      te = headers.get(b'transfer-encoding', b'identity').strip().lower()
+      if (self.head or (resp.status in (204, 304))):
+         self._body_finish()
+      elif (te != b'identity'):
+         if not (te.endswith(b'chunked')):
+            raise HTTPClientError('Unsupported transfer encoding {0!a}.'.format(te))
+         self.state = self.ST_CHUNK_SIZE
+      elif (b'content-length' in headers):
+         try:
+            self.length_left = int(headers[b'content-length'])
+         except ValueError:
+            raise HTTPClientError('Invalid content length {0!a}.'.format(headers[b'content-length']))
+         if (self.length_left < 0):
+            raise HTTPClientError('Invalid content length {0!a}.'.format(headers[b'content-length']))
+         self.state = self.ST_BODY_LENGTH
+         if (self.length_left == 0):
+            self._body_finish()
+      else:
+         resp.keep_alive = False
+         self.state = self.ST_BODY_EOF
+
+   def _body_add(self, data):
+      if not (self.decompressor is None):
+         data = self.decompressor.decompress(data)
+      self.body_length += len(data)
+      if (self.body_length > self.body_length_max):
+         raise HTTPClientError('Body exceeds length limit.')
+      self.body_parts.append(bytes(data))
+
+   def _body_finish(self):
+      if not (self.decompressor is None):
+         self.body_parts.append(self.decompressor.flush())
+         self.decompressor = None
+      self.response.body = b''.join(self.body_parts)
+      self.body_parts = []
+      self.state = self.ST_DONE
+
+   def data_process(self, data):
+      """Process received data; returns number of bytes of data that belong
+         to this response"""
+      self.buf += data
+      buf = self.buf
+      while (buf and (self.state != self.ST_DONE)):
+         state = self.state
+         if (state in (self.ST_STATUS, self.ST_HEADERS, self.ST_CHUNK_SIZE,
+               self.ST_CHUNK_END, self.ST_TRAILER)):
+            line = self._line_get()
+            if (line is None):
+               break
+            if (state == self.ST_STATUS):
+               if (line):
+                  self._status_process(line)
+                  self.state = self.ST_HEADERS
+            elif (state == self.ST_HEADERS):
+               if (line):
+                  self._header_process(line)
+               else:
+                  self._headers_finish()
+            elif (state == self.ST_CHUNK_SIZE):
+               try:
+                  self.length_left = int(line.split(b';',1)[0], 16)
+               except ValueError:
+                  raise HTTPClientError('Invalid chunk size line {0!a}.'.format(line))
+               if (self.length_left == 0):
+                  self.state = self.ST_TRAILER
+               else:
+                  self.state = self.ST_CHUNK_DATA
+            elif (state == self.ST_CHUNK_END):
+               if (line):
+                  raise HTTPClientError('Garbage {0!a} after chunk data.'.format(line))
+               self.state = self.ST_CHUNK_SIZE
+            elif not (line):
+               # End of trailer
+               self._body_finish()
+         elif (state == self.ST_BODY_EOF):
+            self._body_add(buf)
+            del(buf[:])
+         else:
+            l = min(len(buf), self.length_left)
+            self._body_add(buf[:l])
+            del(buf[:l])
+            self.length_left -= l
+            if (self.length_left == 0):
+               if (state == self.ST_CHUNK_DATA):
+                  self.state = self.ST_CHUNK_END
+               else:
+                  self._body_finish()
+
+      if (self.state != self.ST_DONE):
+         # Anything left in our buffer is an incomplete line of ours.
+         return len(data)
+      self.buf = bytearray()
+      return len(data) - len(buf)
+
+   def eof_process(self):
+      """Process end of stream; returns True if this completes the
+         response"""
+      if (self.state == self.ST_BODY_EOF):
+         self._body_finish()
+      return (self.state == self.ST_DONE)
+
+
+class HTTPRequest:
+   """Pending or finished HTTP request
+
+   After the request has finished, either response is a HTTPResponse or
+   error is set to a description of why it failed."""
+   def __init__(self, host, port, target, callback, headers=(), method=b'GET'):
+      self.host = host
+      self.port = port
+      self.target = target
+      self.callback = callback
+      self.headers = tuple(headers)
+      self.method = method
+      self.response = None
+      self.error = None
+      self.retries = 0
+
+   def host_header_get(self):
+      host = self.host
+      if (b':' in host):
+         host = b''.join((b'[', host, b']'))
+      if (self.port == 80):
+         return host
+      return b':'.join((host, str(self.port).encode('ascii')))
+
+   def request_string_build(self):
+      """Return request data to send to server"""
+      lines = [b' '.join((self.method, self.target, b'HTTP/1.1')),
+         b'Host: ' + self.host_header_get(),
+         b'Accept-Encoding: gzip']
+      lines.extend(b': '.join(h) for h in self.headers)
+      lines.append(b'\r\n')
+      return b'\r\n'.join(lines)
+
+   def _finish(self, response=None, error=None):
+      self.response = response
+      self.error = error
+      callback = self.callback
+      self.callback = None
+      if not (callback is None):
+         callback(self)
+
+   def cancel(self):
+      """Don't call our callback once the request finishes"""
+      self.callback = None
+
+   def __repr__(self):
+      return '<{0} host: {1!a} port: {2!a} target: {3!a} id: {4}>'.format(
+         self.__class__.__name__, self.host, self.port, self.target, id(self))
+
+
+class HTTPClientConnection:
+   """Persistent connection to one HTTP server
+
+   Only a single request is sent until the server has shown us that it keeps
+   HTTP/1.1 connections alive; after that, requests are pipelined."""
+   def __init__(self, pool, key, address, family=socket.AF_INET):
+      self.pool = pool
+      self.key = key
+      self.requests = deque()
+      self.parser = None
+      self.reusable = True
+      self.pipelining = False
+      self.responses_count = 0
+      self.timer_idle = None
+      self.timer_response = None
+      self.stream = AsyncDataStream.build_sock_connect(pool.ed, address,
+         family=family)
+      self.stream.process_input = self.input_process
+      self.stream.process_close = self.close_process
+
+   def capacity_get(self):
+      """Return number of requests we can currently accept"""
+      if not (self.reusable and self.stream):
+         return 0
+      if (self.pipelining):
+         return max(self.pool.pipeline_depth_max - len(self.requests), 0)
+      return int(not (self.requests))
+
+   def request_send(self, request):
+      """Send request to server"""
+      if not (self.timer_idle is None):
+         self.timer_idle.cancel()
+         self.timer_idle = None
+      if not (self.requests):
+         self.parser = HTTPResponseParser(request.method == b'HEAD')
+      self.requests.append(request)
+      self.stream.send_bytes((request.request_string_build(),))
+      if (self.timer_response is None):
+         self._timer_response_reset()
+
+   def input_process(self, in_data):
+      data = bytes(in_data)
+      self.stream.discard_inbuf_data()
+      self._timer_response_reset()
+      try:
+         while (data):
+            if not (self.requests):
+               raise HTTPClientError('Got unrequested data {0!a}.'.format(data))
+            l = self.parser.data_process(data)
+            data = data[l:]
+            if (self.parser.done()):
+               self.response_process(self.parser.response)
+               if not (self.reusable):
+                  self.close()
+                  return
+      except (HTTPClientError, zlib.error) as exc:
+         _log(30, '{0!a} failed to parse response: {1}'.format(self, exc))
+         self.close()
+
+   def response_process(self, response):
+      """Pass finished response to its request"""
+      req = self.requests.popleft()
+      self.responses_count += 1
+      if not (response.keep_alive):
+         self.reusable = False
+      elif (response.version != b'HTTP/1.0'):
+         self.pipelining = True
+      if (self.requests):
+         self.parser = HTTPResponseParser(self.requests[0].method == b'HEAD')
+      else:
+         self.parser = None
+      req._finish(response)
+
+      if not (self.reusable and self.stream and self.pool):
+         return
+      self._timer_response_reset()
+      if not (self.requests):
+         self.timer_idle = self.pool.ed.set_timer(self.pool.idle_timeout,
+            self._idle_timeout_handle)
+      self.pool._requests_dispatch(self.key)
+
+   def _timer_response_reset(self):
+      """(Re)start response timer if we are waiting for responses, stop it
+         otherwise"""
+      if not (self.timer_response is None):
+         self.timer_response.cancel()
+         self.timer_response = None
+      if (self.requests and self.stream and self.pool):
+         self.timer_response = self.pool.ed.set_timer(
+            self.pool.response_timeout, self._response_timeout_handle)
+
+   def _idle_timeout_handle(self):
+      self.timer_idle = None
+      self.close()
+
+   def _response_timeout_handle(self):
+      self.timer_response = None
+      _log(30, '{0!a} timed out waiting for response.'.format(self))
+      self.close()
+
+   def close_process(self, *args, **kwargs):
+      """Fail or retry outstanding requests after connection close"""
+      if not (self.timer_idle is None):
+         self.timer_idle.cancel()
+         self.timer_idle = None
+      if not (self.timer_response is None):
+         self.timer_response.cancel()
+         self.timer_response = None
+      if (self.requests and self.parser.eof_process()):
+         self.response_process(self.parser.response)
+
+      requests = self.requests
+      self.requests = deque()
+      self.reusable = False
+      pool = self.pool
+      if (pool is None):
+         return
+      self.pool = None
+      pool._connection_remove(self)
+      for req in requests:
+         # Servers may close idle persistent connections at any time, so
+         # requests sent on a connection that has been used before deserve
+         # another try.
+         if ((self.responses_count > 0) and (req.retries < pool.retries_max)):
+            req.retries += 1
+            pool._request_queue(req)
+         else:
+            req._finish(error='Connection to {0!a} closed before receiving response.'.format(self.key))
+      pool._requests_dispatch(self.key)
+
+   def close(self):
+      if (self.stream):
+         self.stream.close()
+
+   def __repr__(self):
+      return '<{0} key: {1!a} pending: {2} responses: {3} id: {4}>'.format(
+         self.__class__.__name__, self.key, len(self.requests),
+         self.responses_count, id(self))
+
+
+class HTTPClientPool:
+   """Pool of persistent HTTP connections, shared by all requests
+
+   Requests to the same server are spread over a limited number of
+   connections, which are kept open for reuse for some time after they have
+   become idle."""
+   # Per-server limit on number of connections
+   connections_per_host_max = 2
+   # Limit on number of pipelined requests per connection
+   pipeline_depth_max = 8
+   # Seconds to keep idle connections open for
+   idle_timeout = 30
+   # Seconds to wait for (more of) a response before giving up on a
+   # connection
+   response_timeout = 60
+   # Number of times to resend requests lost on closing reused connections
+   retries_max = 1
+   def __init__(self, event_dispatcher, resolver=None):
+      self.ed = event_dispatcher
+      self.resolver = resolver
+      # (host, port) -> list of HTTPClientConnections
+      self.connections = {}
+      # (host, port) -> deque of HTTPRequests not sent yet
+      self.requests_waiting = {}
+      # (host, port) -> ResolverRequest for opening another connection
+      self.resolver_requests = {}
+
+   def request_send(self, request):
+      """Send request on a suitable connection, opening one if necessary;
+         request callback may be called before this returns"""
+      self._request_queue(request)
+      self._requests_dispatch((request.host, request.port))
+
+   def _request_queue(self, request):
+      key = (request.host, request.port)
+      try:
+         self.requests_waiting[key].append(request)
+      except KeyError:
+         self.requests_waiting[key] = deque((request,))
+
+   def _requests_dispatch(self, key):
+      """Send waiting requests for key on connections that have capacity
+         left; open a new connection if there are requests left over"""
+      waiting = self.requests_waiting.get(key)
+      if (waiting is None):
+         return
+      for conn in tuple(self.connections.get(key, ())):
+         while (waiting and (conn.capacity_get() > 0)):
+            req = waiting.popleft()
+            if (req.callback is None):
+               # Cancelled
+               continue
+            conn.request_send(req)
+
+      while (waiting and (waiting[0].callback is None)):
+         waiting.popleft()
+      if not (waiting):
+         del(self.requests_waiting[key])
+         return
+
+      if ((key in self.resolver_requests) or (len(self.connections.get(key,
+            ())) >= self.connections_per_host_max)):
+         return
+      if (self.resolver is None):
+         self._connect(key, getaddrinfo_catch(key[0], key[1], 0,
+            socket.SOCK_STREAM))
+         return
+
+      def cb(req):
+         del(self.resolver_requests[key])
+         self._connect(key, req.addrinfo)
+      self.resolver_requests[key] = None
+      req = self.resolver.resolve(key[0], key[1], cb, type=socket.SOCK_STREAM)
+      if (key in self.resolver_requests):
+         self.resolver_requests[key] = req
+
+   def _connect(self, key, addrinfo):
+      """Open new connection to server at looked-up address"""
+      if not (addrinfo):
+         self._requests_fail(key, 'Unable to resolve {0!a}.'.format(key[0]))
+         return
+      try:
+         (family, address) = (addrinfo[0][0], addrinfo[0][4])
+         conn = HTTPClientConnection(self, key, address, family)
+      except socket.error as exc:
+         self._requests_fail(key, 'Unable to connect to {0!a}: {1}'.format(key, exc))
+         return
+      try:
+         self.connections[key].append(conn)
+      except KeyError:
+         self.connections[key] = [conn]
+      self._requests_dispatch(key)
+
+   def _requests_fail(self, key, error):
+      _log(30, error)
+      for req in self.requests_waiting.pop(key, ()):
+         req._finish(error=error)
+
+   def _connection_remove(self, conn):
+      conns = self.connections.get(conn.key, ())
+      if (conn in conns):
+         conns.remove(conn)
+         if not (conns):
+            del(self.connections[conn.key])
+
+   def close(self):
+      """Close all connections and drop pending requests"""
+      for req in self.resolver_requests.values():
+         if not (req is None):
+            req.cancel()
+      self.resolver_requests = {}
+      self.requests_waiting = {}
+      for conns in tuple(self.connections.values()):
+         for conn in tuple(conns):
+            conn.pool = None
+            conn.requests = deque()
+            conn.close()
+      self.connections = {}
+
+   def __repr__(self):
+      return '<{0} servers: {1} waiting: {2} id: {3}>'.format(
+         self.__class__.__name__, len(self.connections),
+         len(self.requests_waiting), id(self))
+
+
+def _selftest():
+   import gzip
+   body = b'd8:intervali1800e5:peers6:\x7f\x00\x00\x01\x1a\xe1e'
+   body_gz = gzip.compress(body)
+   resp_gzip = (b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n'
+      b'Content-Length: ' + str(len(body_gz)).encode('ascii') + b'\r\n\r\n' +
+      body_gz)
+   resp_chunked = (b'HTTP/1.1 100 Continue\r\n\r\n'
+      b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+      b'5;ext=1\r\n' + body[:5] + b'\r\n' +
+      '{0:x}\r\n'.format(len(body) - 5).encode('ascii') + body[5:] + b'\r\n'
+      b'0\r\nX-Trailer: 1\r\n\r\n')
+   resp_chunked_gzip = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+      b'Content-Encoding: gzip\r\n\r\n' +
+      '{0:x}\r\n'.format(len(body_gz)).encode('ascii') + body_gz +
+      b'\r\n0\r\n\r\n')
+   resp_head = (b'HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n')
+   
+   def responses_parse(data, step, heads):
+      """Parse pipelined responses from data, passed in step bytes at a
+         time"""
+      rv = []
+      parser = HTTPResponseParser(heads[0])
+      for i in range(0, len(data), step):
+         chunk = data[i:i+step]
+         while (chunk):
+            l = parser.data_process(chunk)
+            chunk = chunk[l:]
+            if (parser.done()):
+               rv.append(parser.response)
+               parser = HTTPResponseParser(heads[len(rv)] if (len(rv) < len(heads)) else False)
+      return (rv, parser)
+   
+   print('=== Test: Pipelined responses with split reads ===')
+   pipelined = resp_gzip + resp_head + resp_chunked + resp_chunked_gzip
+   heads = (False, True, False, False)
+   for step in (1, 2, 7, 64, len(pipelined)):
+      (rv, parser) = responses_parse(pipelined, step, heads)
+      if (len(rv) != 4):
+         raise Exception('Step {0}: got {1} responses, expected 4.'.format(step, len(rv)))
+      for (i, resp) in enumerate(rv):
+         expected = (b'' if heads[i] else body)
+         if ((resp.status != 200) or (resp.body != expected) or not
+               resp.keep_alive):
+            raise Exception('Step {0}: response {1} is {2!a} with body {3!a}.'.format(step, i, resp, resp.body))
+      if ((parser.state != parser.ST_STATUS) or parser.buf):
+         raise Exception('Step {0}: parser has leftover data {1!a}.'.format(step, parser.buf))
+   print('...passed.')
+   
+   print('=== Test: HTTP/1.0 response without content length ===')
+   for step in (1, 5, 1000):
+      data = b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n' + body
+      (rv, parser) = responses_parse(data, step, (False,))
+      if (rv or parser.done()):
+         raise Exception('Step {0}: response finished before EOF.'.format(step))
+      if not (parser.eof_process()):
+         raise Exception('Step {0}: response unfinished after EOF.'.format(step))
+      resp = parser.response
+      if ((resp.body != body) or resp.keep_alive):
+         raise Exception('Step {0}: got {1!a} with body {2!a}.'.format(step, resp, resp.body))
+   # Truncated length-delimited bodies must not be accepted at EOF.
+   parser = HTTPResponseParser()
+   parser.data_process(resp_gzip[:-1])
+   if (parser.eof_process()):
+      raise Exception('Truncated response accepted at EOF.')
+   print('...passed.')
+   
+   print('=== Test: Invalid responses ===')
+   for data in (b'ICY 200 OK\r\n\r\n',
+         b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n',
+         b'HTTP/1.1 200 OK\r\nContent-Length: -1\r\n\r\n',
+         b'HTTP/1.1 200 OK\r\nContent-Encoding: br\r\n\r\n'):
+      try:
+         HTTPResponseParser().data_process(data)
+      except HTTPClientError:
+         pass
+      else:
+         raise Exception('Parser accepted {0!a}.'.format(data))
+   print('...passed.')
+
+
+if (__name__ == '__main__'):
+   _selftest()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-torrent peer bookkeeping that outlives single connections"""
+
+import random
+from itertools import chain
+from time import time
+
+from .benc_structures import BTPeer, BTPeerTable
+
+
+class BTPeerRecord:
+   """Connection history of a single peer"""
+   fields = ('ts_seen', 'connects', 'connects_ok', 'failures', 'ts_retry',
+      'handshake_latency', 'rate_in')
+   def __init__(self, peer, ts_seen=None, connects=0, connects_ok=0,
+         failures=0, ts_retry=None, handshake_latency=None, rate_in=None):
+      self.peer = peer
+      # Last time we heard about this peer from outside
+      self.ts_seen = ts_seen
+      self.connects = connects
+      self.connects_ok = connects_ok
+      # Number of failures since the last successful connection
+      self.failures = failures
+      # Don't connect again before this time
+      self.ts_retry = ts_retry
+      # Smoothed seconds from connect to handshake, and bytes per second of
+      # content received from the peer
+      self.handshake_latency = handshake_latency
+      self.rate_in = rate_in
+
+   def score_get(self):
+      """Return score used to decide which peers to connect to first; higher
+         is better"""
+      rv = 0.0
+      if (self.connects_ok):
+         rv += 10
+      if not (self.rate_in is None):
+         # One point per 16KiB/s, so fast peers beat merely reachable ones.
+         rv += min(self.rate_in/16384, 20)
+      if not (self.handshake_latency is None):
+         rv -= min(self.handshake_latency, 10)/2
+      rv -= 5*self.failures
+      return rv
+
+   @staticmethod
+   def _smooth(old, new):
+      if (old is None):
+         return new
+      return (old + new)/2
+
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      rv = {
+         b'ip': str(self.peer.ip).encode('ascii'),
+         b'port': self.peer.port,
+         b'connects': self.connects,
+         b'connects_ok': self.connects_ok,
+         b'failures': self.failures
+      }
+      if not (self.peer.peer_id is None):
+         rv[b'peer id'] = self.peer.peer_id
+      for (key, val) in ((b'ts_seen', self.ts_seen),
+            (b'ts_retry', self.ts_retry)):
+         if not (val is None):
+            rv[key] = int(val)
+      if not (self.handshake_latency is None):
+         rv[b'handshake_latency_ms'] = int(self.handshake_latency*1000)
+      if not (self.rate_in is None):
+         rv[b'rate_in'] = int(self.rate_in)
+      return rv
+
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      handshake_latency = state.get(b'handshake_latency_ms')
+      if not (handshake_latency is None):
+         handshake_latency = int(handshake_latency)/1000
+      return cls(BTPeer.build_from_dict(state), state.get(b'ts_seen'),
+         int(state[b'connects']), int(state[b'connects_ok']),
+         int(state[b'failures']), state.get(b'ts_retry'), handshake_latency,
+         state.get(b'rate_in'))
+
+   def __repr__(self):
+      return '{0}({1!a}, **{2!a})'.format(self.__class__.__name__, self.peer,
+         dict((name, getattr(self, name)) for name in self.fields))
+
+
+class BTPeerStore:
+   """Set of known peers of a torrent, with per-peer connection history
+
+   Iterating over instances yields BTPeers, so they can be used in place of
+   a plain set of them. Peers we have only been told about are kept in
+   compact form in BTPeerTables; BTPeerRecords are built for them once we try
+   to connect. Peers that fail are retried with exponential backoff, and
+   forgotten after failures_max consecutive failures. Instances are pickled
+   in summarized form, so the history survives restarts."""
+   # Number of peers with history to remember; lowest-scoring ones are
+   # dropped beyond this
+   peers_max = 1000
+   # Number of untried peers to remember; random ones are dropped beyond this
+   peers_untried_max = 50000
+   # Delay before retrying a failed peer, doubled with each further failure
+   # up to backoff_max
+   backoff_base = 60
+   backoff_max = 3600
+   failures_max = 8
+   def __init__(self, records=(), tables=()):
+      # compact peer -> BTPeerRecord
+      self.records = {}
+      for rec in records:
+         self.records[rec.peer.packed_get()] = rec
+      # entry length -> untried peers
+      self.tables = {6: BTPeerTable(6), 18: BTPeerTable(18)}
+      for table in tables:
+         self.peers_add(table)
+
+   def __len__(self):
+      return len(self.records) + sum(len(t) for t in self.tables.values())
+
+   def __contains__(self, peer):
+      entry = peer.packed_get()
+      return ((entry in self.records) or (entry in self.tables[len(entry)]))
+
+   def __iter__(self):
+      return chain([rec.peer for rec in self.records.values()],
+         *[iter(table) for table in self.tables.values()])
+
+   def record_get(self, peer):
+      """Return BTPeerRecord of peer, or None if we haven't tried it yet"""
+      return self.records.get(peer.packed_get())
+
+   def add(self, peer, now=None):
+      """Remember peer we've been told about"""
+      entry = peer.packed_get()
+      rec = self.records.get(entry)
+      if (rec is None):
+         table = self.tables[len(entry)]
+         table.entry_add(entry)
+         self._table_trim(table)
+         return
+      if (now is None):
+         now = time()
+      if (rec.peer.peer_id is None):
+         rec.peer = peer
+      rec.ts_seen = now
+
+   def peers_add(self, peers, now=None):
+      """Remember peers from a BTPeerTable or sequence of BTPeers we've been
+         told about"""
+      if not (isinstance(peers, BTPeerTable)):
+         for peer in peers:
+            self.add(peer, now)
+         return
+      if (now is None):
+         now = time()
+      table = self.tables[peers.entry_length]
+      for entry in peers.entries_iter():
+         rec = self.records.get(entry)
+         if (rec is None):
+            table.entry_add(entry)
+         else:
+            rec.ts_seen = now
+      self._table_trim(table)
+
+   def discard(self, peer):
+      """Forget about peer, if we know it"""
+      entry = peer.packed_get()
+      if (self.records.pop(entry, None) is None):
+         self.tables[len(entry)].entry_remove(entry)
+
+   def _table_trim(self, table):
+      """Drop random untried peers from table to get down to
+         peers_untried_max"""
+      if (len(table) <= self.peers_untried_max + self.peers_untried_max//4):
+         return
+      for entry in table.entries_sample(len(table) - self.peers_untried_max):
+         table.entry_remove(entry)
+
+   def _trim(self):
+      """Drop lowest-scoring peers to get down to peers_max"""
+      items = sorted(self.records.items(), key=(lambda item:
+         (item[1].score_get(), item[1].ts_seen or 0)))
+      for (entry, rec) in items[:len(items) - self.peers_max]:
+         del(self.records[entry])
+
+   def connect_start(self, peer, now=None):
+      """Note that we're trying to connect to peer"""
+      entry = peer.packed_get()
+      rec = self.records.get(entry)
+      if (rec is None):
+         if not (self.tables[len(entry)].entry_remove(entry)):
+            return
+         if (now is None):
+            now = time()
+         rec = self.records[entry] = BTPeerRecord(peer, now)
+         if (len(self.records) > self.peers_max + self.peers_max//4):
+            self._trim()
+      rec.connects += 1
+
+   def connection_record(self, peer, handshake_latency, bytes_in, duration):
+      """Record stats of a finished outgoing connection to peer;
+         handshake_latency is None if it never completed a handshake"""
+      rec = self.records.get(peer.packed_get())
+      if (rec is None):
+         return
+      if (handshake_latency is None):
+         self.failure_record(peer)
+         return
+      rec.connects_ok += 1
+      rec.failures = 0
+      rec.ts_retry = None
+      rec.handshake_latency = rec._smooth(rec.handshake_latency,
+         handshake_latency)
+      if (duration > 0):
+         rec.rate_in = rec._smooth(rec.rate_in, bytes_in/duration)
+
+   def failure_record(self, peer, now=None):
+      """Note failure to connect to or talk with peer, and back off from it"""
+      entry = peer.packed_get()
+      rec = self.records.get(entry)
+      if (rec is None):
+         return
+      if (now is None):
+         now = time()
+      rec.failures += 1
+      if (rec.failures >= self.failures_max):
+         del(self.records[entry])
+         return
+      rec.ts_retry = now + min(self.backoff_base*2**(rec.failures - 1),
+         self.backoff_max)
+
+   def _untried_sample(self, count, exclude):
+      """Return up to count randomly picked untried peers not in exclude"""
+      entries = []
+      for table in self.tables.values():
+         entries.extend(e for e in table.entries_sample(count + len(exclude))
+            if not (e in exclude))
+      if (len(entries) > count):
+         entries = random.sample(entries, count)
+      return [BTPeer.build_from_packed(e) for e in entries]
+
+   def peers_connectable_get(self, count, exclude=(), now=None):
+      """Return up to count best-scoring peers that aren't in exclude and
+         not currently backed off from
+
+      Peers that have worked before come first, then untried ones, then ones
+      with a bad record."""
+      if (now is None):
+         now = time()
+      exclude = set(peer.packed_get() for peer in exclude)
+      recs = [rec for (entry, rec) in self.records.items() if (((rec.ts_retry
+         is None) or (rec.ts_retry <= now)) and not (entry in exclude))]
+      # Shuffle first, so peers with equal scores are picked at random.
+      random.shuffle(recs)
+      recs = [(rec.score_get(), rec) for rec in recs]
+      recs.sort(key=(lambda r: r[0]), reverse=True)
+      rv = [rec.peer for (score, rec) in recs if (score > 0)][:count]
+      if (len(rv) < count):
+         rv.extend(self._untried_sample(count - len(rv), exclude))
+      if (len(rv) < count):
+         rv.extend([rec.peer for (score, rec) in recs
+            if (score <= 0)][:count - len(rv)])
+      return rv
+
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      return {
+         b'records': [rec.state_get() for rec in self.records.values()],
+         b'peers': self.tables[6].data_get(),
+         b'peers6': self.tables[18].data_get()
+      }
+
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      return cls([BTPeerRecord.build_from_state(s) for s in
+         state[b'records']], (BTPeerTable(6, state.get(b'peers', b'')),
+         BTPeerTable(18, state.get(b'peers6', b''))))
+
+   def __getstate__(self):
+      return {'records': [rec.state_get() for rec in self.records.values()],
+         'tables': tuple(self.tables.values())}
+
+   def __setstate__(self, state):
+      self.__init__((BTPeerRecord.build_from_state(s)
+         for s in state['records']), state.get('tables', ()))
+
+   def __repr__(self):
+      return '<{0} peers: {1} untried: {2} id: {3}>'.format(
+         self.__class__.__name__, len(self.records),
+         sum(len(t) for t in self.tables.values()), id(self))
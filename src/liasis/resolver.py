@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous hostname resolution with result caching"""
+
+import logging
+import socket
+import time
+
+from .worker_pool import WorkerPool
+
+_logger = logging.getLogger('Resolver')
+_log = _logger.log
+
+
+def getaddrinfo_catch(host, port, family, type):
+   """Call socket.getaddrinfo(); return None instead of raising socket
+      errors"""
+   try:
+      return socket.getaddrinfo(host, port, family, type)
+   except socket.error:
+      return None
+
+
+def getaddrinfo_numeric(host, port, family=0, type=0):
+   """Return getaddrinfo() results for host if it is a literal IP address,
+      None otherwise; never blocks"""
+   try:
+      return socket.getaddrinfo(host, port, family, type, 0,
+         socket.AI_NUMERICHOST)
+   except socket.error:
+      return None
+
+
+class ResolverRequest:
+   """Pending or finished hostname lookup
+
+   After the lookup has finished, addrinfo is a list of getaddrinfo()
+   results, or None if the lookup failed."""
+   def __init__(self, host, port, callback):
+      self.host = host
+      self.port = port
+      self.callback = callback
+      self.addrinfo = None
+      self.done = False
+
+   def _finish(self, addrinfo):
+      self.addrinfo = addrinfo
+      self.done = True
+      callback = self.callback
+      self.callback = None
+      if not (callback is None):
+         callback(self)
+
+   def cancel(self):
+      """Don't call our callback once the lookup finishes"""
+      self.callback = None
+
+   def __repr__(self):
+      return '<{0} host: {1!a} port: {2!a} id: {3}>'.format(
+         self.__class__.__name__, self.host, self.port, id(self))
+
+
+class AsyncResolver:
+   """Resolve hostnames without blocking the event loop
+
+   Lookups are done by getaddrinfo() calls on a pool of worker threads.
+   Results are cached for a fixed time, since getaddrinfo() doesn't tell us
+   about record TTLs; concurrent lookups of the same name are merged."""
+   # Seconds to cache successful and failed lookups for
+   ttl = 300
+   ttl_negative = 60
+   # Number of cached results above which we start throwing out expired ones
+   cache_size_max = 1024
+   workers_default = 4
+   def __init__(self, event_dispatcher, workers=None):
+      if (workers is None):
+         workers = self.workers_default
+      self.pool = WorkerPool(event_dispatcher, workers)
+      # (host, port, family, type) -> (expiry ts, addrinfo)
+      self.cache = {}
+      # (host, port, family, type) -> list of ResolverRequests
+      self.requests_pending = {}
+
+   def resolve(self, host, port, callback, family=0, type=0):
+      """Look up host and pass ResolverRequest to callback once done; if the
+         result is known already, callback is called before this returns"""
+      req = ResolverRequest(host, port, callback)
+      addrinfo = getaddrinfo_numeric(host, port, family, type)
+      if not (addrinfo is None):
+         req._finish(addrinfo)
+         return req
+
+      key = (host, port, family, type)
+      try:
+         (ts_expire, addrinfo) = self.cache[key]
+      except KeyError:
+         pass
+      else:
+         if (ts_expire > time.time()):
+            req._finish(addrinfo)
+            return req
+         del(self.cache[key])
+
+      if (key in self.requests_pending):
+         self.requests_pending[key].append(req)
+         return req
+
+      self.requests_pending[key] = [req]
+      def cb(wp_req):
+         self._lookup_finish(key, wp_req)
+      self.pool.call(getaddrinfo_catch, key, cb)
+      return req
+
+   def _lookup_finish(self, key, wp_req):
+      """Cache result of finished lookup and pass it on to requests"""
+      addrinfo = wp_req.rv
+      if (wp_req.failed or not addrinfo):
+         addrinfo = None
+         ttl = self.ttl_negative
+         _log(25, 'Failed to resolve {0!a}.'.format(key[0]))
+      else:
+         ttl = self.ttl
+
+      now = time.time()
+      if (len(self.cache) >= self.cache_size_max):
+         for (k, (ts_expire, ai)) in tuple(self.cache.items()):
+            if (ts_expire <= now):
+               del(self.cache[k])
+      self.cache[key] = (now + ttl, addrinfo)
+
+      for req in self.requests_pending.pop(key, ()):
+         req._finish(addrinfo)
+
+   def close(self):
+      """Shut down workers and drop pending lookups"""
+      self.pool.close()
+      self.requests_pending = {}
+      self.cache = {}
+
+   def __repr__(self):
+      return '<{0} cached: {1} pending: {2} id: {3}>'.format(
+         self.__class__.__name__, len(self.cache), len(self.requests_pending),
+         id(self))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Small statistics-keeping structures for runtime instrumentation"""
+
+from bisect import bisect_left
+from math import exp
+from time import time
+
+
+class LatencyHistogram:
+   """Histogram of latency values with logarithmically spaced buckets
+
+   Values are specified in seconds. Bucket i counts all values that are
+   bigger than the upper bound of bucket (i-1), and not bigger than
+   bucket_bounds[i]; the last bucket counts everything bigger than the
+   biggest bound."""
+   # 0.5ms to ~16s
+   bucket_bounds = tuple(0.0005*2**i for i in range(16))
+
+   def __init__(self, counts=None, total=0.0):
+      if (counts is None):
+         counts = [0]*(len(self.bucket_bounds) + 1)
+      elif (len(counts) != (len(self.bucket_bounds) + 1)):
+         raise ValueError('Got {0} bucket counts; expected {1}.'.format(len(counts), len(self.bucket_bounds) + 1))
+      self.counts = counts
+      self.total = total
+
+   def value_add(self, val):
+      """Count specified latency value"""
+      self.counts[bisect_left(self.bucket_bounds, val)] += 1
+      self.total += val
+
+   def count_get(self):
+      """Return number of values counted"""
+      return sum(self.counts)
+
+   def mean_get(self):
+      """Return mean of counted values, or None if there aren't any"""
+      count = self.count_get()
+      if (count == 0):
+         return None
+      return self.total/count
+
+   def quantile_get(self, q):
+      """Return upper bucket bound of the specified quantile, or None if no
+         values have been counted or the quantile is in the overflow bucket"""
+      count = self.count_get()
+      if (count == 0):
+         return None
+
+      target = q*count
+      acc = 0
+      for (i, c) in enumerate(self.counts):
+         acc += c
+         if (acc >= target):
+            break
+      if (i >= len(self.bucket_bounds)):
+         return None
+      return self.bucket_bounds[i]
+
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      return {
+         b'bounds_us': [int(b*1000000) for b in self.bucket_bounds],
+         b'counts': list(self.counts),
+         b'total_us': int(self.total*1000000)
+      }
+
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      bounds = tuple(int(b)/1000000 for b in state[b'bounds_us'])
+      counts = [int(c) for c in state[b'counts']]
+      rv = cls.__new__(cls)
+      if (bounds != cls.bucket_bounds):
+         rv.bucket_bounds = bounds
+      LatencyHistogram.__init__(rv, counts, int(state[b'total_us'])/1000000)
+      return rv
+
+   def __repr__(self):
+      return '{0}({1!a}, {2!a})'.format(self.__class__.__name__, self.counts, self.total)
+
+
+class EWMARate:
+   """Exponentially weighted moving average of a transfer rate
+   
+   Each amount of bytes counted is added to the estimate after decaying the
+   previous value by exp(-dt/time_constant); for a steady stream of data, the
+   estimate converges to its rate in bytes per second. Timestamps are
+   time.time() values; callers that already know the current time can pass
+   it in."""
+   time_constant = 10.0
+   def __init__(self, time_constant=None, rate=0.0, ts=None):
+      if not (time_constant is None):
+         self.time_constant = time_constant
+      self.rate = rate
+      self.ts = ts
+   
+   def _decay(self, now):
+      if (self.ts is None):
+         self.ts = now
+         return
+      dt = now - self.ts
+      if (dt > 0):
+         self.rate *= exp(-dt/self.time_constant)
+         self.ts = now
+   
+   def value_add(self, val, now=None):
+      """Count <val> bytes transferred at time <now>"""
+      if (now is None):
+         now = time()
+      self._decay(now)
+      self.rate += val/self.time_constant
+   
+   def rate_get(self, now=None):
+      """Return estimated rate in bytes per second at time <now>"""
+      if (now is None):
+         now = time()
+      self._decay(now)
+      return self.rate
+   
+   def state_get(self):
+      """Summarize internal state using nested dicts, lists, ints and strings"""
+      return {
+         b'rate': int(self.rate_get()),
+         b'time_constant_ms': int(self.time_constant*1000)
+      }
+   
+   @classmethod
+   def build_from_state(cls, state):
+      """Build instance from summarized internal state"""
+      return cls(int(state[b'time_constant_ms'])/1000, float(state[b'rate']))
+   
+   def __repr__(self):
+      return '{0}({1!a}, {2!a}, {3!a})'.format(self.__class__.__name__,
+         self.time_constant, self.rate, self.ts)
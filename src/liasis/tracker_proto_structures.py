@@ -23,18 +23,18 @@
 # FIXME: add options to limit allowed address families for this?
 
 import logging
-import http.client
 import random
 import socket
 import struct
-import urllib.request
+import time
 from urllib.parse import quote
 
-from gonium.hacks.asynchttpc import build_async_opener
-from gonium.fdm import AsyncDataStream, AsyncPacketSock
+from gonium.fdm import AsyncPacketSock
 
-from .benc_structures import py_from_benc_str, BTPeer
+from .benc_structures import py_from_benc_str, BTPeer, BTPeerTable
 from .url_parsing import HTTPLikeURL
+from .resolver import getaddrinfo_catch
+from .http_client import HTTPRequest, HTTPClientPool
 
 
 class TrackerRequestError(Exception):
@@ -55,6 +55,7 @@ class TrackerRequest:
       for field in self.fields:
          setattr(self, field, locals()[field])
       self.announce_url = announce_url
+      self.resolver_request = None
       
    def address_get(self, default_port=None):
       """Determine (host, port) tuple."""
@@ -64,18 +65,60 @@ class TrackerRequest:
          port = default_port
       
       return (url.host, port)
+   
+   def address_resolve(self, resolver, callback, default_port=None,
+         sock_type=0):
+      """Look up tracker address and pass list of getaddrinfo() results (or
+         None on failure) to callback; this will block if resolver is None"""
+      (host, port) = self.address_get(default_port)
+      if (resolver is None):
+         callback(getaddrinfo_catch(host, port, 0, sock_type))
+         return
+      
+      def cb(req):
+         self.resolver_request = None
+         callback(req.addrinfo)
+      
+      req = resolver.resolve(host, port, cb, type=sock_type)
+      if not (req.done):
+         self.resolver_request = req
+   
+   def resolver_request_cancel(self):
+      """Cancel pending tracker address lookup, if any"""
+      if not (self.resolver_request is None):
+         self.resolver_request.cancel()
+         self.resolver_request = None
+   
+   @staticmethod
+   def peers_build(peers):
+      """Build peers from peer list of tracker response; returns (BTPeers
+         or BTPeerTable, list of (hostname, port, peer_id) tuples for peers
+         specified by hostname)"""
+      if not (isinstance(peers, (list, tuple))):
+         # Compact form; keep it that way.
+         return (BTPeerTable(6, peers), [])
+      rv = []
+      hostname_peers = []
+      for peer_dict in peers:
+         try:
+            rv.append(BTPeer.build_from_dict(peer_dict))
+         except ValueError:
+            hostname_peers.append((peer_dict[b'ip'], peer_dict[b'port'],
+               peer_dict.get(b'peer id')))
+      return (tuple(rv), hostname_peers)
 
 
 class HTTPTrackerRequest(TrackerRequest):
    proto = b'http'
+   # There's at least one tracker which doesn't seem to like
+   # Python-urllib-2.4 UA strings. Besides, this is more informative.
+   headers = ((b'User-Agent', b'Liasis'),)
    def __init__(self, *args, **kwargs):
       TrackerRequest.__init__(self, *args, **kwargs)
-      self.connection = None
-      self.od = build_async_opener()
+      self.http_request = None
+      self.http_pool_own = None
       self.result_callback = None
       self.error_callback = None
-      self.clean_up_active = False
-      self.data = None
    
    def req_url_get(self):
       rlist = []
@@ -92,38 +135,45 @@ class HTTPTrackerRequest(TrackerRequest):
       
       return '?'.join((self.announce_url.decode('ascii'), '&'.join(rlist)))
 
-   def request_build(self):
-      # There's at least one tracker which doesn't seem to like
-      # Python-urllib-2.4 UA strings. Besides, this is more informative.
-      ul_req = urllib.request.Request(self.req_url_get(), None, {'User-Agent':'Liasis'})
-      (got_exc, hcd) = self.od.open(ul_req, responses=())
-      
-      if not (got_exc):
-         raise TrackerRequestError("http.client hack failed.")
-      
-      return hcd.req_string
-
-   def conn_input_handle(self, data):
-      self.data = data
+   def request_build(self, callback):
+      """Build and return HTTPRequest for our request URL"""
+      url = HTTPLikeURL.build_from_urlstring(self.req_url_get().encode('ascii'))
+      if (url.proto != self.proto):
+         raise ValueError('Unsupported proto {0!a} in URL {1!a}.'.format(url.proto, self.announce_url))
+      port = url.port
+      if (port is None):
+         port = 80
+      return HTTPRequest(url.host, port, b'/' + url.path, callback,
+         headers=self.headers)
 
-   def conn_close_handle(self):
-      """Handle closing of fd from our http connection: process data and pass result to callback"""
-      if (self.clean_up_active):
-         # Nothing to see here. Result is almost certainly incomplete
-         return
-      response_http = self.data
-      if (response_http is None):
-         self.log(30, 'Tracker request to {0!a} failed; received no data.'.format(self.announce_url), exc_info=False)
-         self.error_callback(self)
+   def response_data_process(self, response_data):
+      """Validate and convert decoded response; returns data to pass to
+         result callback"""
+      # According to wiki.theory.org, 'ip' entries from the dicts can also
+      # be hostnames; we pass those on for asynchronous lookup.
+      (response_data[b'peers'], response_data[b'peers_hostname']) = \
+         self.peers_build(response_data[b'peers'])
+      if (b'peers6' in response_data):
+         response_data[b'peers6'] = BTPeerTable(18, response_data[b'peers6'])
+      return response_data
+   
+   def http_response_handle(self, http_request):
+      """Handle finished HTTP request: process data and pass result to
+         callback"""
+      self.http_request = None
+      result_callback = self.result_callback
+      error_callback = self.error_callback
+      response = http_request.response
+      if (response is None):
+         self.log(30, 'Tracker request to {0!a} failed: {1}'.format(self.announce_url, http_request.error), exc_info=False)
+         self.close()
+         error_callback(self)
          return
       try:
-         (got_exc, urlo) = self.od.open(self.req_url_get(), responses=(bytes(response_http),))
-         
-         if (got_exc):
-            raise TrackerResponseError('HTTP parsing failed; got followup request: {0!a}'.format(urlo,))
+         if (response.status != 200):
+            raise TrackerResponseError('Tracker {0!a} returned HTTP status {1} {2!a}.'.format(self.announce_url, response.status, response.reason))
          
-         response_text = urlo.read()
-         response_data = py_from_benc_str(response_text)
+         response_data = py_from_benc_str(response.body)
          
          if (b'failure reason' in response_data):
             fr = response_data[b'failure reason']
@@ -131,56 +181,51 @@ class HTTPTrackerRequest(TrackerRequest):
             raise TrackerResponseError('Tracker {0!a} returned failure reason {1!a}. Complete response data: {2!a}'.format(self.announce_url, fr, response_data))
          if (b'warning message' in response_data):
             wm = response_data[b'warning message']
-            self.log(30, 'Got warning message {0!a} from tracker {1!a}.'.format(fr, self.announce_url))
+            self.log(30, 'Got warning message {0!a} from tracker {1!a}.'.format(wm, self.announce_url))
          
-         # FIXME: According to wiki.theory.org, 'peer id' entries from the tuples
-         # can also be hostnames. This hasn't been observed in practice, but we
-         # should catch it here and do some kind of asynchronous lookup if they are.
-         response_data[b'peers'] = BTPeer.seq_build(response_data[b'peers'])
-      except (Exception, http.client.HTTPException) as exc:
-         self.error_callback(self)
-         self.log(30, 'Tracker request to {0!a} failed. Resultstring: {1!a}. Error: {2!a} ({3!a})'.format(self.announce_url, bytes(response_http), exc, str(exc)), exc_info=False)
+         response_data = self.response_data_process(response_data)
+      except Exception as exc:
+         self.log(30, 'Tracker request to {0!a} failed. Resultstring: {1!a}. Error: {2!a} ({3!a})'.format(self.announce_url, response.body, exc, str(exc)), exc_info=False)
+         self.close()
+         error_callback(self)
       else:
-         self.result_callback(self, response_data)
-         self.connection = None
          self.close()
+         result_callback(self, response_data)
    
-   def request_send(self, event_dispatcher, result_callback, error_callback):
-      """Open connection to announce url, open and send request"""
-      if not (self.connection is None):
-         raise TrackerRequestError("Request {0!a} is still pending.".format(self.connection))
+   def request_send(self, event_dispatcher, result_callback, error_callback,
+         resolver=None, udp_mux=None, http_pool=None):
+      """Send request to tracker; if http_pool is specified, connections to
+         the tracker are shared with other requests through it. udp_mux is
+         ignored."""
+      if not (self.http_request is None):
+         raise TrackerRequestError("Request {0!a} is still pending.".format(self.http_request))
       
       try:
-         request_string = self.request_build()
-      except urllib.request.URLError:
+         http_request = self.request_build(self.http_response_handle)
+      except ValueError:
          self.log(30, 'Error building request for {0!a}:'.format(self.req_url_get()), exc_info=True)
          error_callback(self)
          return
       
-      try:
-         self.connection = AsyncDataStream.build_sock_connect(event_dispatcher,
-            self.address_get(default_port=80))
-      except socket.error:
-         self.connection = None
-         self.result_callback = None
-         self.error_callback = None
-         error_callback(self)
-         return
-      
-      self.connection.process_input = self.conn_input_handle
-      self.connection.process_close = self.conn_close_handle
       self.result_callback = result_callback
       self.error_callback = error_callback
+      if (http_pool is None):
+         http_pool = self.http_pool_own = HTTPClientPool(event_dispatcher,
+            resolver)
       
-      self.connection.send_bytes((request_string,))
+      self.http_request = http_request
+      http_pool.request_send(http_request)
 
    def close(self):
-      self.clean_up_active = True
-      if (self.connection):
-         self.connection.close()
-      self.connection = None
-      self.callback_handler = None
-      self.clean_up_active = False
+      self.resolver_request_cancel()
+      if not (self.http_request is None):
+         self.http_request.cancel()
+         self.http_request = None
+      if not (self.http_pool_own is None):
+         self.http_pool_own.close()
+         self.http_pool_own = None
+      self.result_callback = None
+      self.error_callback = None
 
 
 # Implementation of protocol described on
@@ -210,6 +255,8 @@ class UDPTrackerRequest(TrackerRequest):
    def __init__(self, *args, **kwargs):
       TrackerRequest.__init__(self, *args, **kwargs)
       self.sock = None
+      self.mux = None
+      self.transaction_id = None
       self.timeout_timer = None
       self.close()
    
@@ -218,6 +265,16 @@ class UDPTrackerRequest(TrackerRequest):
       """Return a random 32bit signed integer"""
       return random.randint(-1*2**31,2**31-1)
    
+   def transaction_id_new(self):
+      """Pick a new transaction id, registering it with our mux if we use
+         one"""
+      if (self.mux is None):
+         self.transaction_id = self.tid_generate()
+         return
+      if not (self.transaction_id is None):
+         self.mux.tid_unregister(self.transaction_id)
+      self.transaction_id = self.mux.tid_register(self)
+   
    def frame_build_init(self, tid=None):
       """Build and return frame for initiating session to tracker"""
       if (tid is None):
@@ -237,7 +294,7 @@ class UDPTrackerRequest(TrackerRequest):
       
       key = self.key
       if (key is None):
-         key = ''
+         key = b''
       key = key[-4:]
       return struct.pack('>qll20s20sqqqlL4slHH', self.connection_id,
          self.ACTION_ANNOUNCE, tid, self.info_hash, self.peer_id,
@@ -259,16 +316,10 @@ class UDPTrackerRequest(TrackerRequest):
          raise ValueError('Data {0!a} invalid; length {1} does not satisfy (((l - 12) % 6) == 0) condition.'.format(data, len(data)))
       
       (interval, seeders, leechers) = struct.unpack('>lll', data[:12])
-      peers = BTPeer.seq_build(data[12:])
-      
-      peers_filtered = []
-      for peer in peers:
-         if ((int(peer.ip) == 0) or (peer.port == 0)):
-            self.log(30, '{0} for invalid BTPeer data {1!a}. Discarding.'.format(self, peer))
-            continue
-         peers_filtered.append(peer)
-      
-      peers = peers_filtered
+      peers = BTPeerTable(6, data[12:])
+      peers_invalid = (len(data) - 12)//6 - len(peers)
+      if (peers_invalid):
+         self.log(30, '{0} got {1} invalid or duplicate peer entries. Discarding.'.format(self, peers_invalid))
       
       # Build response data manually, since it doesn't exist at protocol level
       response_data = {
@@ -291,7 +342,9 @@ class UDPTrackerRequest(TrackerRequest):
       if (self.state != 0):
          raise TrackerResponseError('{0!a}.frame_process_init({1!a}) got called while state == {2!a}.'.format(self, data, self.state))
       self.connection_id = self.frame_parsebody_init(data)
-      self.transaction_id = self.tid_generate()
+      if not (self.mux is None):
+         self.mux.connection_id_set(self.tracker_address, self.connection_id)
+      self.transaction_id_new()
       self.state = 1
       try:
          self.frame_send(self.frame_build_announce())
@@ -312,6 +365,9 @@ class UDPTrackerRequest(TrackerRequest):
    def frame_process_error(self, data):
       """Process error response"""
       self.log(30, '{0!a} got error {1!a} from tracker.'.format(self, data))
+      if ((self.state == 1) and not (self.mux is None)):
+         # Possibly caused by our connection id having expired.
+         self.mux.connection_id_drop(self.tracker_address)
       self.error_callback(TrackerResponseError('Tracker {0!a} returned failure reason {1!a}.'.format(self.announce_url, data)))
       self.close()
     
@@ -323,7 +379,7 @@ class UDPTrackerRequest(TrackerRequest):
     
    def frame_process(self, data, source):
       """Process UDP frame received from tracker"""
-      if (source != self.tracker_address):
+      if (tuple(source[:2]) != self.tracker_address):
          # Not what we're expecting.
          self.log(30, '{0!a} got unexpected udp frame {1!a} from {2!a}. Discarding.'.format(self, data, source))
          return
@@ -348,6 +404,9 @@ class UDPTrackerRequest(TrackerRequest):
     
    def frame_send(self, data):
       """Send frame to tracker"""
+      if not (self.mux is None):
+         self.mux.frame_send(self.tracker_af, data, self.tracker_address)
+         return
       self.sock.send_bytes((data,), self.tracker_address)
    
    def _timeout_fake(self):
@@ -355,36 +414,53 @@ class UDPTrackerRequest(TrackerRequest):
          self.timeout_timer.cancel()
       self.timeout_timer = self.ed.set_timer(0, self.timeout_handle)
    
-   def request_send(self, event_dispatcher, result_callback, error_callback):
-      """Initiate announce sequence"""
-      if not (self.state is None):
+   def request_send(self, event_dispatcher, result_callback, error_callback,
+         resolver=None, udp_mux=None, http_pool=None):
+      """Initiate announce sequence; if udp_mux is specified, its shared
+         sockets and cached connection ids are used. http_pool is ignored."""
+      if not ((self.state is None) and (self.resolver_request is None)):
          raise TrackerRequestError("Request {0!a} is still pending.".format(self.sock))
       
       self.result_callback = result_callback
       self.error_callback = error_callback
       
       self.ed = event_dispatcher
-      
-      try:
-         tracker_addrinfo = random.choice(socket.getaddrinfo(*self.address_get()))
-      except socket.error as exc:
+      self.mux = udp_mux
+      self.address_resolve(resolver, self._session_start,
+         sock_type=socket.SOCK_DGRAM)
+   
+   def _session_start(self, addrinfo):
+      """Open socket to looked-up tracker address and send init frame"""
+      event_dispatcher = self.ed
+      if not (addrinfo):
          self.log(35, "Connection to tracker {0} failed; found no valid records. Faking timeout.".format(self.address_get()))
          self._timeout_fake()
          return
+      tracker_addrinfo = random.choice(addrinfo)
       
-      tracker_AF = tracker_addrinfo[0]
-      rsock = socket.socket(tracker_AF, socket.SOCK_DGRAM)
+      self.tracker_af = tracker_addrinfo[0]
+      self.tracker_address = tuple(tracker_addrinfo[4][:2])
+      if (self.mux is None):
+         rsock = socket.socket(self.tracker_af, socket.SOCK_DGRAM)
+         self.sock = AsyncPacketSock(event_dispatcher, rsock)
+         self.sock.process_input = self.frame_process
+         self.sock.process_close = (lambda *args: None)
+         connection_id = None
+      else:
+         connection_id = self.mux.connection_id_get(self.tracker_address)
       
-      self.sock = AsyncPacketSock(event_dispatcher, rsock)
-      self.sock.process_input = self.frame_process
-      self.sock.process_close = (lambda *args: None)
-       
-      self.transaction_id = self.tid_generate()
-      self.state = 0
-      self.tracker_address = tracker_addrinfo[4][:2]
+      self.transaction_id_new()
+      if (connection_id is None):
+         self.state = 0
+         frame = self.frame_build_init()
+      else:
+         # Reuse recent handshake.
+         self.connection_id = connection_id
+         self.state = 1
+         frame = self.frame_build_announce()
       
       try:
-         self.frame_send(self.frame_build_init())
+         self.frame_send(frame)
       except socket.error as exc:
          # Ugly hack, but modeling explicitly reported send failure different
          # from a timeout isn't worth the hassle.
@@ -395,6 +471,7 @@ class UDPTrackerRequest(TrackerRequest):
     
    def close(self):
       """Close socket, if opened, and reset state variables"""
+      self.resolver_request_cancel()
       self.ed = None
       if (self.sock):
          self.sock.close()
@@ -402,20 +479,228 @@ class UDPTrackerRequest(TrackerRequest):
       if not (self.timeout_timer is None):
          self.timeout_timer.cancel()
          self.timeout_timer = None
+      if not ((self.mux is None) or (self.transaction_id is None)):
+         self.mux.tid_unregister(self.transaction_id)
+      self.mux = None
       self.connection_id = None
       self.state = None
       self.transaction_id = None
+      self.tracker_af = None
       self.tracker_address = None
       self.result_callback = None
       self.error_callback = None
 
 
+class UDPTrackerMux:
+   """Shared UDP sockets for talking to UDP trackers
+   
+   One socket is opened per address family, and incoming frames are passed
+   to the UDPTrackerRequest they belong to by transaction id. Connection ids
+   are remembered per tracker address for as long as the protocol allows
+   their reuse, so announces of many torrents to one tracker can share a
+   single handshake."""
+   logger = logging.getLogger('UDPTrackerMux')
+   log = logger.log
+   # Seconds for which a connection id may be used after receiving it
+   connection_id_ttl = 60
+   def __init__(self, event_dispatcher):
+      self.ed = event_dispatcher
+      self.socks = {}
+      self.requests = {}
+      # tracker address -> (expiry ts, connection id)
+      self.connection_ids = {}
+   
+   def tid_register(self, request):
+      """Pick unused transaction id and associate it with request"""
+      tid = UDPTrackerRequest.tid_generate()
+      while (tid in self.requests):
+         tid = UDPTrackerRequest.tid_generate()
+      self.requests[tid] = request
+      return tid
+   
+   def tid_unregister(self, tid):
+      """Forget about specified transaction id"""
+      self.requests.pop(tid, None)
+   
+   def connection_id_get(self, address):
+      """Return cached connection id for tracker address, or None"""
+      try:
+         (ts_expire, connection_id) = self.connection_ids[address]
+      except KeyError:
+         return None
+      if (ts_expire <= time.time()):
+         del(self.connection_ids[address])
+         return None
+      return connection_id
+   
+   def connection_id_set(self, address, connection_id):
+      """Remember connection id received from tracker address"""
+      now = time.time()
+      for (addr, (ts_expire, cid)) in tuple(self.connection_ids.items()):
+         if (ts_expire <= now):
+            del(self.connection_ids[addr])
+      self.connection_ids[address] = (now + self.connection_id_ttl,
+         connection_id)
+   
+   def connection_id_drop(self, address):
+      """Forget cached connection id for tracker address"""
+      self.connection_ids.pop(address, None)
+   
+   def sock_get(self, af):
+      """Return our socket for specified address family, opening it if
+         necessary"""
+      try:
+         return self.socks[af]
+      except KeyError:
+         pass
+      sock = AsyncPacketSock(self.ed, socket.socket(af, socket.SOCK_DGRAM))
+      sock.process_input = self.frame_process
+      def process_close(*args):
+         if (self.socks.get(af) is sock):
+            del(self.socks[af])
+      sock.process_close = process_close
+      self.socks[af] = sock
+      return sock
+   
+   def frame_send(self, af, data, address):
+      """Send frame to tracker at address"""
+      self.sock_get(af).send_bytes((data,), address)
+   
+   def frame_process(self, data, source):
+      """Pass UDP frame to the request it belongs to"""
+      if (len(data) < 8):
+         self.log(30, '{0!a} got short udp frame {1!a} from {2!a}. Discarding.'.format(self, data, source))
+         return
+      (tid,) = struct.unpack('>l', data[4:8])
+      try:
+         request = self.requests[tid]
+      except KeyError:
+         self.log(30, '{0!a} got udp frame {1!a} with unknown tid from {2!a}. Discarding.'.format(self, data, source))
+         return
+      request.frame_process(data, source)
+   
+   def close(self):
+      """Close sockets and forget about requests and connection ids"""
+      for sock in tuple(self.socks.values()):
+         sock.close()
+      self.socks = {}
+      self.requests = {}
+      self.connection_ids = {}
+   
+   def __repr__(self):
+      return '<{0} socks: {1} requests: {2} id: {3}>'.format(
+         self.__class__.__name__, len(self.socks), len(self.requests), id(self))
+
+
+def scrape_url_get(announce_url):
+   """Return scrape URL corresponding to announce URL, or None if the tracker
+      doesn't support scraping by convention"""
+   proto = HTTPLikeURL.build_from_urlstring(announce_url).proto
+   if (proto == UDPTrackerRequest.proto):
+      # UDP trackers scrape on the same address.
+      return announce_url
+   url_split = announce_url.split(b'/')
+   if not (url_split[-1].startswith(b'announce')):
+      return None
+   url_split[-1] = b'scrape' + url_split[-1][8:]
+   return b'/'.join(url_split)
+
+
+class HTTPTrackerScrapeRequest(HTTPTrackerRequest):
+   """Scrape of a set of torrents from a HTTP tracker
+   
+   Results are passed to the result callback as a dict mapping info hashes to
+   dicts with b'complete', b'incomplete' and b'downloaded' counts."""
+   # Limit on info hashes per request, to keep request URLs reasonably short
+   info_hashes_max = 64
+   def __init__(self, scrape_url, info_hashes):
+      self.announce_url = scrape_url
+      self.info_hashes = tuple(info_hashes)
+      self.resolver_request = None
+      self.http_request = None
+      self.http_pool_own = None
+      self.result_callback = None
+      self.error_callback = None
+   
+   def req_url_get(self):
+      args = '&'.join('info_hash=' + quote(info_hash, safe=b'')
+         for info_hash in self.info_hashes)
+      url = self.announce_url.decode('ascii')
+      if ('?' in url):
+         return '&'.join((url, args))
+      return '?'.join((url, args))
+   
+   def response_data_process(self, response_data):
+      rv = {}
+      for (info_hash, stats) in response_data[b'files'].items():
+         rv[info_hash] = dict((key, int(stats.get(key, 0))) for key in
+            (b'complete', b'incomplete', b'downloaded'))
+      return rv
+
+
+class UDPTrackerScrapeRequest(UDPTrackerRequest):
+   """Scrape of a set of torrents from a UDP tracker
+   
+   Results are passed to the result callback in the same format as used by
+   HTTPTrackerScrapeRequest."""
+   # Protocol limit on info hashes per request
+   info_hashes_max = 74
+   def __init__(self, scrape_url, info_hashes):
+      self.announce_url = scrape_url
+      self.info_hashes = tuple(info_hashes)
+      if (len(self.info_hashes) > self.info_hashes_max):
+         raise ValueError('Got {0} info hashes; protocol limit is {1}.'.format(len(self.info_hashes), self.info_hashes_max))
+      self.resolver_request = None
+      self.sock = None
+      self.mux = None
+      self.transaction_id = None
+      self.timeout_timer = None
+      self.close()
+   
+   def frame_build_announce(self, tid=None, **kwargs):
+      """Build and return scrape frame; sent in place of an announce"""
+      if (tid is None):
+         tid = self.transaction_id
+      return b''.join((struct.pack('>qll', self.connection_id,
+         self.ACTION_SCRAPE, tid),) + self.info_hashes)
+   
+   def frame_process_scrape(self, data):
+      """Process scrape response"""
+      if (self.state != 1):
+         raise TrackerResponseError('{0!a}.frame_process_scrape({1!a}) got called while state == {2!a}.'.format(self, data, self.state))
+      if (len(data) != 12*len(self.info_hashes)):
+         raise ValueError('Data {0!a} invalid; expected {1} bytes.'.format(data, 12*len(self.info_hashes)))
+      
+      rv = {}
+      for (i, info_hash) in enumerate(self.info_hashes):
+         (seeders, completed, leechers) = struct.unpack('>lll', data[i*12:(i+1)*12])
+         rv[info_hash] = {
+            b'complete': seeders,
+            b'incomplete': leechers,
+            b'downloaded': completed
+         }
+      self.result_callback(self, rv)
+      self.close()
+   
+   FRAME_HANDLERS = {
+      UDPTrackerRequest.ACTION_CONNECT:UDPTrackerRequest.frame_process_init,
+      UDPTrackerRequest.ACTION_SCRAPE:frame_process_scrape,
+      UDPTrackerRequest.ACTION_ERROR:UDPTrackerRequest.frame_process_error
+   }
+
+
 _request_types = {}
 for cls in (HTTPTrackerRequest,UDPTrackerRequest):
    _request_types[cls.proto] = cls
 del(cls)
 
 
+_scrape_request_types = {}
+for cls in (HTTPTrackerScrapeRequest, UDPTrackerScrapeRequest):
+   _scrape_request_types[cls.proto] = cls
+del(cls)
+
+
 def tracker_request_build(announce_url, *args, **kwargs):
    proto = HTTPLikeURL.build_from_urlstring(announce_url).proto
    try:
@@ -425,3 +710,24 @@ def tracker_request_build(announce_url, *args, **kwargs):
    
    return cls(announce_url, *args, **kwargs)
 
+
+
+def tracker_scrape_request_build(announce_url, info_hashes):
+   """Build scrape request for tracker with specified announce URL"""
+   proto = HTTPLikeURL.build_from_urlstring(announce_url).proto
+   try:
+      cls = _scrape_request_types[proto]
+   except KeyError:
+      raise ValueError('Unknown proto {0!a} in announce URL {1!a}.'.format(proto, announce_url))
+   
+   scrape_url = scrape_url_get(announce_url)
+   if (scrape_url is None):
+      raise ValueError("Tracker {0!a} doesn't support scraping.".format(announce_url))
+   return cls(scrape_url, info_hashes)
+
+
+def scrape_request_info_hashes_max(announce_url):
+   """Return maximum number of info hashes to pass in one scrape request to
+      tracker with specified announce URL"""
+   proto = HTTPLikeURL.build_from_urlstring(announce_url).proto
+   return _scrape_request_types[proto].info_hashes_max
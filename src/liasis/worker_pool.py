@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#Copyright 2009 Sebastian Hagen
+# This file is part of liasis.
+#
+# liasis is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# liasis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Execution of blocking calls outside of the event loop thread"""
+
+import logging
+import os
+import threading
+from collections import deque, Callable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from hashlib import sha1
+
+from gonium.fdm import AsyncDataStream
+
+_logger = logging.getLogger('WorkerPool')
+_log = _logger.log
+
+
+def sha1_digest(data):
+   """Return SHA1 digest of data"""
+   return sha1(data).digest()
+
+
+class WorkerPoolRequest:
+   """Pending or finished call on a WorkerPool"""
+   def __init__(self, callback):
+      self.callback = callback
+      self.rv = None
+      self.failed = False
+
+   def _process_result(self, future):
+      """Process finished future; called from event loop thread"""
+      try:
+         self.rv = future.result()
+      except Exception:
+         _log(40, 'WorkerPoolRequest {0!a} failed:'.format(self), exc_info=True)
+         self.failed = True
+      self.callback(self)
+
+
+class _WorkerPoolNotifier(AsyncDataStream):
+   """Read end of a WorkerPool's self-pipe"""
+   def __init__(self, pool, *args, **kwargs):
+      AsyncDataStream.__init__(self, *args, **kwargs)
+      self.pool = pool
+
+   def process_input(self, in_data):
+      self.discard_inbuf_data()
+      self.pool._results_process()
+
+   def process_close(self):
+      if not (self.pool is None):
+         _log(40, 'Notification pipe of {0!a} closed unexpectedly.'.format(self.pool))
+      self.pool = None
+
+
+class WorkerPool:
+   """Pool of worker threads or processes for blocking calls
+
+   Calls are made from the pool's workers; their results are passed back to
+   the event loop by writing to a self-pipe monitored by the event dispatcher,
+   and the specified callbacks are called from the event loop thread."""
+   def __init__(self, event_dispatcher, workers=None, processes=False):
+      if (processes):
+         executor_cls = ProcessPoolExecutor
+      else:
+         executor_cls = ThreadPoolExecutor
+      self.processes = processes
+      self._executor = executor_cls(workers)
+      self._results = deque()
+      # Guards _results, and _fd_w against being closed while we write to it
+      self._results_lock = threading.Lock()
+      self.closed = False
+
+      (fd_r, fd_w) = os.pipe()
+      os.set_blocking(fd_w, False)
+      self._fd_w = fd_w
+      self._notifier = _WorkerPoolNotifier(self, event_dispatcher,
+         os.fdopen(fd_r, 'rb', 0))
+
+   def call(self, func, args, callback:Callable) -> WorkerPoolRequest:
+      """Call func with args on one of our workers, and pass request to
+         callback once it is done"""
+      if (self.processes):
+         # memoryviews can't be pickled.
+         args = tuple((bytes(arg) if isinstance(arg, memoryview) else arg)
+            for arg in args)
+      req = WorkerPoolRequest(callback)
+      future = self._executor.submit(func, *args)
+      future.liasis_req = req
+      future.add_done_callback(self._result_queue)
+      return req
+
+   def sha1_digest(self, data, callback:Callable) -> WorkerPoolRequest:
+      """Compute SHA1 digest of data on one of our workers"""
+      return self.call(sha1_digest, (data,), callback)
+
+   def _result_queue(self, future):
+      """Queue finished future for processing by the event loop thread; may be
+         called from any thread"""
+      with self._results_lock:
+         if (self.closed):
+            # The fd number may have been reused by now.
+            return
+         notify = (len(self._results) == 0)
+         self._results.append(future)
+         if (notify):
+            try:
+               os.write(self._fd_w, b'\x00')
+            except BlockingIOError:
+               # Notification already pending.
+               pass
+
+   def _results_process(self):
+      """Pass results of finished calls to their callbacks"""
+      with self._results_lock:
+         results = self._results
+         self._results = deque()
+
+      for future in results:
+         future.liasis_req._process_result(future)
+
+   def close(self):
+      """Shut down workers and drop any pending calls"""
+      self._executor.shutdown(wait=False)
+      with self._results_lock:
+         if (self.closed):
+            return
+         self.closed = True
+         os.close(self._fd_w)
+         self._results = deque()
+      self._notifier.pool = None
+      self._notifier.close()
+
+   def __repr__(self):
+      return '<{0} processes: {1} id: {2}>'.format(self.__class__.__name__,
+         self.processes, id(self))